@@ -1,11 +1,17 @@
 import time
+import asyncio
 import logging
 import random
 import os
-import boto3
+import threading
 import base64
-from typing import Callable, List, Dict, Any, Optional
-from botocore.exceptions import ClientError
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from io import BytesIO
+from typing import Awaitable, Callable, List, Dict, Any, Optional, Tuple, Union
+
+from metrics import RETRIES, S3_UPLOAD_LATENCY, VERTEX_LATENCY, record_span
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
@@ -13,17 +19,186 @@ logger = logging.getLogger(__name__)
 
 
 
+def error_status_code(error: Exception) -> Optional[int]:
+    """Best-effort HTTP status code of an SDK exception (google.api_core / botocore)"""
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        return response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return None
+
+
+# Client errors caused by the project rather than the request: revoked credentials,
+# API disabled, model not enabled in the project
+PROJECT_ERROR_STATUSES = (401, 403, 404)
+
+
+class ProjectsSaturated(Exception):
+    """Every project is at its max_in_flight quota and none freed up in time"""
+
+    # Retried and reported like a quota error
+    code = 429
+
+
 class SDKRotator:
-    def __init__(self, sdk_configs: List[Dict[str, Any]]):
+    """
+    Thread-safe scheduler over the configured GCP projects
+
+    Every call leases a config: the least-loaded healthy project is picked
+    (in-flight requests divided by the config's optional "weight"), ties go
+    round-robin, projects that just failed are passed over so retries land
+    elsewhere, and projects at their optional "max_in_flight" quota are
+    skipped; when every project is at quota, acquire waits up to
+    acquire_timeout seconds for a slot and then raises ProjectsSaturated.
+    429 / 5xx, 401 / 403 / 404 and other non-client errors count against a
+    project; after failure_threshold consecutive failures its circuit opens
+    for cooldown seconds and traffic moves to the other projects.
+    """
+
+    def __init__(self, sdk_configs: List[Dict[str, Any]], failure_threshold: int = 3, cooldown: float = 30.0, acquire_timeout: float = 5.0):
         self.sdk_configs = sdk_configs
         self.current_index = 0
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.acquire_timeout = acquire_timeout
+        self._lock = threading.Lock()
+        # Signalled on every release, for acquire calls waiting on a quota slot
+        self._released = threading.Condition(self._lock)
+        self._stats = [
+            {
+                "in_flight": 0,
+                "successes": 0,
+                "failures": 0,
+                "throttled": 0,
+                "server_errors": 0,
+                "project_errors": 0,
+                "consecutive_failures": 0,
+                "last_failure": float("-inf"),
+                "open_until": 0.0,
+            }
+            for _ in sdk_configs
+        ]
 
     def get_current_config(self) -> Dict[str, Any]:
         return self.sdk_configs[self.current_index]
     
     def rotate(self) -> Dict[str, Any]:
-        self.current_index = (self.current_index + 1) % len(self.sdk_configs)
-        return self.get_current_config()
+        with self._lock:
+            self.current_index = (self.current_index + 1) % len(self.sdk_configs)
+            return self.sdk_configs[self.current_index]
+
+    def _index_of(self, config: Dict[str, Any]) -> int:
+        for index, candidate in enumerate(self.sdk_configs):
+            if candidate is config or candidate["project_id"] == config["project_id"]:
+                return index
+        raise ValueError(f"Unknown SDK config: {config.get('project_id')}")
+
+    def acquire(self) -> Dict[str, Any]:
+        """
+        Pick a project for one call and count it as in flight; pair with release()
+
+        Raises:
+            ProjectsSaturated: If every project stayed at its max_in_flight quota for acquire_timeout seconds
+        """
+        count = len(self.sdk_configs)
+        deadline = time.monotonic() + self.acquire_timeout
+
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                candidates = []
+                below_quota = []
+                for index, config in enumerate(self.sdk_configs):
+                    stats = self._stats[index]
+                    max_in_flight = config.get("max_in_flight")
+                    if max_in_flight and stats["in_flight"] >= max_in_flight:
+                        continue
+                    below_quota.append(index)
+                    if stats["open_until"] > now:
+                        continue
+                    load = stats["in_flight"] / config.get("weight", 1.0)
+                    distance = (index - self.current_index) % count
+                    # Projects that failed within the cooldown window are only used when nothing else is free
+                    recently_failed = stats["consecutive_failures"] > 0 and now - stats["last_failure"] < self.cooldown
+                    candidates.append((recently_failed, load, distance, index))
+
+                if candidates:
+                    index = min(candidates)[3]
+                    break
+                if below_quota:
+                    # Every project with spare quota is tripped - use the one that recovers first
+                    index = min(below_quota, key=lambda i: self._stats[i]["open_until"])
+                    logger.warning(f"No healthy SDK config available, falling back to {self.sdk_configs[index]['project_id']}")
+                    break
+
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise ProjectsSaturated(f"All {count} projects at their max_in_flight quota")
+                self._released.wait(remaining)
+
+            self._stats[index]["in_flight"] += 1
+            self.current_index = (index + 1) % count
+            return self.sdk_configs[index]
+
+    def release(self, config: Dict[str, Any], error: Optional[Exception] = None) -> None:
+        """Record the outcome of a call made with a config returned by acquire()"""
+        index = self._index_of(config)
+        status = error_status_code(error) if error is not None else None
+
+        with self._lock:
+            stats = self._stats[index]
+            stats["in_flight"] = max(0, stats["in_flight"] - 1)
+            self._released.notify()
+
+            if error is None:
+                stats["successes"] += 1
+                stats["consecutive_failures"] = 0
+                stats["open_until"] = 0.0
+                return
+
+            if status == 429:
+                stats["throttled"] += 1
+            elif status is not None and status >= 500:
+                stats["server_errors"] += 1
+            elif status in PROJECT_ERROR_STATUSES:
+                stats["project_errors"] += 1
+            elif status is not None and 400 <= status < 500:
+                # The request itself was bad; the project is healthy
+                return
+
+            stats["failures"] += 1
+            stats["consecutive_failures"] += 1
+            stats["last_failure"] = time.monotonic()
+            if stats["consecutive_failures"] >= self.failure_threshold:
+                stats["open_until"] = time.monotonic() + self.cooldown
+                logger.warning(f"Circuit opened for project {config['project_id']} for {self.cooldown:.0f}s after {stats['consecutive_failures']} consecutive failures")
+
+    @contextmanager
+    def lease(self, operation: str = "call"):
+        """Context manager around acquire()/release() for a single call, timed per project"""
+        config = self.acquire()
+        start = time.perf_counter()
+        try:
+            yield config
+        except Exception as e:
+            self.release(config, e)
+            outcome = "throttled" if error_status_code(e) == 429 else "error"
+            record_span(f"vertex.{operation}", start, VERTEX_LATENCY.labels(config["project_id"], operation, outcome))
+            raise
+        else:
+            self.release(config)
+            record_span(f"vertex.{operation}", start, VERTEX_LATENCY.labels(config["project_id"], operation, "success"))
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Snapshot of per-project counters and circuit state"""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                dict(stats, project_id=config["project_id"], circuit_open=stats["open_until"] > now)
+                for config, stats in zip(self.sdk_configs, self._stats)
+            ]
 
 def exponential_backoff_retry(
 
@@ -31,7 +206,8 @@ def exponential_backoff_retry(
     max_retries: int = 3,
     base_delay: float = 1.0,
     max_delay: float = 60.0,
-    jitter: bool = True
+    jitter: bool = True,
+    operation: str = "call"
 ) -> Any:
 
     """
@@ -43,6 +219,7 @@ def exponential_backoff_retry(
         base_delay: Initial delay between retries in seconds
         max_delays: Maximum delay between retries in seconds
         jitter: Whether to add random jitter into the delay
+        operation: Label for the retry counter on /metrics
 
     Returns:
         Returns result if function call is successful
@@ -68,11 +245,65 @@ def exponential_backoff_retry(
                 delay = delay * (0.5 + random.random())
 
             logger.warning(f"Attempt {attempt + 1}/{max_retries} failed: {str(e)}. Retrying in {delay:.2f}s")
+            RETRIES.labels(operation).inc()
             time.sleep(delay)
 
     # The above exception should be raised instead of this one
     raise last_exception
 
+async def async_exponential_backoff_retry(
+
+    func: Callable[[], Awaitable[Any]],
+    max_retries: int = 3,
+    base_delay: float = 1.0,
+    max_delay: float = 60.0,
+    jitter: bool = True,
+    operation: str = "call"
+) -> Any:
+
+    """
+    Await a coroutine function with exponential backoff retry logic
+
+    Same policy as exponential_backoff_retry, but waits with asyncio.sleep
+    so the event loop keeps serving other requests between attempts.
+
+    Args:
+        func: Zero-argument callable returning an awaitable
+        max_retries: Maximum number of retry attempts
+        base_delay: Initial delay between retries in seconds
+        max_delay: Maximum delay between retries in seconds
+        jitter: Whether to add random jitter into the delay
+        operation: Label for the retry counter on /metrics
+
+    Returns:
+        Returns result if function call is successful
+
+    Raises:
+        Exception: The last exception encountered if all retries fail
+    """
+
+    last_exception = None
+
+    for attempt in range(max_retries):
+        try:
+            return await func()
+        except Exception as e:
+            last_exception = e
+            if attempt == max_retries - 1:
+                logger.error(f"All {max_retries} retry attempts failed")
+                raise
+
+            delay = min(base_delay * (2 ** attempt), max_delay)
+
+            if jitter:
+                delay = delay * (0.5 + random.random())
+
+            logger.warning(f"Attempt {attempt + 1}/{max_retries} failed: {str(e)}. Retrying in {delay:.2f}s")
+            RETRIES.labels(operation).inc()
+            await asyncio.sleep(delay)
+
+    raise last_exception
+
 
 
 def read_secret(secret_path):
@@ -103,10 +334,87 @@ S3_REGION = os.environ.get("S3_REGION", "eu-north-1")
 
 
 class S3ImageManager:
-    def __init__(self, bucket_name: str, region: str = 'eu-north-1'):
+    """
+    S3 uploads through a single tuned, thread-safe boto3 client
+
+    The client's connection pool, timeouts, TCP keep-alive and retry mode
+    are configurable, endpoint_url points it at a local stand-in (MinIO,
+    moto server) for tests, and uploads can run on a bounded thread pool
+    returning futures so several variants go up concurrently. boto3 is
+    imported and the client built on first use, not at construction.
+    """
+
+    def __init__(
+        self,
+        bucket_name: str,
+        region: str = 'eu-north-1',
+        max_pool_connections: int = 50,
+        connect_timeout: float = 5,
+        read_timeout: float = 30,
+        max_attempts: int = 3,
+        retry_mode: str = 'adaptive',
+        tcp_keepalive: bool = True,
+        endpoint_url: Optional[str] = None,
+        upload_workers: int = 16,
+        multipart_threshold: int = 8 * 1024 * 1024,
+    ):
         self.bucket_name = bucket_name
         self.region = region
-        self.s3_client = boto3.client('s3', region_name=region)
+        self.endpoint_url = endpoint_url
+        self._client_config = {
+            "max_pool_connections": max_pool_connections,
+            "connect_timeout": connect_timeout,
+            "read_timeout": read_timeout,
+            "retries": {"max_attempts": max_attempts, "mode": retry_mode},
+            "tcp_keepalive": tcp_keepalive,
+        }
+        self._s3_client = None
+        self._transfer_config = None
+        self._client_lock = threading.Lock()
+        # Bodies at or above the threshold go through the transfer manager as multipart uploads
+        self.multipart_threshold = multipart_threshold
+        self._upload_executor = ThreadPoolExecutor(max_workers=upload_workers, thread_name_prefix="s3-upload")
+
+    @property
+    def s3_client(self):
+        """The boto3 S3 client, created on first use"""
+        if self._s3_client is None:
+            return self.connect()
+        return self._s3_client
+
+    @s3_client.setter
+    def s3_client(self, client) -> None:
+        self._s3_client = client
+
+    def connect(self):
+        """Build the boto3 client now instead of on the first upload; returns the client"""
+        with self._client_lock:
+            if self._s3_client is None:
+                import boto3
+                from botocore.config import Config
+
+                self._s3_client = boto3.client(
+                    's3',
+                    region_name=self.region,
+                    endpoint_url=self.endpoint_url,
+                    config=Config(**self._client_config),
+                )
+        return self._s3_client
+
+    @property
+    def transfer_config(self):
+        """Transfer manager settings for multipart uploads, created on first use"""
+        if self._transfer_config is None:
+            from boto3.s3.transfer import TransferConfig
+
+            self._transfer_config = TransferConfig(multipart_threshold=self.multipart_threshold, max_concurrency=4)
+        return self._transfer_config
+
+    def object_url(self, key_name: str) -> str:
+        """Public URL of an object in the bucket"""
+        if self.endpoint_url:
+            return f"{self.endpoint_url.rstrip('/')}/{self.bucket_name}/{key_name}"
+        return f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{key_name}"
 
     def upload_image(self, image_data: bytes, key_name: str, content_type: str = 'image/png') -> str:
 
@@ -121,22 +429,63 @@ class S3ImageManager:
         Returns:
             Public URL of the uploaded image
         """
-
+        start = time.perf_counter()
+        outcome = "error"
         try:
-            self.s3_client.put_object(
-                Bucket=self.bucket_name,
-                Key=key_name,
-                Body=image_data,
-                ContentType=content_type, 
-            )
+            if len(image_data) >= self.multipart_threshold:
+                self.s3_client.upload_fileobj(
+                    BytesIO(image_data),
+                    self.bucket_name,
+                    key_name,
+                    ExtraArgs={"ContentType": content_type},
+                    Config=self.transfer_config,
+                )
+            else:
+                self.s3_client.put_object(
+                    Bucket=self.bucket_name,
+                    Key=key_name,
+                    Body=image_data,
+                    ContentType=content_type, 
+                )
+            outcome = "success"
 
             # Construct the URL using the bucket and region
-            url = f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{key_name}"
-            return url
+            return self.object_url(key_name)
 
-        except ClientError as e:
+        except Exception as e:
+            # ClientError, but also timeouts and EndpointConnectionError
             logger.error(f"Failed to upload image to S3: {e}")
             raise
+        finally:
+            record_span("s3.upload", start, S3_UPLOAD_LATENCY.labels(outcome))
+
+    def upload_image_async(self, image_data: bytes, key_name: str, content_type: str = 'image/png') -> Future:
+        """
+        Start an upload on the upload thread pool
+
+        Returns:
+            Future resolving to the public URL; await it from async code with asyncio.wrap_future
+        """
+        # Run in a copy of the caller's context so the upload shows up in its request trace
+        context = contextvars.copy_context()
+        return self._upload_executor.submit(context.run, self.upload_image, image_data, key_name, content_type)
+
+    def upload_images(self, images: List[Tuple[bytes, str, str]]) -> List[Union[str, Exception]]:
+        """
+        Upload several images concurrently on the upload thread pool
+
+        Waits for every upload, so one failure doesn't leave the others
+        running unobserved; callers decide which failures are fatal.
+
+        Args:
+            images: (image data, key name, content type) per image
+
+        Returns:
+            Public URL, or the exception the upload raised, per image in the same order
+        """
+        futures = [self.upload_image_async(data, key, content_type) for data, key, content_type in images]
+        wait(futures)
+        return [future.exception() or future.result() for future in futures]
 
     def get_image_as_base64(self, key_name: str) -> str:
         """
@@ -148,6 +497,8 @@ class S3ImageManager:
         Returns:
             Base64-encoded string representation of the image
         """
+        from botocore.exceptions import ClientError
+
         try:
             response = self.s3_client.get_object(
                 Bucket=self.bucket_name,
@@ -0,0 +1,160 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from metrics import ADMISSION_REJECTED, ADMISSION_WAIT, record_span
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """A request was turned away: no slot was free and the wait queue was full or timed out"""
+
+    def __init__(self, kind: str, reason: str):
+        super().__init__(f"{kind} requests over capacity ({reason})")
+        self.kind = kind
+        self.reason = reason
+
+
+class ConcurrencyLimiter:
+    """
+    At most limit holders at once, with a bounded FIFO queue of waiters
+
+    A caller that finds every slot taken waits for up to wait_timeout
+    seconds, unless max_waiting callers are already waiting, in which case
+    it is rejected straight away. Released slots are handed to the oldest
+    waiter directly, so a newcomer can't overtake the queue.
+    """
+
+    def __init__(self, name: str, limit: int, max_waiting: int = 0, wait_timeout: float = 0.0):
+        self.name = name
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    async def acquire(self) -> None:
+        """
+        Take a slot, waiting in the queue if none is free
+
+        Raises:
+            Overloaded: If the queue is full or the wait timed out
+        """
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+
+        if len(self._waiters) >= self.max_waiting:
+            raise Overloaded(self.name, "queue_full")
+
+        start = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.wait_timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # Handed a slot just as the wait ended; pass it on
+                self.release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                raise Overloaded(self.name, "timeout") from None
+            raise
+        finally:
+            record_span("admission.wait", start, ADMISSION_WAIT.labels(self.name))
+
+    def release(self) -> None:
+        """Give the slot to the oldest waiter, or free it"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class Permit:
+    """A slot held by one request; release is idempotent"""
+
+    def __init__(self, controller: Optional["AdmissionController"] = None, kind: Optional[str] = None, session_id: Optional[str] = None):
+        self._controller = controller
+        self.kind = kind
+        self.session_id = session_id
+
+    def release(self) -> None:
+        controller, self._controller = self._controller, None
+        if controller is not None:
+            controller._release(self.kind, self.session_id)
+
+
+class AdmissionController:
+    """
+    Admission control in front of the Vertex-bound handlers
+
+    Each kind of work has its own ConcurrencyLimiter, so slow image
+    generation can't starve text replies. A session may hold at most
+    session_limit slots across kinds; a session over its limit is turned
+    away at once instead of queueing, so one client can't fill the queue
+    for everyone else. FAQ answers and support handovers don't go through
+    here, which keeps them fast however busy the models are.
+    """
+
+    def __init__(self, limiters: Dict[str, ConcurrencyLimiter], session_limit: int = 0):
+        self.limiters = limiters
+        self.session_limit = session_limit
+        self._sessions: Dict[str, int] = {}
+
+    async def acquire(self, kind: Optional[str], session_id: Optional[str] = None) -> Permit:
+        """
+        Take a slot for a request of the given kind
+
+        Args:
+            kind: Limiter name ("text", "image"), None for requests that aren't limited
+            session_id: Session making the request, counted against session_limit
+
+        Returns:
+            A permit to release once the request is done
+
+        Raises:
+            Overloaded: If the session or the limiter is over capacity
+        """
+        limiter = self.limiters.get(kind) if kind is not None else None
+        if limiter is None:
+            return Permit()
+
+        # Counted before waiting, so a session's queued requests also count towards its limit
+        held = self._sessions.get(session_id, 0) if session_id is not None else 0
+        if self.session_limit > 0 and held >= self.session_limit:
+            self._reject(kind, "session")
+        if session_id is not None:
+            self._sessions[session_id] = held + 1
+
+        try:
+            await limiter.acquire()
+        except BaseException as e:
+            self._release_session(session_id)
+            if isinstance(e, Overloaded):
+                self._reject(kind, e.reason)
+            raise
+        return Permit(self, kind, session_id)
+
+    def _reject(self, kind: str, reason: str) -> None:
+        ADMISSION_REJECTED.labels(kind, reason).inc()
+        logger.warning(f"Shedding {kind} request: {reason}")
+        raise Overloaded(kind, reason)
+
+    def _release(self, kind: str, session_id: Optional[str]) -> None:
+        self.limiters[kind].release()
+        self._release_session(session_id)
+
+    def _release_session(self, session_id: Optional[str]) -> None:
+        if session_id is not None:
+            remaining = self._sessions.get(session_id, 0) - 1
+            if remaining > 0:
+                self._sessions[session_id] = remaining
+            else:
+                self._sessions.pop(session_id, None)
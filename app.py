@@ -1,16 +1,50 @@
 import os
+import hmac
+import asyncio
 import json
-import uuid
-import redis
 import logging
-from datetime import datetime, timedelta
+from collections import Counter
 from typing import List, Dict, Any, Optional
-from fastapi import FastAPI, Request, Response, Cookie, Depends, HTTPException
+from fastapi import FastAPI, Request, Response, Cookie, Depends, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.datastructures import MutableHeaders
+from starlette.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
-from starlette.responses import JSONResponse
-
-from vertex import process_message
+from starlette.responses import PlainTextResponse, StreamingResponse
+
+from session_store import (
+    redis_client,
+    async_redis_client,
+    SESSION_EXPIRY,
+    HISTORY_PROMPT_TURNS,
+    bootstrap_session,
+    purge_expired_sessions,
+    read_secret,
+    session_memory_report,
+    session_memory_usage,
+    fold_session_history,
+    update_chat_history,
+)
+from admission import AdmissionController, ConcurrencyLimiter, Overloaded, Permit
+from image_jobs import ImageJobQueue
+from image_processing import shutdown_process_pool, start_process_pool
+import metrics
+from image_store import IMAGE_ID_PATTERN
+from metrics import REQUEST_LATENCY, start_trace
+from prompt_context import needs_fold
+from router import GOOD_MATCH_THRESHOLD, POOR_MATCH_THRESHOLD, ROUTE_IMAGE, ROUTE_TEXT, RouteDecision
+from vertex import (
+    process_message_async,
+    stream_message_async,
+    build_busy_result,
+    intent_router,
+    summarize_history_async,
+    generate_image_response_async,
+    qa_manager,
+    fallback_images,
+    warm_up_clients,
+    warm_up_models,
+)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
@@ -32,41 +66,63 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-def read_secret(secret_path):
-    try:
-        with open(secret_path, 'r') as file:
-            return file.read().strip()
-    except Exception as e:
-        logger.error(f"Failed to read secret from {secret_path}: {e}")
-        return None
+# Compress JSON responses above COMPRESS_MIN_SIZE bytes; brotli when brotli-asgi is installed,
+# gzip otherwise. Images and event streams are left alone.
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
 
-redis_password_path = os.environ.get('REDIS_PASSWORD_FILE', '/run/secrets/redis_password')
+if BrotliMiddleware is not None:
+    app.add_middleware(BrotliMiddleware, minimum_size=COMPRESS_MIN_SIZE, gzip_fallback=True)
+else:
+    app.add_middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_SIZE)
 
-# Read secrets and set them as environment variables for boto3
+class RequestTracing:
+    """
+    Time every request, return its spans as Server-Timing and log one line per request
 
-REDIS_PASSWORD = None
-if os.path.exists(redis_password_path):
-    REDIS_PASSWORD = read_secret(redis_password_path)
-    if REDIS_PASSWORD:
-        print(f"Redis password loaded succesfully, length: {len(REDIS_PASSWORD)}") 
-    else:
-        print(f"Failed to load Redis password") 
-else:
-    print(f"Redis password not found at path: {redis_password_path}") 
-
-# Initialize Redis client
-REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
-REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
-REDIS_DB = int(os.environ.get("REDIS_DB", 0))
-#REDIS_PASSWORD = os.environ.get("REDIS_PASSWORD", None)
-
-redis_client = redis.Redis(
-    host=REDIS_HOST,
-    port=REDIS_PORT, 
-    db=REDIS_DB,
-    password=REDIS_PASSWORD,
-    decode_responses=True
-)
+    Plain ASGI middleware rather than BaseHTTPMiddleware, so the clock stops
+    when the last body chunk has been sent: streamed responses are timed to
+    the end of the stream, not to their headers. Server-Timing carries the
+    spans recorded before the headers went out.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        trace = start_trace(f"{method} {scope['path']}")
+        status_code = 500
+
+        async def send_with_trace(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                headers = MutableHeaders(scope=message)
+                headers["X-Trace-Id"] = trace.trace_id
+                server_timing = trace.server_timing()
+                if server_timing:
+                    headers["Server-Timing"] = server_timing
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            # Label by route template so path parameters don't explode the series
+            route = scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            duration = trace.elapsed()
+            REQUEST_LATENCY.labels(method, route_path, status_code).observe(duration)
+            logger.info(f"{method} {route_path} {status_code} {duration * 1000:.1f}ms trace={trace.trace_id} {trace.server_timing()}")
+
+app.add_middleware(RequestTracing)
 
 try:
     redis_client.ping()
@@ -74,52 +130,173 @@ try:
 except Exception as e:
     print(f"Redis connection failed: {e}")
 
-print(f"Secret path exists: {os.path.exists(redis_password_path)}")
-print(f"REDIS_PASSWORD length: {len(REDIS_PASSWORD) if REDIS_PASSWORD else 0}")
+# Build Vertex AI clients in the background at startup
+VERTEX_WARMUP = os.environ.get("VERTEX_WARMUP", "true").lower() == "true"
+
+# Import the SDKs vertex defers (vertexai, PIL, boto3) in the background once serving starts;
+# when false they load on first use
+CLIENT_WARMUP = os.environ.get("CLIENT_WARMUP", "true").lower() == "true"
+
+# Seconds between sweeps of the session expiry index, 0 disables the background sweep
+SESSION_CLEANUP_INTERVAL = int(os.environ.get("SESSION_CLEANUP_INTERVAL", 300))
+
+# Bearer token for the admin endpoints, from a Docker secret like the Redis password or from
+# ADMIN_TOKEN; without one the admin endpoints answer 404 as if they weren't mounted
+ADMIN_TOKEN_FILE = os.environ.get("ADMIN_TOKEN_FILE", "/run/secrets/admin_token")
+ADMIN_TOKEN = read_secret(ADMIN_TOKEN_FILE) if os.path.exists(ADMIN_TOKEN_FILE) else os.environ.get("ADMIN_TOKEN")
+
+# Largest batch accepted by /faq/match-batch
+FAQ_BATCH_MAX_MESSAGES = int(os.environ.get("FAQ_BATCH_MAX_MESSAGES", 10000))
+
+# Admission control for requests that reach Gemini or Imagen; FAQ answers and handovers are never limited
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "true").lower() == "true"
+
+# Answer shed requests with a busy support contact response instead of a 429
+ADMISSION_DEGRADE = os.environ.get("ADMISSION_DEGRADE", "true").lower() == "true"
+
+# Retry-After, in seconds, sent with 429 responses
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", 2))
+
+# Concurrent text and image generations, requests allowed to queue for a slot, and how long they may wait
+admission = AdmissionController(
+    {
+        "text": ConcurrencyLimiter(
+            "text",
+            limit=int(os.environ.get("ADMISSION_TEXT_LIMIT", 32)),
+            max_waiting=int(os.environ.get("ADMISSION_TEXT_QUEUE", 64)),
+            wait_timeout=float(os.environ.get("ADMISSION_WAIT_TIMEOUT", 5.0)),
+        ),
+        "image": ConcurrencyLimiter(
+            "image",
+            limit=int(os.environ.get("ADMISSION_IMAGE_LIMIT", 4)),
+            max_waiting=int(os.environ.get("ADMISSION_IMAGE_QUEUE", 8)),
+            wait_timeout=float(os.environ.get("ADMISSION_WAIT_TIMEOUT", 5.0)),
+        ),
+    },
+    session_limit=int(os.environ.get("ADMISSION_SESSION_LIMIT", 2)),
+)
+
+# Fire-and-forget tasks, referenced here so they aren't garbage collected mid-flight
+background_tasks = set()
 
-# Session expiry time (24 hours)
-SESSION_EXPIRY = 60 * 60 * 24
+# Image generation jobs run on a fixed pool of workers instead of the request
+image_jobs = ImageJobQueue(
+    async_redis_client,
+    generate_image_response_async,
+    workers=int(os.environ.get("IMAGE_JOB_WORKERS", 4)),
+    max_queued=int(os.environ.get("IMAGE_JOB_QUEUE_SIZE", 100)),
+    ttl=int(os.environ.get("IMAGE_JOB_TTL", 3600)),
+)
 
 # Models 
 class MessageRequest(BaseModel):
     message: str
+    # Queue image requests and return a job id instead of waiting for the image
+    async_image: bool = False
 
 class MessageResponse(BaseModel):
     response: Dict[str, Any]
     session_id: str
 
+class FAQBatchRequest(BaseModel):
+    messages: List[str]
+    good_threshold: int = GOOD_MATCH_THRESHOLD
+    poor_threshold: int = POOR_MATCH_THRESHOLD
+
 # Helper functions
-def get_or_create_session(session_id: Optional[str] = None) -> str:
-    """Get existing session or create a new one"""
-    if session_id and redis_client.exists(f"session:{session_id}"):
-        # Reset session expiry time
-        redis_client.expire(f"session:{session_id}", SESSION_EXPIRY)
-        redis_client.expire(f"history:{session_id}", SESSION_EXPIRY)
-        return session_id
-
-    # Create new session
-    new_session_id = str(uuid.uuid4())
-    redis_client.set(f"session:{new_session_id}", json.dumps({
-        "created_at": datetime.now().isoformat(),
-    }), ex=SESSION_EXPIRY)
-
-    # Initialize empty history
-    redis_client.set(f"history:{new_session_id}", json.dumps([]), ex=SESSION_EXPIRY)
-
-    return new_session_id
-
-def get_chat_history(session_id: str) -> List[Dict[str, Any]]:
-    """Get chat history for a session"""
-    history_json = redis_client.get(f"history:{session_id}")
-    if history_json:
-        return json.loads(history_json)
-    return []
-
-def update_chat_history(session_id: str, entry: Dict[str, Any]) -> None:
-    """Update chat history for a session"""
-    history = get_chat_history(session_id)
-    history.append(entry)
-    redis_client.set(f"history:{session_id}", json.dumps(history), ex=SESSION_EXPIRY)
+def set_session_cookie(response: Response, session_id: str) -> None:
+    """Attach the secure session cookie to a response"""
+    response.set_cookie(
+        key="session_id",
+        value=session_id,
+        max_age=SESSION_EXPIRY,
+        httponly=True,
+        secure=True,
+        samesite="lax"
+    )
+
+async def fold_history_in_background(session_id: str) -> None:
+    try:
+        await fold_session_history(session_id, summarize_history_async)
+    except Exception as e:
+        logger.error(f"Failed to fold history of session {session_id}: {e}")
+
+def schedule_history_fold(session_id: str, history: List[Dict[str, Any]], summary: Optional[str]) -> None:
+    """Summarise older turns off the request path once the history outgrows the prompt budget"""
+    if not needs_fold(history, summary, max_turns=HISTORY_PROMPT_TURNS):
+        return
+
+    task = asyncio.create_task(fold_history_in_background(session_id))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def sweep_expired_sessions() -> None:
+    """Periodically delete history and summaries left behind by expired sessions"""
+    while True:
+        await asyncio.sleep(SESSION_CLEANUP_INTERVAL)
+        try:
+            await purge_expired_sessions()
+        except Exception as e:
+            logger.error(f"Session cleanup failed: {e}")
+
+def admission_kind(decision: RouteDecision, async_image: bool = False) -> Optional[str]:
+    """Limiter a routed message must pass, None if it is answered without the models or queued as an image job"""
+    if not ADMISSION_CONTROL:
+        return None
+    if decision.route == ROUTE_TEXT:
+        return "text"
+    if decision.route == ROUTE_IMAGE and not (async_image and not image_jobs.full()):
+        return "image"
+    return None
+
+def shed_load(decision: RouteDecision) -> Dict[str, Any]:
+    """
+    Response for a request turned away by admission control
+
+    Raises:
+        HTTPException: 429 with Retry-After when degraded responses are disabled
+    """
+    if not ADMISSION_DEGRADE:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests, please try again shortly",
+            headers={"Retry-After": str(ADMISSION_RETRY_AFTER)},
+        )
+    return build_busy_result(decision)["response"]
+
+def require_admin(authorization: Optional[str] = Header(None)) -> None:
+    """Dependency guarding the admin endpoints with the ADMIN_TOKEN bearer token"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Admin token required", headers={"WWW-Authenticate": "Bearer"})
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """Encode one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+class PermitStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that releases an admission permit once it is done
+
+    The release runs when the response's ASGI call returns, so the slot is
+    freed even when the body iterator never starts (the client disconnected
+    before the first chunk, or sending the headers failed) and its finally
+    block never runs.
+    """
+
+    def __init__(self, content, permit: Optional[Permit], **kwargs):
+        super().__init__(content, **kwargs)
+        self.permit = permit
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.permit is not None:
+                self.permit.release()
 
 @app.post("/send-message", response_model=MessageResponse)
 async def send_message(
@@ -131,55 +308,220 @@ async def send_message(
     """
     Send message to the chat for response
     """
-    # Get or create a session
-    session_id = get_or_create_session(session_id)
+    # Get or create a session and load its history in a single round-trip
+    session_id, history, summary = await bootstrap_session(session_id)
 
     # Set secure cookie
-    response.set_cookie(
-        key="session_id",
-        value=session_id,
-        max_age=SESSION_EXPIRY,
-        httponly=True,
-        secure=True,
-        samesite="lax"
-    )
+    set_session_cookie(response, session_id)
 
-    # Get chat history 
-    history = get_chat_history(session_id)
+    # Route first so FAQ answers skip admission control, and the decision is reused below
+    decision = intent_router.route(request.message)
+    try:
+        permit = await admission.acquire(admission_kind(decision, request.async_image), session_id)
+    except Overloaded:
+        # Shed responses aren't stored: the message never reached the models
+        return MessageResponse(response=shed_load(decision), session_id=session_id)
+
+    # Process message without blocking the event loop
+    submit_image_job = None
+    if request.async_image:
+        submit_image_job = lambda prompt: image_jobs.submit(session_id, prompt)
 
-    # Process images
-    result = process_message(request.message, history)
+    try:
+        result = await process_message_async(request.message, history, summary, submit_image_job, decision=decision)
+    finally:
+        permit.release()
 
     # Update chat history
-    update_chat_history(session_id, result["history_entry"])
+    await update_chat_history(session_id, result["history_entry"])
+    schedule_history_fold(session_id, history + [result["history_entry"]], summary)
 
     return MessageResponse(
         response=result["response"],
         session_id=session_id
     )
 
-@app.get("/cleanup-sessions")
+@app.post("/send-message/stream")
+async def send_message_stream(
+    request: MessageRequest,
+    session_id: Optional[str] = Cookie(None)
+) -> StreamingResponse:
+
+    """
+    Send message to the chat and stream the response as Server-Sent Events
+
+    Emits "chunk" events with text as it is generated and a final "done"
+    event carrying the same response object as /send-message. History is
+    persisted once the stream completes. A request shed by admission
+    control gets a single "done" event with the busy response.
+    """
+    session_id, history, summary = await bootstrap_session(session_id)
+
+    decision = intent_router.route(request.message)
+    busy_response = None
+    try:
+        permit = await admission.acquire(admission_kind(decision), session_id)
+    except Overloaded:
+        permit, busy_response = None, shed_load(decision)
+
+    async def event_stream():
+        if busy_response is not None:
+            yield format_sse("done", {"response": busy_response, "session_id": session_id})
+            return
+
+        events = stream_message_async(request.message, history, summary, decision=decision)
+        try:
+            async for event in events:
+                if event["event"] == "chunk":
+                    yield format_sse("chunk", {"text": event["text"]})
+                    continue
+
+                await update_chat_history(session_id, event["history_entry"])
+                schedule_history_fold(session_id, history + [event["history_entry"]], summary)
+                yield format_sse("done", {"response": event["response"], "session_id": session_id})
+        finally:
+            # Closes the Gemini stream when the client went away mid-stream
+            await events.aclose()
+
+    # The slot is held until the last chunk has been sent
+    try:
+        streaming_response = PermitStreamingResponse(
+            event_stream(),
+            permit,
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        set_session_cookie(streaming_response, session_id)
+    except BaseException:
+        if permit is not None:
+            permit.release()
+        raise
+    return streaming_response
+
+@app.get("/image-jobs/{job_id}")
+async def get_image_job(job_id: str, session_id: Optional[str] = Cookie(None)) -> Dict[str, Any]:
+    """
+    Poll an image generation job queued by /send-message with async_image
+
+    Returns the job status ("queued", "running", "done" or "failed") and,
+    once finished, the same response object an inline image request returns.
+    """
+    job = await image_jobs.get(job_id)
+    if job is None or job.get("session_id") != session_id:
+        raise HTTPException(status_code=404, detail="Image job not found")
+
+    return {
+        "job_id": job_id,
+        "status": job["status"],
+        "response": job.get("response"),
+    }
+
+@app.get("/images/{image_id}")
+async def get_fallback_image(image_id: str, request: Request) -> Response:
+    """
+    Serve an image kept in the fallback store after its S3 upload failed
+
+    Ids are content hashes, so the id is a strong ETag, If-None-Match is
+    answered without a Redis lookup and the image is cacheable as immutable
+    until the store's TTL runs out.
+    """
+    if not IMAGE_ID_PATTERN.match(image_id):
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    etag = f'"{image_id}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={fallback_images.ttl}, immutable",
+    }
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in [tag.strip().replace("W/", "", 1) for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    image = await fallback_images.get(image_id)
+    if image is None:
+        raise HTTPException(status_code=404, detail="Image not found or expired")
+
+    data, content_type = image
+    return Response(content=data, media_type=content_type, headers=headers)
+
+@app.get("/metrics", dependencies=[Depends(require_admin)])
+async def get_metrics() -> PlainTextResponse:
+    """
+    Prometheus metrics: request, Redis, FAQ, Vertex AI, retry, image and S3 latencies, response cache results and shed requests
+
+    Admin only, since the labels name the GCP projects; scrape it with the
+    admin token as the bearer credentials.
+    """
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.on_event("startup")
+async def start_background_tasks():
+    """Start Q&A refresh and Vertex AI warm-up without blocking requests"""
+    qa_manager.start_refresher()
+    image_jobs.start()
+    start_process_pool()
+
+    if CLIENT_WARMUP:
+        app.state.client_warmup_task = asyncio.create_task(warm_up_clients())
+
+    if VERTEX_WARMUP:
+        app.state.warmup_task = asyncio.create_task(warm_up_models())
+
+    if SESSION_CLEANUP_INTERVAL > 0:
+        app.state.cleanup_task = asyncio.create_task(sweep_expired_sessions())
+
+@app.on_event("shutdown")
+async def close_clients():
+    """Stop background work and release pooled Redis connections on shutdown"""
+    qa_manager.stop_refresher()
+    cleanup_task = getattr(app.state, "cleanup_task", None)
+    if cleanup_task is not None:
+        cleanup_task.cancel()
+    await image_jobs.stop()
+    shutdown_process_pool()
+    await async_redis_client.close()
+    await fallback_images.async_redis_client.close()
+
+@app.get("/cleanup-sessions", dependencies=[Depends(require_admin)])
 async def cleanup_expired_sessions():
     """Admin endpoint to clean up expired sessions"""
-    # This should be protected with authentication 
+    # Only expired entries of the session expiry index are visited, in bounded batches
+    cleaned, deleted_keys = await purge_expired_sessions()
 
-    pattern = "session:*"
-    cursor = 0
-    cleaned = 0
+    return {"status": "success", "cleaned_sessions": cleaned, "deleted_keys": deleted_keys}
 
-    while True:
-        cursor, keys = redis_client.scan(cursor, pattern, 100)
-        for key in keys:
-            session_id = key.split(":")[1]
-            if not redis_client.exists(key):
-                #Delete session history
-                redis_client.delete(f"history:{session_id}")
-                cleaned += 1
-
-        if cursor == 0:
-            break
-
-    return {"status": "success", "cleaned_sessions": cleaned}
+@app.get("/session-memory", dependencies=[Depends(require_admin)])
+async def get_session_memory(sample: int = 100) -> Dict[str, Any]:
+    """Admin endpoint reporting memory used per session and the sessions Redis can hold"""
+    return await session_memory_report(min(max(sample, 1), 1000))
+
+@app.get("/session-memory/{session_id}", dependencies=[Depends(require_admin)])
+async def get_session_memory_usage(session_id: str) -> Dict[str, Any]:
+    """Admin endpoint reporting memory used by one session"""
+    return await session_memory_usage(session_id)
+
+@app.post("/faq/match-batch", dependencies=[Depends(require_admin)])
+async def match_faq_batch(request: FAQBatchRequest) -> Dict[str, Any]:
+    """
+    Admin endpoint scoring many messages against the FAQ in one pass
+
+    Returns answer, score and decision per message plus decision counts,
+    for re-scoring historical traffic with candidate thresholds.
+    """
+    if len(request.messages) > FAQ_BATCH_MAX_MESSAGES:
+        raise HTTPException(status_code=413, detail=f"At most {FAQ_BATCH_MAX_MESSAGES} messages per batch")
+
+    # CPU-bound, so it runs on a worker thread instead of the event loop
+    results = await asyncio.to_thread(
+        qa_manager.match_batch,
+        request.messages,
+        request.good_threshold,
+        request.poor_threshold,
+    )
+    decisions = Counter(result["decision"] or "none" for result in results)
+    logger.info(f"Scored {len(results)} messages against the FAQ: {dict(decisions)}")
+
+    return {"count": len(results), "decisions": dict(decisions), "results": results}
 
 # Run with: uvicorn app:app --reload
 if __name__ == "__main__":
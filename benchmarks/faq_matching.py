@@ -0,0 +1,106 @@
+"""
+FAQ answer rate and match cost, with and without the TF-IDF tier
+
+Matches labelled paraphrases of the FAQ snapshot questions, and messages
+that should not get an FAQ answer, against FAQIndex built with the vector
+tier on and off. The unrelated messages include off-topic ones that share
+an FAQ question's wording ("how can I pay my taxes"), which is where a
+similarity tier goes wrong. Reports how many paraphrases are answered with
+the right question, how many unrelated messages are wrongly answered, and
+the mean cost per match.
+
+Run with: python benchmarks/faq_matching.py --iterations 200
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from typing import List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import faq_index
+from faq_index import FAQIndex
+from router import GOOD_MATCH_THRESHOLD
+
+SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "faq_snapshot.json")
+
+# (message, question it should be answered with, None if it should not get an FAQ answer)
+LABELLED_MESSAGES: List[Tuple[str, Optional[str]]] = [
+    ("i want my money back", "Can I get my money back?"),
+    ("how do i pay", "How can I pay?"),
+    ("cancel order", "Can I cancel my order?"),
+    ("whats the delivery fee", "How much is the delivery fee?"),
+    ("can you deliver to tirana", "Do you deliver to my area?"),
+    ("change address please", "Can I change my delivery address?"),
+    ("track delivery status", "Can I track my delivery?"),
+    ("is my food ready yet", "When will my food be ready?"),
+    ("how long will delivery take", "How long is the delivery time?"),
+    ("my food is late", "When will my food be ready?"),
+    ("tell me a story about mountains", None),
+    ("what is the weather today", None),
+    ("what time do you open", None),
+    ("where are you located", None),
+    ("hello", None),
+    ("i love pizza", None),
+    ("order a burger", None),
+    ("where is paris", None),
+    ("what is the minimum wage", None),
+    ("how can I pay my taxes", None),
+    ("how do I cancel my netflix subscription", None),
+    ("can I track my phone", None),
+    ("how long is the movie", None),
+]
+
+
+def build_index(vectors: bool) -> FAQIndex:
+    with open(SNAPSHOT_PATH, encoding="utf-8") as f:
+        entries = json.load(f)["entries"]
+
+    enabled = faq_index.VECTOR_SEARCH_ENABLED
+    faq_index.VECTOR_SEARCH_ENABLED = vectors
+    try:
+        return FAQIndex([e["question"] for e in entries], [e["answer"] for e in entries])
+    finally:
+        faq_index.VECTOR_SEARCH_ENABLED = enabled
+
+
+def evaluate(index: FAQIndex) -> Tuple[int, int, int, int]:
+    """(paraphrases answered correctly, paraphrases, unrelated messages answered, unrelated messages)"""
+    correct = paraphrases = false_answers = unrelated = 0
+    for message, expected in LABELLED_MESSAGES:
+        question, _, score = index.match(message)
+        answered = score >= GOOD_MATCH_THRESHOLD
+        if expected is None:
+            unrelated += 1
+            false_answers += answered
+        else:
+            paraphrases += 1
+            correct += answered and question == expected
+    return correct, paraphrases, false_answers, unrelated
+
+
+def measure(index: FAQIndex, iterations: int) -> float:
+    """Mean microseconds per match"""
+    messages = [message for message, _ in LABELLED_MESSAGES]
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for message in messages:
+            index.match(message)
+    return (time.perf_counter() - start) / (iterations * len(messages)) * 1e6
+
+
+def run(iterations: int) -> None:
+    print(f"{'index':<10} {'answered':>10} {'false':>8} {'us/match':>10}")
+    for name, vectors in (("fuzzy", False), ("tfidf", True)):
+        index = build_index(vectors)
+        correct, paraphrases, false_answers, unrelated = evaluate(index)
+        print(f"{name:<10} {f'{correct}/{paraphrases}':>10} {f'{false_answers}/{unrelated}':>8} {measure(index, iterations):>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    run(args.iterations)
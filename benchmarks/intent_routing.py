@@ -0,0 +1,97 @@
+"""
+Routing cost per message, before and after the intent router
+
+Compares the original handler chain (marker split, FAQ match, a
+recompiled image regex and a second re.sub for the prompt) against a
+single IntentRouter.route call, over the FAQ snapshot and a mix of FAQ,
+image and free-text messages.
+
+Run with: python benchmarks/intent_routing.py --iterations 2000
+"""
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+from typing import Callable, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from faq_index import FAQIndex
+from router import IntentRouter
+
+# Records are not emitted, so the eager f-string formatting is measured but not handler I/O
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "faq_snapshot.json")
+
+
+def legacy_route(index: FAQIndex, full_prompt: str) -> str:
+    """The routing steps process_message ran before the router, logging included"""
+    marker = "=== CURRENT USER MESSAGE ==="
+    message = full_prompt.strip()
+    if marker in full_prompt:
+        parts = full_prompt.split(marker)
+        if len(parts) > 1:
+            message = parts[1].strip()
+            logger.info(f"Extracted current message: {message}")
+
+    best_match, answer, score = index.match(message)
+    logger.info(f"Best match: '{best_match}' with score: {score}")
+    logger.info(f"Match score: {score}, Good threshold: 85, Poor threshold: 40")
+    if score >= 85:
+        logger.info(f"Good match found, returning answer: {answer}")
+        return "faq"
+    if score >= 40:
+        logger.info("Poor match, returning support contact")
+        return "handover"
+    logger.info("No match found, returning None")
+
+    if re.search(r"(\.image|image:)", message, re.IGNORECASE):
+        re.sub(r"(\.image|image:)", "", message, flags=re.IGNORECASE).strip()
+        return "image"
+    return "text"
+
+
+def sample_messages(index: FAQIndex) -> List[str]:
+    history = "User: hi\nAssistant: Hello! How can I help?\n" * 5
+    messages = list(index.questions[:20])
+    messages += [".image a baboon reading a newspaper", "image: red sneakers on a beach"] * 5
+    messages += ["zzqx wvkp qjjf", "tell me a story about mountains in albania"] * 5
+    return [f"{history}=== CURRENT USER MESSAGE ===\n{message}" for message in messages]
+
+
+def measure(route: Callable[[str], object], messages: List[str], iterations: int) -> float:
+    """Mean microseconds per routed message"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for message in messages:
+            route(message)
+    return (time.perf_counter() - start) / (iterations * len(messages)) * 1e6
+
+
+def run(iterations: int) -> None:
+    with open(SNAPSHOT_PATH, encoding="utf-8") as f:
+        entries = json.load(f)["entries"]
+    index = FAQIndex([e["question"] for e in entries], [e["answer"] for e in entries])
+    router = IntentRouter(lambda: index)
+    messages = sample_messages(index)
+
+    for message in messages:
+        legacy = legacy_route(index, message)
+        routed = router.route(message).route
+        assert legacy == routed, (message, legacy, routed)
+
+    print(f"{'flow':<8} {'us/message':>12}")
+    print(f"{'legacy':<8} {measure(lambda m: legacy_route(index, m), messages, iterations):>12.2f}")
+    print(f"{'router':<8} {measure(router.route, messages, iterations):>12.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=1000)
+    args = parser.parse_args()
+    run(args.iterations)
@@ -0,0 +1,303 @@
+"""
+Load test for app:app with local stand-ins for Vertex AI, S3 and Redis
+
+Drives POST /send-message in-process through httpx's ASGI transport with a
+fixed number of concurrent virtual users, each keeping its own session
+cookie. Vertex AI models, the S3 client and Redis are replaced by local
+fakes (fakeredis for Redis) whose latency and error rate are configurable,
+so the real hot path (routing, retries, SDK rotation, worker pools, WebP
+rendering, session pipelines) is measured without spending quota.
+
+Reports throughput, p50/p95/p99 overall and per message kind, requests
+shed by admission control, and a per-stage breakdown built from the
+Server-Timing spans of every response.
+
+Run with: python benchmarks/load_test.py --users 32 --requests 2000 --mix faq=5,text=4,image=1
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import argparse
+from collections import defaultdict
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakeredis
+import httpx
+from PIL import Image
+
+import app
+import session_store
+import vertex
+
+
+class LatencyModel:
+    """Log-normal latency with a median and spread, plus a failure rate"""
+
+    def __init__(self, median_ms: float, sigma: float = 0.5, error_rate: float = 0.0, error_code: int = 503):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.error_code = error_code
+
+    def wait(self) -> None:
+        """Block the calling (worker) thread like a network call would, then maybe fail"""
+        if self.median_ms > 0:
+            time.sleep(random.lognormvariate(math.log(self.median_ms), self.sigma) / 1000)
+        if self.error_rate and random.random() < self.error_rate:
+            raise FakeServiceError(self.error_code)
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyModel":
+        """Parse 'median_ms[:sigma[:error_rate[:error_code]]]', e.g. '800:0.4:0.02:429'"""
+        parts = spec.split(":")
+        return cls(
+            float(parts[0]),
+            float(parts[1]) if len(parts) > 1 else 0.5,
+            float(parts[2]) if len(parts) > 2 else 0.0,
+            int(parts[3]) if len(parts) > 3 else 503,
+        )
+
+
+class FakeServiceError(Exception):
+    """Error carrying an HTTP status code, classified like a google.api_core error"""
+
+    def __init__(self, code: int):
+        super().__init__(f"fake service error {code}")
+        self.code = code
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeImage:
+    def __init__(self, image_bytes: bytes):
+        self._image_bytes = image_bytes
+
+
+class FakeTextModel:
+    def __init__(self, latency: LatencyModel, reply: str):
+        self.latency = latency
+        self.reply = reply
+
+    def generate_content(self, contents, stream: bool = False):
+        self.latency.wait()
+        if stream:
+            return iter([FakeResponse(word + " ") for word in self.reply.split()])
+        return FakeResponse(self.reply)
+
+
+class FakeImageModel:
+    def __init__(self, latency: LatencyModel, image_bytes: bytes):
+        self.latency = latency
+        self.image_bytes = image_bytes
+
+    def generate_images(self, prompt: str, **params):
+        self.latency.wait()
+        return [FakeImage(self.image_bytes)]
+
+
+class FakeS3Client:
+    def __init__(self, latency: LatencyModel):
+        self.latency = latency
+
+    def put_object(self, **kwargs):
+        self.latency.wait()
+        return {}
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None, Config=None):
+        self.latency.wait()
+
+
+def sample_png(size: int = 1024) -> bytes:
+    """A noisy PNG the size of an Imagen output, so WebP encoding does real work"""
+    img = Image.effect_noise((size, size), 64).convert("RGB")
+    output = BytesIO()
+    img.save(output, format="PNG")
+    return output.getvalue()
+
+
+def install_fakes(text_latency: LatencyModel, image_latency: LatencyModel, s3_latency: LatencyModel) -> None:
+    """Swap Vertex AI models, the S3 client and every Redis client for local fakes"""
+    text_model = FakeTextModel(text_latency, "This is a generated reply from the load test stand-in. " * 4)
+    image_model = FakeImageModel(image_latency, sample_png())
+    vertex.model_pool.get_text_model = lambda config: text_model
+    vertex.model_pool.get_image_model = lambda config: image_model
+    vertex.s3_manager.s3_client = FakeS3Client(s3_latency)
+
+    server = fakeredis.FakeServer()
+    async_client = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    sync_client = fakeredis.FakeRedis(server=server, decode_responses=True)
+
+    session_store.async_redis_client = async_client
+    session_store.redis_client = sync_client
+    session_store._bootstrap_session = async_client.register_script(session_store.BOOTSTRAP_SESSION_SCRIPT)
+    session_store._fold_history = async_client.register_script(session_store.FOLD_HISTORY_SCRIPT)
+    app.async_redis_client = async_client
+    app.image_jobs.redis_client = async_client
+    vertex.async_redis_client = async_client
+    vertex.response_cache.redis_client = async_client
+    vertex.fallback_images.redis_client = fakeredis.FakeRedis(server=server)
+    vertex.fallback_images.async_redis_client = fakeredis.FakeAsyncRedis(server=server)
+    vertex.fallback_images.base_url = "https://loadtest"
+
+
+def build_messages(kind: str, count: int) -> List[str]:
+    """Messages routed to the FAQ, to Gemini text or to Imagen"""
+    if kind == "faq":
+        questions = list(vertex.qa_manager.index.questions)
+        return [questions[i % len(questions)] for i in range(count)]
+    if kind == "image":
+        return [f".image zqxj wvkp {i}" for i in range(count)]
+    return [f"zzqx wvkp qjjf {i}" for i in range(count)]
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        kind, weight = part.split("=")
+        if kind not in ("faq", "text", "image"):
+            raise ValueError(f"Unknown message kind: {kind}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def parse_server_timing(header: Optional[str]) -> List[Tuple[str, float]]:
+    """(span name, milliseconds) pairs from a Server-Timing header"""
+    spans = []
+    for item in (header or "").split(","):
+        name, _, duration = item.strip().partition(";dur=")
+        if name and duration:
+            spans.append((name, float(duration)))
+    return spans
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def virtual_user(plan: List[Tuple[str, str]], results: List[Dict[str, Any]]) -> None:
+    """Send the planned messages one after another on one session"""
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="https://loadtest", timeout=None) as client:
+        for kind, message in plan:
+            start = time.perf_counter()
+            try:
+                response = await client.post("/send-message", json={"message": message})
+                latency_ms = (time.perf_counter() - start) * 1000
+                status = response.status_code
+                spans = parse_server_timing(response.headers.get("server-timing"))
+                shed = status == 429 or (status == 200 and bool(response.json()["response"].get("busy")))
+            except Exception:
+                latency_ms = (time.perf_counter() - start) * 1000
+                status, spans, shed = 0, [], False
+            results.append({
+                "kind": kind,
+                "status": status,
+                "shed": shed,
+                "latency_ms": latency_ms,
+                "spans": spans,
+            })
+
+
+async def run(users: int, requests: int, mix: Dict[str, float], seed: int) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=requests)
+    messages = {kind: iter(build_messages(kind, kinds.count(kind))) for kind in mix}
+    plans: List[List[Tuple[str, str]]] = [[] for _ in range(users)]
+    for i, kind in enumerate(kinds):
+        plans[i % users].append((kind, next(messages[kind])))
+
+    results: List[Dict[str, Any]] = []
+    start = time.perf_counter()
+    await asyncio.gather(*(virtual_user(plan, results) for plan in plans))
+    elapsed = time.perf_counter() - start
+
+    # Let history folds scheduled by the last requests finish before shutting down
+    if app.background_tasks:
+        await asyncio.gather(*app.background_tasks, return_exceptions=True)
+
+    return summarize(results, elapsed)
+
+
+def summarize(results: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    by_kind = defaultdict(list)
+    stages = defaultdict(list)
+    errors = shed = 0
+    for result in results:
+        shed += result["shed"]
+        by_kind["all"].append(result["latency_ms"])
+        by_kind[result["kind"]].append(result["latency_ms"])
+        if result["status"] != 200 and not result["shed"]:
+            errors += 1
+        for name, duration in result["spans"]:
+            stages[name].append(duration)
+
+    return {
+        "requests": len(results),
+        "errors": errors,
+        "shed": shed,
+        "elapsed_s": elapsed,
+        "throughput_rps": len(results) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            kind: {"count": len(samples), "p50": percentile(samples, 50), "p95": percentile(samples, 95), "p99": percentile(samples, 99)}
+            for kind, samples in by_kind.items()
+        },
+        "stages_ms": {
+            name: {"count": len(samples), "mean": sum(samples) / len(samples), "p50": percentile(samples, 50), "p95": percentile(samples, 95)}
+            for name, samples in sorted(stages.items())
+        },
+    }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"{report['requests']} requests, {report['errors']} errors, {report['shed']} shed in {report['elapsed_s']:.2f}s: {report['throughput_rps']:.1f} req/s")
+    print()
+    print(f"{'kind':<8} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for kind, stats in report["latency_ms"].items():
+        print(f"{kind:<8} {stats['count']:>7} {stats['p50']:>9.1f} {stats['p95']:>9.1f} {stats['p99']:>9.1f}")
+    print()
+    print(f"{'stage':<32} {'count':>7} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for name, stats in report["stages_ms"].items():
+        print(f"{name:<32} {stats['count']:>7} {stats['mean']:>9.2f} {stats['p50']:>9.2f} {stats['p95']:>9.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=16, help="concurrent virtual users, one session each")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--mix", default="faq=5,text=4,image=1", help="relative weights of faq, text and image messages")
+    parser.add_argument("--text-latency", default="800:0.4", help="Gemini median_ms[:sigma[:error_rate[:error_code]]]")
+    parser.add_argument("--image-latency", default="4000:0.3", help="Imagen median_ms[:sigma[:error_rate[:error_code]]]")
+    parser.add_argument("--s3-latency", default="40:0.5", help="S3 median_ms[:sigma[:error_rate[:error_code]]]")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the report to this file, for comparing runs")
+    args = parser.parse_args()
+
+    # One log line per request would dominate the run
+    logging.getLogger().setLevel(logging.WARNING)
+
+    install_fakes(
+        LatencyModel.parse(args.text_latency),
+        LatencyModel.parse(args.image_latency),
+        LatencyModel.parse(args.s3_latency),
+    )
+    report = asyncio.run(run(args.users, args.requests, parse_mix(args.mix), args.seed))
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    vertex.vertex_executor.shutdown(wait=False)
+    app.shutdown_process_pool()
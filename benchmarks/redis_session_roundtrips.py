@@ -0,0 +1,129 @@
+"""
+Redis round-trips and latency per /send-message, before and after pipelining
+
+Compares the original session flow (EXISTS + 2x EXPIRE, GET history, then
+GET + SET to append) against session_store.bootstrap_session followed by
+update_chat_history, against the Redis configured through REDIS_HOST /
+REDIS_PORT / REDIS_PASSWORD_FILE.
+
+Run with: python benchmarks/redis_session_roundtrips.py --requests 2000 --history 20
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import redis.asyncio as aioredis
+
+import session_store
+
+
+class RoundTripCounter:
+    """Counts commands and pipelines sent by the async client"""
+
+    def __init__(self, client: aioredis.Redis):
+        self.count = 0
+        self._client = client
+        self._execute_command = client.execute_command
+        self._pipeline_execute = aioredis.client.Pipeline.execute
+
+    def __enter__(self):
+        counter = self
+        execute_command = self._execute_command
+        pipeline_execute = self._pipeline_execute
+
+        async def counted_command(*args, **kwargs):
+            counter.count += 1
+            return await execute_command(*args, **kwargs)
+
+        async def counted_pipeline(pipe, *args, **kwargs):
+            counter.count += 1
+            return await pipeline_execute(pipe, *args, **kwargs)
+
+        self._client.execute_command = counted_command
+        aioredis.client.Pipeline.execute = counted_pipeline
+        return self
+
+    def __exit__(self, *exc):
+        self._client.execute_command = self._execute_command
+        aioredis.client.Pipeline.execute = self._pipeline_execute
+
+
+async def legacy_request(client: aioredis.Redis, session_id: str, entry: Dict[str, Any]) -> None:
+    """The session flow before pipelining, on separate keys"""
+    session = f"bench_legacy_session:{session_id}"
+    history = f"bench_legacy_history:{session_id}"
+
+    if await client.exists(session):
+        await client.expire(session, session_store.SESSION_EXPIRY)
+        await client.expire(history, session_store.SESSION_EXPIRY)
+
+    json.loads(await client.get(history) or "[]")
+
+    entries = json.loads(await client.get(history) or "[]")
+    entries.append(entry)
+    await client.set(history, json.dumps(entries), ex=session_store.SESSION_EXPIRY)
+
+
+async def pipelined_request(session_id: str, entry: Dict[str, Any]) -> None:
+    """The current flow: one script call before generation, one pipeline after"""
+    session_id, _, _ = await session_store.bootstrap_session(session_id)
+    await session_store.update_chat_history(session_id, entry)
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def run(requests: int, history: int) -> None:
+    client = session_store.async_redis_client
+    entry = {"user_message": "How long is the delivery time?", "bot_message": "x" * 400}
+
+    # Seed one session per flow with the requested history length
+    legacy_id = str(uuid.uuid4())
+    await client.set(f"bench_legacy_session:{legacy_id}", "{}", ex=600)
+    await client.set(f"bench_legacy_history:{legacy_id}", json.dumps([entry] * history), ex=600)
+
+    session_id, _, _ = await session_store.bootstrap_session(None)
+    for _ in range(history):
+        await session_store.update_chat_history(session_id, entry)
+
+    results = {}
+    for name, request in (
+        ("legacy", lambda: legacy_request(client, legacy_id, entry)),
+        ("pipelined", lambda: pipelined_request(session_id, entry)),
+    ):
+        latencies = []
+        with RoundTripCounter(client) as counter:
+            for _ in range(requests):
+                start = time.perf_counter()
+                await request()
+                latencies.append((time.perf_counter() - start) * 1000)
+        results[name] = (counter.count / requests, latencies)
+
+    print(f"{'flow':<10} {'round-trips':>12} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, (round_trips, latencies) in results.items():
+        print(f"{name:<10} {round_trips:>12.1f} {percentile(latencies, 50):>8.3f} {percentile(latencies, 99):>8.3f}")
+
+    await client.delete(
+        f"bench_legacy_session:{legacy_id}",
+        f"bench_legacy_history:{legacy_id}",
+        session_store.session_key(session_id),
+        session_store.history_key(session_id),
+        session_store.summary_key(session_id),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=20, help="history entries already in the session")
+    args = parser.parse_args()
+    asyncio.run(run(args.requests, args.history))
@@ -0,0 +1,114 @@
+"""
+Cold-start cost of importing the app, from python -X importtime
+
+Imports a module (app by default) in fresh interpreters and reports the
+median wall time, the packages with the most self import time, and which
+of the SDKs the app defers to first use (vertexai, PIL, boto3, pandas...)
+were loaded anyway. Redis is pinged at import, so run it with Redis
+reachable or expect the connection timeout in the numbers.
+
+Run with: python benchmarks/startup_time.py --runs 5 --top 15
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imported on first use or by the background warm-up, never by `import app`
+DEFERRED_PACKAGES = ("vertexai", "google.cloud.aiplatform", "google.oauth2", "PIL", "boto3", "botocore", "pandas", "openpyxl", "requests", "numpy", "scipy")
+
+_IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def import_once(module: str) -> Tuple[float, List[Tuple[str, int, int, int]]]:
+    """
+    Import module in a fresh interpreter
+
+    Returns:
+        (wall time in seconds, [(module, self us, cumulative us, depth)])
+    """
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+
+    return float(result.stdout.strip().splitlines()[-1]), imports
+
+
+def summarize(module: str, runs: int, top: int) -> Dict[str, Any]:
+    wall_times = []
+    for _ in range(runs):
+        wall_time, imports = import_once(module)
+        wall_times.append(wall_time)
+
+    # Package breakdown from the last run
+    by_package = defaultdict(int)
+    for name, self_us, _, _ in imports:
+        by_package[name.split(".")[0]] += self_us
+
+    loaded = {name for name, _, _, _ in imports}
+    deferred_loaded = sorted(
+        package for package in DEFERRED_PACKAGES
+        if package in loaded or any(name.startswith(f"{package}.") for name in loaded)
+    )
+
+    return {
+        "module": module,
+        "runs": runs,
+        "wall_s": {"median": statistics.median(wall_times), "min": min(wall_times), "max": max(wall_times)},
+        "modules_imported": len(imports),
+        "top_packages_ms": [
+            {"package": package, "self_ms": self_us / 1000}
+            for package, self_us in sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:top]
+        ],
+        "deferred_packages_loaded": deferred_loaded,
+    }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    wall = report["wall_s"]
+    print(f"import {report['module']}: median {wall['median'] * 1000:.0f} ms (min {wall['min'] * 1000:.0f}, max {wall['max'] * 1000:.0f}) over {report['runs']} runs, {report['modules_imported']} modules")
+    print()
+    print(f"{'package':<32} {'self ms':>9}")
+    for item in report["top_packages_ms"]:
+        print(f"{item['package']:<32} {item['self_ms']:>9.1f}")
+    print()
+    if report["deferred_packages_loaded"]:
+        print(f"Deferred packages loaded at import: {', '.join(report['deferred_packages_loaded'])}")
+    else:
+        print("No deferred packages loaded at import")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="packages to list by self import time")
+    parser.add_argument("--json", help="also write the report to this file, for comparing runs")
+    args = parser.parse_args()
+
+    report = summarize(args.module, args.runs, args.top)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
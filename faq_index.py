@@ -0,0 +1,345 @@
+import os
+import re
+import logging
+from array import array
+from collections import Counter, defaultdict
+from io import BytesIO
+from typing import Dict, List, Optional, Sequence, Tuple
+
+try:
+    from rapidfuzz import fuzz as rf_fuzz, process as rf_process
+except ImportError:
+    rf_fuzz = None
+    rf_process = None
+
+if rf_process is None:
+    from fuzzywuzzy import fuzz
+
+# rapidfuzz scores a whole batch against the FAQ in one call when NumPy is installed.
+# Imported by the first batch match, so app startup doesn't pay for it
+np = None
+_numpy_imported = False
+
+from faq_vectors import TfidfIndex
+
+logger = logging.getLogger(__name__)
+
+# FAQs up to this size are scored exhaustively, larger ones go through the n-gram prefilter
+PREFILTER_MIN_SIZE = 256
+
+# Number of prefiltered candidates handed to the fuzzy scorer
+MAX_CANDIDATES = 64
+
+NGRAM_SIZE = 3
+
+# N-grams found in more than this share of questions carry little signal and are skipped
+MAX_NGRAM_DF = 0.2
+
+# TF-IDF retrieval tier, off until it is calibrated against production traffic. A question
+# raises the message's fuzzy score only when both its cosine similarity and its fuzzy ratio
+# clear these minimums. The defaults sit between the paraphrases and the off-topic messages
+# of benchmarks/faq_matching.py: the closest off-topic one ("what is the minimum wage")
+# reaches 0.60, the weakest paraphrase answered ("track delivery status") 0.65
+VECTOR_SEARCH_ENABLED = os.environ.get("FAQ_VECTOR_SEARCH", "false").lower() == "true"
+VECTOR_TOP_K = int(os.environ.get("FAQ_VECTOR_TOP_K", 5))
+VECTOR_MIN_SIMILARITY = float(os.environ.get("FAQ_VECTOR_MIN_SIMILARITY", 0.62))
+VECTOR_MIN_RATIO = int(os.environ.get("FAQ_VECTOR_MIN_RATIO", 60))
+
+# Messages per rapidfuzz cdist call in match_many, bounding the score matrix
+MATCH_BATCH_SIZE = 4096
+
+_NON_ALNUM = re.compile(r"(?ui)\W")
+
+
+def _import_numpy() -> bool:
+    """Import NumPy on first use; True if it is installed"""
+    global np, _numpy_imported
+    if not _numpy_imported:
+        _numpy_imported = True
+        try:
+            import numpy
+        except ImportError:
+            return False
+        np = numpy
+    return np is not None
+
+
+def normalize_question(text: str) -> str:
+    """
+    Normalize text the same way fuzz.token_sort_ratio does before comparing
+
+    Non-ascii characters are dropped, punctuation becomes whitespace, and the
+    lowercased tokens are sorted so a plain ratio on the result equals
+    token_sort_ratio on the originals.
+    """
+    text = str(text).encode("ascii", "ignore").decode("ascii")
+    text = _NON_ALNUM.sub(" ", text).lower().strip()
+    return " ".join(sorted(text.split()))
+
+
+def _ngrams(text: str) -> set:
+    padded = f" {text} "
+    return {padded[i:i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1)}
+
+
+class FAQIndex:
+    """
+    Compiled matcher over the FAQ questions
+
+    Built once per FAQ load: questions are normalized and token-sorted up
+    front, answers are kept in a parallel array and a character n-gram
+    inverted index narrows large FAQs down to a few candidates before the
+    fuzzy scorer runs. A TF-IDF index over the same questions finds
+    paraphrases the character-based ratio scores too low, see _fuse.
+    """
+
+    def __init__(self, questions: Sequence[str], answers: Sequence[str]):
+        if len(questions) != len(answers):
+            raise ValueError("questions and answers must have the same length")
+
+        self.questions: Tuple[str, ...] = tuple(str(q) for q in questions)
+        self.answers: Tuple[str, ...] = tuple(str(a) for a in answers)
+        self.normalized: Tuple[str, ...] = tuple(normalize_question(q) for q in self.questions)
+
+        # First occurrence wins, like the DataFrame lookup it replaces
+        self.answer_by_question: Dict[str, str] = {}
+        for question, answer in zip(self.questions, self.answers):
+            self.answer_by_question.setdefault(question, answer)
+
+        # Messages that normalize to a stored question score 100 without running the scorer
+        self._exact_rows: Dict[str, int] = {}
+        for row, normalized in enumerate(self.normalized):
+            self._exact_rows.setdefault(normalized, row)
+        self._all_rows: List[int] = list(range(len(self.questions)))
+
+        self._postings: Dict[str, array] = {}
+        if len(self.questions) > PREFILTER_MIN_SIZE:
+            postings = defaultdict(lambda: array("I"))
+            for row, normalized in enumerate(self.normalized):
+                for gram in _ngrams(normalized):
+                    postings[gram].append(row)
+            self._postings = dict(postings)
+        self._max_postings = max(1, int(len(self.questions) * MAX_NGRAM_DF))
+
+        self.vectors: Optional[TfidfIndex] = TfidfIndex(self.normalized) if VECTOR_SEARCH_ENABLED else None
+
+    @classmethod
+    def from_dataframe(cls, qa_data) -> "FAQIndex":
+        """Build an index from a DataFrame with 'Question' and 'Answer' columns"""
+        return cls(qa_data["Question"].tolist(), qa_data["Answer"].tolist())
+
+    @classmethod
+    def from_xlsx(cls, data: bytes) -> "FAQIndex":
+        """
+        Build an index from an .xlsx workbook with 'Question' and 'Answer' header cells
+
+        Reads the first sheet with openpyxl directly, so refreshing the FAQ
+        doesn't load pandas. Rows without a question or an answer are skipped.
+        """
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(BytesIO(data), read_only=True, data_only=True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = [str(cell).strip() if cell is not None else "" for cell in next(rows, ())]
+            try:
+                question_col = header.index("Question")
+                answer_col = header.index("Answer")
+            except ValueError:
+                raise ValueError(f"Expected 'Question' and 'Answer' columns, found {header}")
+
+            questions, answers = [], []
+            for row in rows:
+                question = row[question_col] if question_col < len(row) else None
+                answer = row[answer_col] if answer_col < len(row) else None
+                if question is None or answer is None:
+                    continue
+                questions.append(str(question))
+                answers.append(str(answer))
+        finally:
+            workbook.close()
+
+        return cls(questions, answers)
+
+    def __len__(self) -> int:
+        return len(self.questions)
+
+    def _candidates(self, normalized_message: str) -> List[int]:
+        """Rows worth scoring for a normalized message"""
+        if len(self.questions) <= PREFILTER_MIN_SIZE:
+            return self._all_rows
+
+        postings = [self._postings[gram] for gram in _ngrams(normalized_message) if gram in self._postings]
+        selective = [rows for rows in postings if len(rows) <= self._max_postings]
+
+        overlap = Counter()
+        for rows in selective or postings:
+            overlap.update(rows)
+
+        return [row for row, _ in overlap.most_common(MAX_CANDIDATES)]
+
+    def _score(self, normalized_message: str, rows: List[int]) -> Tuple[Optional[int], int]:
+        """Return (best row, score) among the given rows"""
+        if not rows:
+            return None, 0
+
+        if rows is self._all_rows:
+            choices = self.normalized
+        else:
+            choices = [self.normalized[row] for row in rows]
+
+        if rf_process is not None:
+            match = rf_process.extractOne(normalized_message, choices, scorer=rf_fuzz.ratio, processor=None)
+            if match is None:
+                return None, 0
+            _, score, position = match
+            return rows[position], int(round(score))
+
+        best_row, best_score = None, -1
+        for row, choice in zip(rows, choices):
+            score = fuzz.ratio(normalized_message, choice)
+            if score > best_score:
+                best_row, best_score = row, score
+        return best_row, best_score
+
+    def _ratio(self, normalized_message: str, choice: str) -> float:
+        if rf_fuzz is not None:
+            return rf_fuzz.ratio(normalized_message, choice)
+        return fuzz.ratio(normalized_message, choice)
+
+    def _fuse(
+        self,
+        normalized_message: str,
+        row: Optional[int],
+        score: int,
+        neighbours: List[Tuple[int, float]],
+    ) -> Tuple[Optional[int], int]:
+        """
+        Raise the fuzzy match with the TF-IDF nearest questions
+
+        A neighbour counts only if both signals are high: cosine similarity
+        at least VECTOR_MIN_SIMILARITY and fuzzy ratio at least
+        VECTOR_MIN_RATIO, so a message sharing just the wording of a
+        question ("how can I pay my taxes") or just one topic word can't
+        borrow its score. The two then count as agreeing evidence, scoring
+        100 - (100 - ratio) * (1 - cosine): a paraphrase that clears both
+        gates reaches the answer threshold, where the ratio alone falls short.
+        The best of these, ties going to the higher ratio, replaces the
+        plain fuzzy match if it scores higher.
+
+        Args:
+            neighbours: (row, cosine similarity) pairs from the TF-IDF search, best first
+        """
+        best_row, best_score, best_ratio = None, -1, -1.0
+        for hit_row, similarity in neighbours:
+            if similarity < VECTOR_MIN_SIMILARITY:
+                break
+            ratio = self._ratio(normalized_message, self.normalized[hit_row])
+            if ratio < VECTOR_MIN_RATIO:
+                continue
+            fused = int(round(100 - (100 - ratio) * (1 - min(similarity, 1.0))))
+            if (fused, ratio) > (best_score, best_ratio):
+                best_row, best_score, best_ratio = hit_row, fused, ratio
+        if best_score > score:
+            return best_row, best_score
+        return row, score
+
+    def match(self, message: str) -> Tuple[Optional[str], Optional[str], int]:
+        """
+        Find the best matching FAQ entry for a message
+
+        Args:
+            message: Raw user message
+
+        Returns:
+            Tuple of (matched question, answer, score): the token sort ratio,
+            raised by TF-IDF similarity when the vector tier is enabled
+        """
+        normalized_message = normalize_question(message)
+        if not normalized_message:
+            return None, None, 0
+
+        row = self._exact_rows.get(normalized_message)
+        if row is not None:
+            return self.questions[row], self.answers[row], 100
+
+        row, score = self._score(normalized_message, self._candidates(normalized_message))
+        if self.vectors is not None:
+            row, score = self._fuse(normalized_message, row, score, self.vectors.search(normalized_message, VECTOR_TOP_K))
+        if row is None:
+            return None, None, 0
+
+        return self.questions[row], self.answers[row], score
+
+    def _score_many(self, normalized_messages: List[str]) -> List[Tuple[Optional[int], int]]:
+        """_score for each message, against its candidates"""
+        if not self.questions:
+            return [(None, 0)] * len(normalized_messages)
+
+        if rf_process is None or len(self.questions) > PREFILTER_MIN_SIZE or not _import_numpy():
+            return [self._score(message, self._candidates(message)) for message in normalized_messages]
+
+        # Small FAQs are scored exhaustively anyway: one cdist call per batch scores every
+        # message against every question, and argmax keeps the first best like extractOne
+        results = []
+        for start in range(0, len(normalized_messages), MATCH_BATCH_SIZE):
+            scores = rf_process.cdist(
+                normalized_messages[start:start + MATCH_BATCH_SIZE],
+                self.normalized,
+                scorer=rf_fuzz.ratio,
+                processor=None,
+                dtype=np.float64,
+                workers=-1,
+            )
+            best_rows = scores.argmax(axis=1)
+            results.extend(
+                (int(row), int(round(scores[i, row]))) for i, row in enumerate(best_rows)
+            )
+        return results
+
+    def match_many(self, messages: Sequence[str]) -> List[Tuple[Optional[str], Optional[str], int]]:
+        """
+        Run match for many messages in one pass
+
+        Messages are normalized and deduplicated first, exact matches are
+        looked up, and the rest are scored together: one rapidfuzz cdist
+        call per batch and one sparse product per batch for the TF-IDF tier
+        when NumPy and SciPy are installed. Scores equal what match returns
+        for each message.
+
+        Args:
+            messages: Raw user messages
+
+        Returns:
+            (matched question, answer, score) per message, in order
+        """
+        normalized_messages = [normalize_question(message) for message in messages]
+
+        best: Dict[str, Tuple[Optional[int], int]] = {}
+        pending = []
+        for normalized_message in dict.fromkeys(normalized_messages):
+            if not normalized_message:
+                continue
+            row = self._exact_rows.get(normalized_message)
+            if row is not None:
+                best[normalized_message] = (row, 100)
+            else:
+                pending.append(normalized_message)
+
+        scored = self._score_many(pending)
+        if self.vectors is not None:
+            neighbours = self.vectors.search_many(pending, VECTOR_TOP_K)
+            scored = [
+                self._fuse(normalized_message, row, score, hits)
+                for normalized_message, (row, score), hits in zip(pending, scored, neighbours)
+            ]
+        best.update(zip(pending, scored))
+
+        results = []
+        for normalized_message in normalized_messages:
+            row, score = best.get(normalized_message, (None, 0))
+            if row is None:
+                results.append((None, None, 0))
+            else:
+                results.append((self.questions[row], self.answers[row], score))
+        return results
@@ -0,0 +1,226 @@
+import math
+import heapq
+import logging
+from collections import Counter, defaultdict
+from typing import Dict, List, Sequence, Tuple
+
+# NumPy and scipy.sparse, imported when the first index is built: SciPy alone costs more
+# than the rest of app startup, and the TF-IDF tier is off by default
+np = None
+sparse = None
+_sparse_imported = False
+
+logger = logging.getLogger(__name__)
+
+# Character n-grams inside each word, so inflections and typos still share features
+CHAR_NGRAM_SIZE = 3
+
+# Function words and question words carry no topic: "where is paris" must not look like
+# "where is my order?". They are left out of documents and queries alike
+STOP_WORDS = frozenset(
+    "a about am an and any are as at be been but by can could did do does for from had has have "
+    "how i if in is it its me my of on or our please should so that the there this to was we "
+    "were what whats when where which who why will with would you your".split()
+)
+
+# Below this many documents SciPy's per-call overhead outweighs the faster product,
+# and the pure Python inverted index is used even when SciPy is installed
+SPARSE_MIN_SIZE = 1024
+
+# Queries per sparse product in search_many, bounding the dense score block
+SEARCH_BATCH_SIZE = 2048
+
+
+def _import_sparse() -> bool:
+    """Import NumPy and scipy.sparse on first use; True if both are installed"""
+    global np, sparse, _sparse_imported
+    if not _sparse_imported:
+        _sparse_imported = True
+        try:
+            import numpy
+            from scipy import sparse as scipy_sparse
+        except ImportError:
+            return False
+        np, sparse = numpy, scipy_sparse
+    return sparse is not None
+
+
+def _sparse_rows(rows: Sequence[Dict[int, float]], width: int):
+    """CSR matrix with one row per {column: weight} dict"""
+    data, indices, indptr = [], [], [0]
+    for weights in rows:
+        indices.extend(weights.keys())
+        data.extend(weights.values())
+        indptr.append(len(indices))
+    return sparse.csr_matrix(
+        (np.asarray(data, dtype=np.float64), np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int32)),
+        shape=(len(rows), width),
+    )
+
+
+def _top_k(scores, k: int) -> List[Tuple[int, float]]:
+    """Up to k (row, score) pairs with a positive score, best first, ties by row"""
+    if k < len(scores):
+        top = np.argpartition(-scores, k)[:k]
+    else:
+        top = np.arange(len(scores))
+    top = top[np.lexsort((top, -scores[top]))]
+    return [(int(row), float(scores[row])) for row in top if scores[row] > 0]
+
+
+def _word_features(word: str) -> List[str]:
+    """The word itself and its character n-grams, padded with spaces at both ends"""
+    padded = f" {word} "
+    return [f"w:{word}"] + [f"c:{padded[i:i + CHAR_NGRAM_SIZE]}" for i in range(len(padded) - CHAR_NGRAM_SIZE + 1)]
+
+
+def _features(text: str) -> Counter:
+    """Word and in-word character n-gram counts of normalized (lowercase, space separated) text, stop words left out"""
+    features = Counter()
+    for word in text.split():
+        if word not in STOP_WORDS:
+            features.update(_word_features(word))
+    return features
+
+
+class TfidfIndex:
+    """
+    Sparse TF-IDF vectors over a fixed set of documents, searched by cosine similarity
+
+    Documents are weighted with sublinear term frequency and smoothed IDF
+    and L2-normalized once at build time, so a search is one sparse
+    vector-matrix product. With NumPy and SciPy installed, for
+    SPARSE_MIN_SIZE documents or more, the weights are a feature-major CSR
+    matrix, so a query only touches the rows of its own features; otherwise
+    an inverted index gives the same scores in pure Python. search_many
+    scores many queries with one sparse matrix product whenever SciPy is
+    installed.
+    """
+
+    def __init__(self, documents: Sequence[str]):
+        self.size = len(documents)
+        counts = [_features(document) for document in documents]
+
+        document_frequency = Counter()
+        for features in counts:
+            document_frequency.update(features.keys())
+
+        self.vocabulary: Dict[str, int] = {feature: column for column, feature in enumerate(sorted(document_frequency))}
+        self.idf: List[float] = [0.0] * len(self.vocabulary)
+        for feature, column in self.vocabulary.items():
+            self.idf[column] = math.log((1 + self.size) / (1 + document_frequency[feature])) + 1
+        # Weight of query features no document has: they match nothing but still count
+        # towards the query's norm, so "pay my taxes" is only partly similar to "pay"
+        self.unseen_idf = math.log(1 + self.size) + 1
+
+        # Columns of every word in the documents, so queries only build n-grams for unseen words
+        self._word_columns: Dict[str, List[int]] = {}
+        for document in documents:
+            for word in document.split():
+                if word not in self._word_columns and word not in STOP_WORDS:
+                    self._word_columns[word] = [self.vocabulary[feature] for feature in _word_features(word)]
+
+        self._rows = [self._weights(*self._columns(document)) for document in documents]
+
+        # _matrix is set when search uses the sparse product, _batch_matrix caches it for search_many
+        self._matrix = None
+        self._batch_matrix = None
+        self._postings: Dict[int, List[Tuple[int, float]]] = {}
+        if _import_sparse() and self.size >= SPARSE_MIN_SIZE:
+            self._matrix = self._features_matrix()
+        else:
+            postings = defaultdict(list)
+            for row, weights in enumerate(self._rows):
+                for column, weight in weights.items():
+                    postings[column].append((row, weight))
+            self._postings = dict(postings)
+
+    def _features_matrix(self):
+        """Document weights as a features x documents CSR matrix, built once"""
+        if self._batch_matrix is None:
+            self._batch_matrix = _sparse_rows(self._rows, len(self.vocabulary)).T.tocsr()
+        return self._batch_matrix
+
+    def _columns(self, text: str) -> Tuple[Counter, Counter]:
+        """Counts of the vocabulary columns in a normalized text, and of its features outside the vocabulary"""
+        columns = Counter()
+        unseen = Counter()
+        for word in text.split():
+            if word in STOP_WORDS:
+                continue
+            word_columns = self._word_columns.get(word)
+            if word_columns is None:
+                word_columns = []
+                for feature in _word_features(word):
+                    column = self.vocabulary.get(feature)
+                    if column is None:
+                        unseen[feature] += 1
+                    else:
+                        word_columns.append(column)
+            columns.update(word_columns)
+        return columns, unseen
+
+    def _weights(self, columns: Counter, unseen: Counter) -> Dict[int, float]:
+        """TF-IDF weights by column, L2-normalized together with the weights of the unseen features"""
+        idf = self.idf
+        weights = {
+            column: idf[column] if count == 1 else (1 + math.log(count)) * idf[column]
+            for column, count in columns.items()
+        }
+
+        norm_squared = sum(weight * weight for weight in weights.values())
+        for count in unseen.values():
+            norm_squared += ((1 + math.log(count)) * self.unseen_idf) ** 2
+        if not weights or norm_squared == 0:
+            return {}
+        norm = math.sqrt(norm_squared)
+        return {column: weight / norm for column, weight in weights.items()}
+
+    def search(self, text: str, k: int = 5) -> List[Tuple[int, float]]:
+        """
+        Documents most similar to a normalized text
+
+        Args:
+            text: Text normalized like the documents
+            k: Maximum number of results
+
+        Returns:
+            Up to k (row, cosine similarity) pairs with a positive similarity, best first
+        """
+        query = self._weights(*self._columns(text))
+        if not query or self.size == 0:
+            return []
+
+        if self._matrix is not None:
+            scores = (_sparse_rows([query], len(self.vocabulary)) @ self._matrix).toarray().ravel()
+            return _top_k(scores, k)
+
+        scores = defaultdict(float)
+        for column, weight in query.items():
+            for row, document_weight in self._postings.get(column, ()):
+                scores[row] += weight * document_weight
+        return heapq.nlargest(k, scores.items(), key=lambda item: (item[1], -item[0]))
+
+    def search_many(self, texts: Sequence[str], k: int = 5) -> List[List[Tuple[int, float]]]:
+        """
+        Run search for each of many normalized texts
+
+        With SciPy installed the queries are scored SEARCH_BATCH_SIZE at a
+        time with one sparse matrix product each, whatever the index size.
+
+        Returns:
+            One result list per text, as search returns them
+        """
+        if sparse is None or self.size == 0:
+            return [self.search(text, k) for text in texts]
+
+        matrix = self._features_matrix()
+        results = []
+        for start in range(0, len(texts), SEARCH_BATCH_SIZE):
+            queries = [self._weights(*self._columns(text)) for text in texts[start:start + SEARCH_BATCH_SIZE]]
+            scores = (_sparse_rows(queries, len(self.vocabulary)) @ matrix).toarray()
+            results.extend(_top_k(row_scores, k) for row_scores in scores)
+        return results
+
+    def __len__(self) -> int:
+        return self.size
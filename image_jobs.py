@@ -0,0 +1,143 @@
+import json
+import time
+import uuid
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class ImageJobQueue:
+    """
+    Background image generation with results kept in Redis
+
+    Requests enqueue a job and return its id straight away; a fixed pool of
+    worker tasks runs generation, compression and upload and stores the
+    response under image_job:{id}, so any replica can answer a poll. The
+    queue itself is in-process: jobs still queued or running when the
+    workers stop are marked failed rather than left "queued" until they
+    expire.
+    """
+
+    def __init__(
+        self,
+        redis_client,
+        generate: Callable[[str], Awaitable[Dict[str, Any]]],
+        workers: int = 4,
+        max_queued: int = 100,
+        ttl: int = 3600,
+    ):
+        self.redis_client = redis_client
+        self.generate = generate
+        self.workers = workers
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        # Ids of the jobs the workers are running
+        self._running: Set[str] = set()
+
+    @staticmethod
+    def job_key(job_id: str) -> str:
+        return f"image_job:{job_id}"
+
+    def start(self) -> None:
+        """Start the worker tasks on the running event loop"""
+        if self._tasks:
+            return
+        # Created here so the queue belongs to the server's event loop
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Started {self.workers} image job workers")
+
+    async def stop(self) -> None:
+        """Cancel the worker tasks and mark the jobs they won't finish as failed"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        unfinished = list(self._running)
+        self._running.clear()
+        while self._queue is not None and not self._queue.empty():
+            job_id, _ = self._queue.get_nowait()
+            unfinished.append(job_id)
+
+        for job_id in unfinished:
+            try:
+                await self._finish(job_id, "failed", None)
+            except Exception as e:
+                logger.error(f"Failed to record image job {job_id} failure on shutdown: {e}")
+        if unfinished:
+            logger.info(f"Marked {len(unfinished)} unfinished image jobs failed")
+
+    def full(self) -> bool:
+        """True if submit would be refused"""
+        return self._queue is None or self._queue.full()
+
+    async def submit(self, session_id: str, prompt: str) -> str:
+        """
+        Queue an image generation job
+
+        Raises:
+            asyncio.QueueFull: If the workers aren't running or max_queued jobs are already waiting
+        """
+        if self.full():
+            raise asyncio.QueueFull()
+
+        job_id = str(uuid.uuid4())
+        key = self.job_key(job_id)
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={
+                "status": "queued",
+                "session_id": session_id,
+                "created_at": time.time(),
+            })
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+        self._queue.put_nowait((job_id, prompt))
+        return job_id
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Return the stored job, with its response decoded, or None"""
+        job = await self.redis_client.hgetall(self.job_key(job_id))
+        if not job:
+            return None
+        if "response" in job:
+            job["response"] = json.loads(job["response"])
+        return job
+
+    async def _finish(self, job_id: str, status: str, response: Optional[Dict[str, Any]]) -> None:
+        fields = {"status": status, "finished_at": time.time()}
+        if response is not None:
+            fields["response"] = json.dumps(response)
+
+        key = self.job_key(job_id)
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping=fields)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def _worker(self, worker_id: int) -> None:
+        while True:
+            job_id, prompt = await self._queue.get()
+            self._running.add(job_id)
+            try:
+                await self.redis_client.hset(self.job_key(job_id), "status", "running")
+                response = await self.generate(prompt)
+                status = "done" if response.get("url") or response.get("base64") else "failed"
+                await self._finish(job_id, status, response)
+            except asyncio.CancelledError:
+                # Left in _running for stop() to mark failed
+                raise
+            except Exception as e:
+                logger.error(f"Image job {job_id} failed on worker {worker_id}: {e}")
+                try:
+                    await self._finish(job_id, "failed", None)
+                except Exception as store_error:
+                    logger.error(f"Failed to record image job {job_id} failure: {store_error}")
+            finally:
+                self._queue.task_done()
+            self._running.discard(job_id)
@@ -0,0 +1,117 @@
+import os
+import logging
+import threading
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+# PIL is imported where images are decoded, so importing this module stays cheap
+if TYPE_CHECKING:
+    from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Variants produced for every generated image: name -> (max dimension, WebP quality)
+IMAGE_VARIANTS: Dict[str, Tuple[int, int]] = {
+    "primary": (800, 85),
+    "fallback": (600, 70),
+    "thumbnail": (int(os.environ.get("IMAGE_THUMBNAIL_SIZE", 256)), 70),
+}
+
+IMAGE_PROCESS_WORKERS = int(os.environ.get("IMAGE_PROCESS_WORKERS", os.cpu_count() or 1))
+
+# Workers are never forked from the server process: by the time the pool starts it runs
+# gRPC and boto threads, and a fork can copy their locks held
+IMAGE_PROCESS_START_METHOD = os.environ.get(
+    "IMAGE_PROCESS_START_METHOD",
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn",
+)
+
+WEBP_MIMETYPE = "image/webp"
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+_process_pool_lock = threading.Lock()
+
+
+def fit_within(img: "Image.Image", max_size: int) -> "Image.Image":
+    """Downscale an image so its longest side is at most max_size, keeping aspect ratio"""
+    if max(img.width, img.height) <= max_size:
+        return img
+
+    from PIL import Image
+
+    if img.width > img.height:
+        new_width = max_size
+        new_height = int(img.height * (max_size / img.width))
+    else:
+        new_height = max_size
+        new_width = int(img.width * (max_size / img.height))
+
+    return img.resize((new_width, new_height), Image.LANCZOS)
+
+
+def encode_webp(img: "Image.Image", quality: int) -> bytes:
+    output = BytesIO()
+    img.save(output, format="WEBP", quality=quality)
+    return output.getvalue()
+
+
+def render_variants(image_data: bytes, variants: Dict[str, Tuple[int, int]]) -> Dict[str, bytes]:
+    """
+    Decode an image once and encode every requested WebP variant
+
+    Variants are rendered largest first and each resize starts from the
+    previous (smaller) result rather than the full-size original.
+
+    Args:
+        image_data: Raw image bytes
+        variants: name -> (max dimension, WebP quality)
+
+    Returns:
+        name -> WebP bytes
+    """
+    from PIL import Image
+
+    img = Image.open(BytesIO(image_data))
+    img.load()
+
+    rendered = {}
+    for name, (max_size, quality) in sorted(variants.items(), key=lambda item: item[1][0], reverse=True):
+        img = fit_within(img, max_size)
+        rendered[name] = encode_webp(img, quality)
+
+    return rendered
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Process pool for CPU-bound image work, created by start_process_pool or on first use"""
+    global _process_pool
+    if _process_pool is None:
+        with _process_pool_lock:
+            if _process_pool is None:
+                _process_pool = ProcessPoolExecutor(
+                    max_workers=IMAGE_PROCESS_WORKERS,
+                    mp_context=multiprocessing.get_context(IMAGE_PROCESS_START_METHOD),
+                )
+                logger.info(f"Started image process pool with {IMAGE_PROCESS_WORKERS} {IMAGE_PROCESS_START_METHOD} workers")
+    return _process_pool
+
+
+def start_process_pool() -> None:
+    """Create the pool and its worker processes at startup, before the first image needs them"""
+    # Workers are spawned on the first submit
+    get_process_pool().submit(os.getpid)
+
+
+def render_variants_in_pool(image_data: bytes, variants: Dict[str, Tuple[int, int]] = IMAGE_VARIANTS) -> Dict[str, bytes]:
+    """Run render_variants in the process pool, blocking the calling thread until done"""
+    return get_process_pool().submit(render_variants, image_data, variants).result()
+
+
+def shutdown_process_pool() -> None:
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False)
+            _process_pool = None
@@ -0,0 +1,70 @@
+import re
+import hashlib
+import logging
+from typing import Optional, Tuple
+
+from metrics import REDIS_LATENCY, span
+
+logger = logging.getLogger(__name__)
+
+# Ids are the first 32 hex digits of the image's SHA-256
+IMAGE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+class FallbackImageStore:
+    """
+    Short-lived image bytes in Redis, served by /images/{image_id}
+
+    Images whose S3 upload failed are kept here for ttl seconds instead of
+    being inlined in the response as base64 data URLs. Ids are content
+    hashes, so an id's bytes never change and the id doubles as the ETag.
+    The store is only enabled with a base_url: the Android client loads
+    images with Glide, which can't resolve a relative URL. Both clients
+    must be created with decode_responses=False.
+    """
+
+    def __init__(self, redis_client, async_redis_client, ttl: int = 900, base_url: str = "", prefix: str = "fallback_image:"):
+        self.redis_client = redis_client
+        self.async_redis_client = async_redis_client
+        self.ttl = ttl
+        self.base_url = base_url.rstrip("/")
+        self.prefix = prefix
+
+    @staticmethod
+    def image_id(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()[:32]
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.base_url)
+
+    def url(self, image_id: str) -> str:
+        """Absolute URL clients load the image from"""
+        return f"{self.base_url}/images/{image_id}"
+
+    def put(self, data: bytes, content_type: str) -> str:
+        """
+        Store an image from a worker thread
+
+        Returns:
+            The image id
+        """
+        image_id = self.image_id(data)
+        key = f"{self.prefix}{image_id}"
+        with span("redis.fallback_image_put", REDIS_LATENCY.labels("fallback_image_put")):
+            pipe = self.redis_client.pipeline()
+            pipe.hset(key, mapping={"data": data, "content_type": content_type})
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+        return image_id
+
+    async def get(self, image_id: str) -> Optional[Tuple[bytes, str]]:
+        """(bytes, content type) of a stored image, or None if it expired or never existed"""
+        if not IMAGE_ID_PATTERN.match(image_id):
+            return None
+
+        with span("redis.fallback_image_get", REDIS_LATENCY.labels("fallback_image_get")):
+            data, content_type = await self.async_redis_client.hmget(f"{self.prefix}{image_id}", "data", "content_type")
+        if data is None:
+            return None
+        return data, content_type.decode("utf-8") if content_type else "application/octet-stream"
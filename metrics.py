@@ -0,0 +1,165 @@
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+# Latency buckets in seconds, from sub-millisecond Redis calls up to slow Imagen generations
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+
+# Request-level tracing: a Trace per request collects the spans timed while serving it.
+# Worker threads see the trace as long as the work is submitted with contextvars.copy_context().
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """Spans recorded while serving one request"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.start = time.perf_counter()
+        self.spans: List[Tuple[str, float, float]] = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, start: float, duration: float) -> None:
+        """Record a span by its absolute perf_counter start and duration in seconds"""
+        with self._lock:
+            self.spans.append((name, start - self.start, duration))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def server_timing(self) -> str:
+        """Spans as a Server-Timing header value, durations in milliseconds"""
+        with self._lock:
+            spans = list(self.spans)
+        return ", ".join(f"{name.replace('.', '-')};dur={duration * 1000:.1f}" for name, _, duration in spans)
+
+
+def start_trace(name: str) -> Trace:
+    """Start a trace for the current request context"""
+    trace = Trace(name)
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+STAGE_LATENCY = Histogram(
+    "baboon_stage_duration_seconds",
+    "Time spent in each request stage",
+    ["stage"],
+    buckets=DEFAULT_BUCKETS,
+)
+
+
+def record_span(name: str, start: float, histogram=None) -> float:
+    """
+    Record a span that started at start (a perf_counter value) and ends now
+
+    For blocks whose labels are only known once they finish; returns the
+    duration in seconds.
+
+    Args:
+        name: Span name, shown in traces and Server-Timing
+        start: perf_counter value at the start of the span
+        histogram: Histogram (or labelled child) to observe the duration on,
+            baboon_stage_duration_seconds{stage=name} by default
+    """
+    duration = time.perf_counter() - start
+    (histogram if histogram is not None else STAGE_LATENCY.labels(name)).observe(duration)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, start, duration)
+    return duration
+
+
+@contextmanager
+def span(name: str, histogram=None):
+    """Time a block as a span of the current trace, see record_span"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, start, histogram)
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format"""
+    return generate_latest().decode("utf-8")
+
+
+REQUEST_LATENCY = Histogram(
+    "baboon_http_request_duration_seconds",
+    "HTTP request latency by route and status",
+    ["method", "route", "status"],
+    buckets=DEFAULT_BUCKETS,
+)
+REDIS_LATENCY = Histogram(
+    "baboon_redis_operation_duration_seconds",
+    "Latency of Redis operations, including pipelines and scripts",
+    ["operation"],
+    buckets=DEFAULT_BUCKETS,
+)
+FAQ_MATCH_LATENCY = Histogram(
+    "baboon_faq_match_duration_seconds",
+    "Time to match a message against the FAQ index",
+    buckets=DEFAULT_BUCKETS,
+)
+MESSAGES_ROUTED = Counter(
+    "baboon_messages_routed_total",
+    "Messages by routing decision",
+    ["route"],
+)
+VERTEX_LATENCY = Histogram(
+    "baboon_vertex_request_duration_seconds",
+    "Vertex AI call latency per project and outcome",
+    ["project", "operation", "outcome"],
+    buckets=DEFAULT_BUCKETS,
+)
+RESPONSE_CACHE = Counter(
+    "baboon_response_cache_total",
+    "Response cache lookups and stores by result (local_hit, redis_hit, miss, store, skipped, error)",
+    ["result"],
+)
+RETRIES = Counter(
+    "baboon_retries_total",
+    "Retries made by the backoff helpers",
+    ["operation"],
+)
+IMAGE_PROCESSING_LATENCY = Histogram(
+    "baboon_image_processing_duration_seconds",
+    "Time to decode and encode every WebP variant of a generated image",
+    buckets=DEFAULT_BUCKETS,
+)
+S3_UPLOAD_LATENCY = Histogram(
+    "baboon_s3_upload_duration_seconds",
+    "S3 upload latency by outcome",
+    ["outcome"],
+    buckets=DEFAULT_BUCKETS,
+)
+COALESCED_CALLS = Counter(
+    "baboon_coalesced_calls_total",
+    "Calls answered by an identical call already in flight, in this process or on another replica",
+    ["operation", "scope"],
+)
+ADMISSION_WAIT = Histogram(
+    "baboon_admission_wait_seconds",
+    "Time requests waited in the admission queue for a text or image slot",
+    ["kind"],
+    buckets=DEFAULT_BUCKETS,
+)
+ADMISSION_REJECTED = Counter(
+    "baboon_admission_rejected_total",
+    "Requests shed by admission control, by kind and reason (queue_full, timeout, session)",
+    ["kind", "reason"],
+)
@@ -0,0 +1,66 @@
+import os
+from typing import List, Dict, Any, Optional, Tuple
+
+# Token budget for replayed history (summary included) in a single prompt
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 4000))
+
+# After folding, the remaining verbatim turns fit in this share of the budget,
+# so a fold isn't needed again on the very next message
+FOLD_TARGET_RATIO = float(os.environ.get("CONTEXT_FOLD_TARGET_RATIO", 0.5))
+
+# Gemini averages roughly four characters per token for English text
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Cheap token estimate for budgeting, without a round-trip to count_tokens"""
+    if not text:
+        return 0
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def entry_tokens(entry: Dict[str, Any]) -> int:
+    """Estimated tokens of one history entry as replayed to the model"""
+    return estimate_tokens(entry.get("user_message")) + estimate_tokens(entry.get("bot_message"))
+
+
+def fit_history(history: List[Dict[str, Any]], summary: Optional[str] = None, budget: int = CONTEXT_TOKEN_BUDGET) -> List[Dict[str, Any]]:
+    """
+    Keep the most recent history entries that fit in the token budget
+
+    Args:
+        history: History entries, oldest first
+        summary: Rolling summary of older turns, counted against the budget
+        budget: Token budget for summary plus replayed turns
+
+    Returns:
+        The newest entries whose estimated size fits, oldest first
+    """
+    remaining = budget - estimate_tokens(summary)
+    kept = 0
+    for entry in reversed(history):
+        remaining -= entry_tokens(entry)
+        if remaining < 0:
+            break
+        kept += 1
+    return history[len(history) - kept:] if kept else []
+
+
+def needs_fold(history: List[Dict[str, Any]], summary: Optional[str] = None, max_turns: Optional[int] = None, budget: int = CONTEXT_TOKEN_BUDGET) -> bool:
+    """Whether older turns should be folded into the rolling summary"""
+    if max_turns is not None and len(history) >= max_turns:
+        return True
+    return len(fit_history(history, summary, budget)) < len(history)
+
+
+def split_for_fold(history: List[Dict[str, Any]], budget: int = CONTEXT_TOKEN_BUDGET, max_turns: Optional[int] = None) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Split history into (turns to fold into the summary, turns to keep verbatim)
+
+    The kept turns fit in FOLD_TARGET_RATIO of the budget and, if given,
+    half of max_turns.
+    """
+    keep = fit_history(history, None, int(budget * FOLD_TARGET_RATIO))
+    if max_turns is not None:
+        keep = keep[len(keep) - min(len(keep), max_turns // 2):]
+    return history[:len(history) - len(keep)], keep
@@ -1,3 +1,4 @@
+import json
 import pandas as pd
 
 # Create the Q&A data
@@ -70,4 +71,17 @@ qa_data = {
 
 # Create DataFrame and save to Excel
 df = pd.DataFrame(qa_data)
-df.to_excel('questions_and_answers.xlsx', index=False)
\ No newline at end of file
+df.to_excel('questions_and_answers.xlsx', index=False)
+
+# Save the compiled snapshot loaded by BaboonQAManager at startup
+snapshot = {
+    "source": "questions_and_answers.xlsx",
+    "etag": None,
+    "last_modified": None,
+    "entries": [
+        {"question": question, "answer": answer}
+        for question, answer in zip(df['Question'], df['Answer'])
+    ],
+}
+with open('faq_snapshot.json', 'w', encoding='utf-8') as file:
+    json.dump(snapshot, file, ensure_ascii=False, indent=1)
@@ -0,0 +1,148 @@
+import re
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+from metrics import REDIS_LATENCY, RESPONSE_CACHE, span
+
+logger = logging.getLogger(__name__)
+
+_NON_WORD = re.compile(r"[^\w\s]")
+
+
+def normalize_message(message: str) -> str:
+    """Lowercase, drop punctuation and collapse whitespace so trivial variants share a key"""
+    return " ".join(_NON_WORD.sub(" ", message.lower()).split())
+
+
+def history_fingerprint(history: List[Dict[str, Any]], summary: Optional[str] = None) -> str:
+    """Stable digest of the conversation context a reply depends on"""
+    digest = hashlib.sha256()
+    digest.update((summary or "").encode("utf-8"))
+    for entry in history:
+        digest.update(b"\x00u")
+        digest.update(entry.get("user_message", "").encode("utf-8"))
+        digest.update(b"\x00b")
+        digest.update(entry.get("bot_message", "").encode("utf-8"))
+    return digest.hexdigest()
+
+
+def request_key(message: str, history: List[Dict[str, Any]], summary: Optional[str] = None) -> Optional[str]:
+    """Digest of everything a reply depends on, or None for an empty message"""
+    normalized = normalize_message(message)
+    if not normalized:
+        return None
+
+    digest = hashlib.sha256(f"{history_fingerprint(history, summary)}\x00{normalized}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class LRUCache:
+    """Small thread-safe in-process LRU with per-entry expiry"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ResponseCache:
+    """
+    Two-tier cache for Gemini text replies
+
+    Lookups hit the in-process LRU first, then Redis (shared by all
+    replicas, with TTL). Keys are the normalized message plus a fingerprint
+    of the conversation context; with context_free_only, turns that carry
+    history are never cached, so private context is never stored or shared.
+    """
+
+    def __init__(
+        self,
+        redis_client,
+        enabled: bool = False,
+        ttl: int = 3600,
+        local_size: int = 1024,
+        max_value_bytes: int = 16384,
+        context_free_only: bool = True,
+        prefix: str = "response_cache:",
+    ):
+        self.redis_client = redis_client
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_value_bytes = max_value_bytes
+        self.context_free_only = context_free_only
+        self.prefix = prefix
+        self.local = LRUCache(local_size, ttl)
+
+    def key_for(self, message: str, history: List[Dict[str, Any]], summary: Optional[str] = None) -> Optional[str]:
+        """Cache key for a request, or None if it must not be cached"""
+        if not self.enabled:
+            return None
+        if self.context_free_only and (history or summary):
+            return None
+
+        return request_key(message, history, summary)
+
+    async def get(self, key: str) -> Optional[str]:
+        """Look a reply up in the local tier, then Redis"""
+        value = self.local.get(key)
+        if value is not None:
+            RESPONSE_CACHE.labels("local_hit").inc()
+            return value
+
+        try:
+            with span("redis.response_cache_get", REDIS_LATENCY.labels("response_cache_get")):
+                value = await self.redis_client.get(f"{self.prefix}{key}")
+        except Exception as e:
+            logger.warning(f"Response cache lookup failed: {e}")
+            RESPONSE_CACHE.labels("error").inc()
+            value = None
+
+        if value is None:
+            RESPONSE_CACHE.labels("miss").inc()
+            return None
+
+        RESPONSE_CACHE.labels("redis_hit").inc()
+        self.local.set(key, value)
+        return value
+
+    async def set(self, key: str, value: str) -> None:
+        """Store a reply in both tiers, skipping values above max_value_bytes"""
+        if len(value.encode("utf-8")) > self.max_value_bytes:
+            RESPONSE_CACHE.labels("skipped").inc()
+            return
+
+        self.local.set(key, value)
+        try:
+            with span("redis.response_cache_set", REDIS_LATENCY.labels("response_cache_set")):
+                await self.redis_client.set(f"{self.prefix}{key}", value, ex=self.ttl)
+            RESPONSE_CACHE.labels("store").inc()
+        except Exception as e:
+            logger.warning(f"Response cache store failed: {e}")
+            RESPONSE_CACHE.labels("error").inc()
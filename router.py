@@ -0,0 +1,122 @@
+import re
+import time
+import logging
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from faq_index import FAQIndex
+from metrics import FAQ_MATCH_LATENCY, MESSAGES_ROUTED, current_trace, record_span
+
+logger = logging.getLogger(__name__)
+
+# Clients send the conversation with the new message after this marker
+CURRENT_MESSAGE_MARKER = "=== CURRENT USER MESSAGE ==="
+
+# Image generation keywords (.image or image:)
+IMAGE_KEYWORDS = re.compile(r"(\.image|image:)", re.IGNORECASE)
+
+# FAQ match scores at or above GOOD get the FAQ answer, at or above POOR a support handover
+GOOD_MATCH_THRESHOLD = 85
+POOR_MATCH_THRESHOLD = 40
+
+ROUTE_FAQ = "faq"
+ROUTE_HANDOVER = "handover"
+ROUTE_IMAGE = "image"
+ROUTE_TEXT = "text"
+
+# Counter children bound once, since labels() costs more than the rest of routing a message
+_ROUTED = {route: MESSAGES_ROUTED.labels(route) for route in (ROUTE_FAQ, ROUTE_HANDOVER, ROUTE_IMAGE, ROUTE_TEXT)}
+
+
+@dataclass
+class RouteDecision:
+    """
+    Where a message goes, decided once per request
+
+    Handlers take what they need from here instead of re-parsing the
+    prompt: the extracted current message, the FAQ match and, for image
+    requests, the prompt with the image keywords already stripped.
+    """
+    route: str
+    message: str
+    score: int = 0
+    matched_question: Optional[str] = None
+    answer: Optional[str] = None
+    image_prompt: Optional[str] = None
+
+
+def extract_current_message(full_prompt: str) -> str:
+    """Extract the current user message from the full prompt with history"""
+    _, marker, rest = full_prompt.partition(CURRENT_MESSAGE_MARKER)
+    if not marker:
+        # If no marker found, use the full prompt
+        return full_prompt.strip()
+
+    # Everything after the marker, up to a repeated marker if there is one
+    return rest.partition(CURRENT_MESSAGE_MARKER)[0].strip()
+
+
+def faq_route(score: int, good_threshold: int = GOOD_MATCH_THRESHOLD, poor_threshold: int = POOR_MATCH_THRESHOLD) -> Optional[str]:
+    """FAQ route for a match score, or None if the FAQ has no answer"""
+    if score >= good_threshold:
+        return ROUTE_FAQ
+    if score >= poor_threshold:
+        return ROUTE_HANDOVER
+    return None
+
+
+class IntentRouter:
+    """
+    Single routing stage in front of the message handlers
+
+    Precedence matches the original handler chain: FAQ answer, support
+    handover, image generation, then a Gemini text reply. The FAQ index is
+    read through get_index on every call so hot-swapped indexes are used
+    straight away.
+    """
+
+    def __init__(
+        self,
+        get_index: Callable[[], Optional[FAQIndex]],
+        good_threshold: int = GOOD_MATCH_THRESHOLD,
+        poor_threshold: int = POOR_MATCH_THRESHOLD,
+    ):
+        self.get_index = get_index
+        self.good_threshold = good_threshold
+        self.poor_threshold = poor_threshold
+
+    def route(self, full_prompt: str) -> RouteDecision:
+        """
+        Classify a message
+
+        Args:
+            full_prompt: Prompt as sent by the client, with or without history
+
+        Returns:
+            The routing decision for the current message
+        """
+        message = extract_current_message(full_prompt)
+
+        decision = self._classify(message)
+        _ROUTED[decision.route].inc()
+        return decision
+
+    def _classify(self, message: str) -> RouteDecision:
+        score = 0
+        index = self.get_index()
+        if message and index is not None and len(index) > 0:
+            start = time.perf_counter()
+            question, answer, score = index.match(message)
+            # Timed only inside a request trace, so offline callers don't pay for the histogram
+            if current_trace() is not None:
+                record_span("faq.match", start, FAQ_MATCH_LATENCY)
+            route = faq_route(score, self.good_threshold, self.poor_threshold)
+            if route is not None:
+                return RouteDecision(route, message, score, question, answer)
+
+        # One pass both detects and strips the image keywords
+        image_prompt, keywords = IMAGE_KEYWORDS.subn("", message)
+        if keywords:
+            return RouteDecision(ROUTE_IMAGE, message, score, image_prompt=image_prompt.strip())
+
+        return RouteDecision(ROUTE_TEXT, message, score)
@@ -0,0 +1,430 @@
+import os
+import json
+import time
+import uuid
+import zlib
+import base64
+import redis
+import redis.asyncio as aioredis
+import logging
+from typing import Awaitable, Callable, List, Dict, Any, Optional, Tuple
+
+from metrics import REDIS_LATENCY, span
+from prompt_context import split_for_fold
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+logger = logging.getLogger(__name__)
+
+def read_secret(secret_path):
+    try:
+        with open(secret_path, 'r') as file:
+            return file.read().strip()
+    except Exception as e:
+        logger.error(f"Failed to read secret from {secret_path}: {e}")
+        return None
+
+redis_password_path = os.environ.get('REDIS_PASSWORD_FILE', '/run/secrets/redis_password')
+
+REDIS_PASSWORD = None
+if os.path.exists(redis_password_path):
+    REDIS_PASSWORD = read_secret(redis_password_path)
+    if REDIS_PASSWORD:
+        logger.info("Redis password loaded")
+    else:
+        logger.error("Failed to load Redis password")
+else:
+    logger.warning(f"Redis password not found at path: {redis_password_path}")
+
+# Initialize Redis client
+REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
+REDIS_DB = int(os.environ.get("REDIS_DB", 0))
+
+# Connection pool sizing; requests wait up to REDIS_POOL_TIMEOUT for a free connection
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 64))
+REDIS_POOL_TIMEOUT = float(os.environ.get("REDIS_POOL_TIMEOUT", 5))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get("REDIS_SOCKET_TIMEOUT", 5))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get("REDIS_CONNECT_TIMEOUT", 2))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get("REDIS_HEALTH_CHECK_INTERVAL", 30))
+
+REDIS_CONNECTION_KWARGS = {
+    "host": REDIS_HOST,
+    "port": REDIS_PORT,
+    "db": REDIS_DB,
+    "password": REDIS_PASSWORD,
+    "decode_responses": True,
+    "socket_timeout": REDIS_SOCKET_TIMEOUT,
+    "socket_connect_timeout": REDIS_CONNECT_TIMEOUT,
+    "socket_keepalive": True,
+    "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL,
+}
+
+redis_client = redis.Redis(
+    connection_pool=redis.BlockingConnectionPool(
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        **REDIS_CONNECTION_KWARGS,
+    )
+)
+
+# Async client used by the request path so Redis I/O never blocks the event loop
+async_redis_client = aioredis.Redis(
+    connection_pool=aioredis.BlockingConnectionPool(
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        **REDIS_CONNECTION_KWARGS,
+    )
+)
+
+# Clients for binary values (fallback images); same server, raw bytes instead of decoded strings
+REDIS_BINARY_MAX_CONNECTIONS = int(os.environ.get("REDIS_BINARY_MAX_CONNECTIONS", 16))
+REDIS_BINARY_CONNECTION_KWARGS = dict(REDIS_CONNECTION_KWARGS, decode_responses=False)
+
+binary_redis_client = redis.Redis(
+    connection_pool=redis.BlockingConnectionPool(
+        max_connections=REDIS_BINARY_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        **REDIS_BINARY_CONNECTION_KWARGS,
+    )
+)
+
+async_binary_redis_client = aioredis.Redis(
+    connection_pool=aioredis.BlockingConnectionPool(
+        max_connections=REDIS_BINARY_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        **REDIS_BINARY_CONNECTION_KWARGS,
+    )
+)
+
+# Session expiry time (24 hours)
+SESSION_EXPIRY = 60 * 60 * 24
+
+# Chat history is an append-only Redis list capped at HISTORY_MAX_ENTRIES;
+# only the last HISTORY_PROMPT_TURNS entries are read back for the prompt
+HISTORY_MAX_ENTRIES = int(os.environ.get("HISTORY_MAX_ENTRIES", 100))
+HISTORY_PROMPT_TURNS = int(os.environ.get("HISTORY_PROMPT_TURNS", 20))
+
+# History entries are stored as compact JSON arrays [user_message, bot_message]; encodings
+# longer than HISTORY_COMPRESS_MIN_BYTES are zlib-compressed when that makes them smaller
+HISTORY_COMPRESS_MIN_BYTES = int(os.environ.get("HISTORY_COMPRESS_MIN_BYTES", 512))
+COMPRESSED_ENTRY_PREFIX = "z:"
+
+# Per-entry cap on the user message and reply together, which with HISTORY_MAX_ENTRIES bounds a
+# session's size. When both are long each keeps half; longer text is cut to a prefix in the
+# stored history only, the user has already received the reply in full
+HISTORY_MAX_ENTRY_CHARS = int(os.environ.get("HISTORY_MAX_ENTRY_CHARS", 8000))
+
+# Sorted set of session ids scored by the unix time their keys expire; cleanup reads
+# only the expired end, so its cost follows the number of expirations, not of sessions
+SESSION_INDEX_KEY = "session_expiry"
+
+# Touch-or-create a session and read its recent history and summary in one server-side step.
+# All keys of a session get the same deadline, which is also recorded in the expiry index.
+# KEYS: session key of the requested id, its history list, its summary, session key for a new id, expiry index
+# ARGV: expiry seconds, creation time for a new session, history turns to return, requested id, new id
+BOOTSTRAP_SESSION_SCRIPT = """
+local expires_at = tonumber(redis.call('TIME')[1]) + tonumber(ARGV[1])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    redis.call('EXPIRE', KEYS[2], ARGV[1])
+    redis.call('EXPIRE', KEYS[3], ARGV[1])
+    redis.call('ZADD', KEYS[5], expires_at, ARGV[4])
+    return {0, redis.call('LRANGE', KEYS[2], -tonumber(ARGV[3]), -1), redis.call('GET', KEYS[3])}
+end
+redis.call('SET', KEYS[4], ARGV[2], 'EX', ARGV[1])
+redis.call('ZADD', KEYS[5], expires_at, ARGV[5])
+return {1, {}, false}
+"""
+
+# Replace the oldest turns with a new summary, unless the list changed underneath us.
+# KEYS: history list, summary
+# ARGV: number of folded turns, last folded entry, summary text, expiry seconds
+FOLD_HISTORY_SCRIPT = """
+if redis.call('LINDEX', KEYS[1], tonumber(ARGV[1]) - 1) ~= ARGV[2] then
+    return 0
+end
+redis.call('LTRIM', KEYS[1], ARGV[1], -1)
+redis.call('SET', KEYS[2], ARGV[3], 'EX', ARGV[4])
+return 1
+"""
+
+# Remove one batch of expired sessions from the index and delete whatever outlived them.
+# A session touched since it was indexed is re-scored by its current TTL instead,
+# and one without a TTL is only dropped from the index.
+# KEYS: expiry index
+# ARGV: batch size, session key prefix, history key prefix, summary key prefix
+CLEANUP_SESSIONS_SCRIPT = """
+local now = tonumber(redis.call('TIME')[1])
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[1]))
+local removed = 0
+local deleted = 0
+for _, id in ipairs(ids) do
+    local ttl = redis.call('TTL', ARGV[2] .. id)
+    if ttl >= 0 then
+        redis.call('ZADD', KEYS[1], now + ttl, id)
+    else
+        if ttl == -2 then
+            deleted = deleted + redis.call('DEL', ARGV[3] .. id, ARGV[4] .. id)
+        end
+        redis.call('ZREM', KEYS[1], id)
+        removed = removed + 1
+    end
+end
+return {#ids, removed, deleted}
+"""
+
+_bootstrap_session = async_redis_client.register_script(BOOTSTRAP_SESSION_SCRIPT)
+_fold_history = async_redis_client.register_script(FOLD_HISTORY_SCRIPT)
+_cleanup_sessions = async_redis_client.register_script(CLEANUP_SESSIONS_SCRIPT)
+
+# Expired sessions handled per cleanup script call, bounding how long Redis is blocked
+SESSION_CLEANUP_BATCH = int(os.environ.get("SESSION_CLEANUP_BATCH", 500))
+
+# Only one fold per session at a time
+FOLD_LOCK_TIMEOUT = 120
+
+def session_key(session_id: str) -> str:
+    """Redis string holding the session metadata"""
+    return f"session:{session_id}"
+
+def history_key(session_id: str) -> str:
+    """Redis list holding one JSON entry per chat turn"""
+    return f"history_list:{session_id}"
+
+def summary_key(session_id: str) -> str:
+    """Redis string holding the rolling summary of turns folded out of the history list"""
+    return f"summary:{session_id}"
+
+def truncate_text(text: str, limit: int) -> str:
+    """Prefix of text at most limit characters long, ending in "..." when cut"""
+    if len(text) <= limit:
+        return text
+    return text[:max(0, limit - 3)] + "..."
+
+def cap_entry(user_message: str, bot_message: Optional[str]) -> Tuple[str, Optional[str]]:
+    """Cut a turn to HISTORY_MAX_ENTRY_CHARS; each side keeps at least half the budget, or all it needs"""
+    if bot_message is None:
+        return truncate_text(user_message, HISTORY_MAX_ENTRY_CHARS), None
+    if len(user_message) + len(bot_message) <= HISTORY_MAX_ENTRY_CHARS:
+        return user_message, bot_message
+
+    half = HISTORY_MAX_ENTRY_CHARS // 2
+    user_limit = max(half, HISTORY_MAX_ENTRY_CHARS - len(bot_message))
+    bot_limit = max(half, HISTORY_MAX_ENTRY_CHARS - len(user_message))
+    return truncate_text(user_message, user_limit), truncate_text(bot_message, bot_limit)
+
+def encode_entry(entry: Dict[str, Any]) -> str:
+    """Compact, possibly compressed, string form of a history entry"""
+    user_message, bot_message = cap_entry(entry.get("user_message", ""), entry.get("bot_message"))
+
+    if set(entry) - {"user_message", "bot_message"}:
+        # Unknown fields are kept as a plain JSON object
+        entry = dict(entry, user_message=user_message)
+        if bot_message is not None:
+            entry["bot_message"] = bot_message
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+
+    fields = [user_message] if bot_message is None else [user_message, bot_message]
+    encoded = json.dumps(fields, ensure_ascii=False, separators=(",", ":"))
+
+    if len(encoded) > HISTORY_COMPRESS_MIN_BYTES:
+        compressed = COMPRESSED_ENTRY_PREFIX + base64.b85encode(zlib.compress(encoded.encode("utf-8"), 6)).decode("ascii")
+        if len(compressed) < len(encoded.encode("utf-8")):
+            return compressed
+
+    return encoded
+
+def decode_entry(raw: str) -> Dict[str, Any]:
+    """Inverse of encode_entry; also reads entries stored as JSON objects"""
+    if raw.startswith(COMPRESSED_ENTRY_PREFIX):
+        raw = zlib.decompress(base64.b85decode(raw[len(COMPRESSED_ENTRY_PREFIX):])).decode("utf-8")
+
+    value = json.loads(raw)
+    if isinstance(value, dict):
+        return value
+
+    entry = {"user_message": value[0]}
+    if len(value) > 1:
+        entry["bot_message"] = value[1]
+    return entry
+
+async def bootstrap_session(session_id: Optional[str] = None, turns: int = HISTORY_PROMPT_TURNS) -> Tuple[str, List[Dict[str, Any]], Optional[str]]:
+    """
+    Get or create a session and load its recent history in one round-trip
+
+    Args:
+        session_id: Session id from the client cookie, if any
+        turns: Number of most recent history entries to return
+
+    Returns:
+        Tuple of (session id to use, history entries, rolling summary or None)
+    """
+    requested_id = session_id or ""
+    new_session_id = str(uuid.uuid4())
+
+    with span("redis.bootstrap_session", REDIS_LATENCY.labels("bootstrap_session")):
+        created, entries, summary = await _bootstrap_session(
+            keys=[session_key(requested_id), history_key(requested_id), summary_key(requested_id), session_key(new_session_id), SESSION_INDEX_KEY],
+            args=[SESSION_EXPIRY, int(time.time()), turns, requested_id, new_session_id],
+        )
+
+    if created:
+        # History list is created by the first RPUSH
+        return new_session_id, [], None
+
+    return requested_id, [decode_entry(entry) for entry in entries], summary
+
+async def get_chat_history(session_id: str, turns: int = HISTORY_PROMPT_TURNS) -> List[Dict[str, Any]]:
+    """Get the most recent chat history entries for a session"""
+    with span("redis.get_chat_history", REDIS_LATENCY.labels("get_chat_history")):
+        entries = await async_redis_client.lrange(history_key(session_id), -turns, -1)
+    return [decode_entry(entry) for entry in entries]
+
+async def update_chat_history(session_id: str, entry: Dict[str, Any]) -> None:
+    """Append an entry to the chat history of a session
+
+    RPUSH, LTRIM and EXPIRE run in one MULTI block, so the cost per message
+    is constant and concurrent requests in a session never drop each
+    other's entries.
+    """
+    key = history_key(session_id)
+    with span("redis.update_chat_history", REDIS_LATENCY.labels("update_chat_history")):
+        async with async_redis_client.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, encode_entry(entry))
+            pipe.ltrim(key, -HISTORY_MAX_ENTRIES, -1)
+            pipe.expire(key, SESSION_EXPIRY)
+            await pipe.execute()
+
+async def fold_session_history(
+    session_id: str,
+    summarize: Callable[[Optional[str], List[Dict[str, Any]]], Awaitable[str]],
+) -> bool:
+    """
+    Fold the oldest history turns of a session into its rolling summary
+
+    Args:
+        session_id: Session to compact
+        summarize: Coroutine function (previous summary, turns) -> new summary
+
+    Returns:
+        True if the history was folded
+    """
+    lock = f"summary_lock:{session_id}"
+    if not await async_redis_client.set(lock, "1", nx=True, ex=FOLD_LOCK_TIMEOUT):
+        return False
+
+    try:
+        with REDIS_LATENCY.labels("load_fold_history").time():
+            async with async_redis_client.pipeline(transaction=False) as pipe:
+                pipe.lrange(history_key(session_id), 0, -1)
+                pipe.get(summary_key(session_id))
+                raw_entries, summary = await pipe.execute()
+
+        history = [decode_entry(entry) for entry in raw_entries]
+        folded, _ = split_for_fold(history, max_turns=HISTORY_PROMPT_TURNS)
+        if not folded:
+            return False
+
+        new_summary = await summarize(summary, folded)
+
+        with REDIS_LATENCY.labels("fold_history").time():
+            applied = await _fold_history(
+                keys=[history_key(session_id), summary_key(session_id)],
+                args=[len(folded), raw_entries[len(folded) - 1], new_summary, SESSION_EXPIRY],
+            )
+        if applied:
+            logger.info(f"Folded {len(folded)} turns of session {session_id} into its summary")
+        return bool(applied)
+
+    finally:
+        await async_redis_client.delete(lock)
+
+async def purge_expired_sessions(batch_size: int = SESSION_CLEANUP_BATCH, max_batches: int = 20) -> Tuple[int, int]:
+    """
+    Drop expired sessions from the expiry index and delete keys that outlived them
+
+    Works through the index in batches of batch_size until no expired
+    entries are left or max_batches have run.
+
+    Returns:
+        Tuple of (expired sessions removed from the index, keys deleted)
+    """
+    sessions = 0
+    deleted = 0
+    for _ in range(max_batches):
+        with span("redis.cleanup_sessions", REDIS_LATENCY.labels("cleanup_sessions")):
+            found, removed, deleted_keys = await _cleanup_sessions(
+                keys=[SESSION_INDEX_KEY],
+                args=[batch_size, session_key(""), history_key(""), summary_key("")],
+            )
+        sessions += removed
+        deleted += deleted_keys
+        if found < batch_size:
+            break
+
+    if sessions:
+        logger.info(f"Cleaned up {sessions} expired sessions, deleted {deleted} orphaned keys")
+    return sessions, deleted
+
+async def _memory_usages(session_ids: List[str]) -> List[Dict[str, Any]]:
+    """MEMORY USAGE of the keys of several sessions, in one pipeline"""
+    async with async_redis_client.pipeline(transaction=False) as pipe:
+        for session_id in session_ids:
+            pipe.memory_usage(session_key(session_id))
+            pipe.memory_usage(history_key(session_id))
+            pipe.memory_usage(summary_key(session_id))
+            pipe.llen(history_key(session_id))
+        results = await pipe.execute()
+
+    usages = []
+    for i, session_id in enumerate(session_ids):
+        session_bytes, history_bytes, summary_bytes, entries = results[i * 4:i * 4 + 4]
+        usages.append({
+            "session_id": session_id,
+            "bytes": (session_bytes or 0) + (history_bytes or 0) + (summary_bytes or 0),
+            "history_bytes": history_bytes or 0,
+            "summary_bytes": summary_bytes or 0,
+            "history_entries": entries,
+        })
+    return usages
+
+async def session_memory_usage(session_id: str) -> Dict[str, Any]:
+    """Bytes used by the keys of one session, as reported by MEMORY USAGE"""
+    return (await _memory_usages([session_id]))[0]
+
+async def session_memory_report(sample: int = 100, largest: int = 10) -> Dict[str, Any]:
+    """
+    Memory used per session, measured on the most recently active sessions
+
+    Args:
+        sample: Number of sessions to measure
+        largest: Number of the biggest sampled sessions to list
+
+    Returns:
+        Sampled average and max bytes per session, the largest sessions, and
+        how many sessions of average size fit in Redis maxmemory
+    """
+    session_ids = await async_redis_client.zrevrange(SESSION_INDEX_KEY, 0, sample - 1)
+    usages = await _memory_usages(session_ids)
+    sizes = [usage["bytes"] for usage in usages]
+
+    try:
+        memory = await async_redis_client.info("memory")
+        maxmemory = int(memory.get("maxmemory", 0)) or None
+        used_memory = int(memory.get("used_memory", 0))
+    except Exception as e:
+        logger.warning(f"Could not read Redis memory info: {e}")
+        maxmemory = used_memory = None
+
+    average = sum(sizes) / len(sizes) if sizes else 0
+    return {
+        "indexed_sessions": await async_redis_client.zcard(SESSION_INDEX_KEY),
+        "sampled_sessions": len(sizes),
+        "average_bytes": average,
+        "max_bytes": max(sizes, default=0),
+        "largest": sorted(usages, key=lambda usage: usage["bytes"], reverse=True)[:largest],
+        "used_memory": used_memory,
+        "maxmemory": maxmemory,
+        "sessions_capacity": int(maxmemory // average) if maxmemory and average else None,
+    }
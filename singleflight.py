@@ -0,0 +1,119 @@
+import time
+import uuid
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict
+
+from metrics import COALESCED_CALLS
+
+logger = logging.getLogger(__name__)
+
+# Delete the lock only if this caller still holds it
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """
+    Share one in-flight call among concurrent callers with the same key
+
+    In-process, callers with a key already in flight await the same task;
+    the task is shielded, so a caller that disconnects doesn't cancel the
+    call for the others. With a redis_client, the first replica to take
+    the lock {prefix}{key}:lock makes the call and publishes the result
+    under {prefix}{key}:result for result_ttl seconds, and the others poll
+    for it; if the holder goes away without a result they make the call
+    themselves. Results must be strings when redis_client is set.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        redis_client=None,
+        lock_ttl: float = 60.0,
+        result_ttl: int = 10,
+        poll_interval: float = 0.1,
+        prefix: str = "singleflight:",
+    ):
+        self.name = name
+        self.redis_client = redis_client
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.prefix = prefix
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._release_lock = redis_client.register_script(RELEASE_LOCK_SCRIPT) if redis_client is not None else None
+
+    async def do(self, key: str, func: Callable[[], Awaitable]):
+        """Await func(), or the call already in flight for key"""
+        task = self._calls.get(key)
+        if task is not None:
+            COALESCED_CALLS.labels(self.name, "local").inc()
+            return await asyncio.shield(task)
+
+        task = asyncio.ensure_future(self._run(key, func))
+        self._calls[key] = task
+        task.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Retrieve the exception so it isn't reported as unhandled when every caller has gone
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"{self.name} call for {key} failed: {task.exception()}")
+
+    async def _run(self, key: str, func: Callable[[], Awaitable]):
+        if self.redis_client is None:
+            return await func()
+
+        lock_key = f"{self.prefix}{key}:lock"
+        result_key = f"{self.prefix}{key}:result"
+        token = str(uuid.uuid4())
+        try:
+            acquired = await self.redis_client.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000))
+        except Exception as e:
+            logger.warning(f"Single-flight lock failed, calling directly: {e}")
+            return await func()
+
+        if acquired:
+            try:
+                result = await func()
+                try:
+                    await self.redis_client.set(result_key, result, ex=self.result_ttl)
+                except Exception as e:
+                    logger.warning(f"Single-flight result store failed: {e}")
+                return result
+            finally:
+                try:
+                    await self._release_lock(keys=[lock_key], args=[token])
+                except Exception as e:
+                    logger.warning(f"Single-flight lock release failed: {e}")
+
+        # Another replica is making the call; wait for its result while it holds the lock
+        deadline = time.monotonic() + self.lock_ttl
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    pipe.get(result_key)
+                    pipe.exists(lock_key)
+                    result, locked = await pipe.execute()
+            except Exception as e:
+                logger.warning(f"Single-flight poll failed, calling directly: {e}")
+                break
+
+            if result is not None:
+                COALESCED_CALLS.labels(self.name, "redis").inc()
+                return result
+            if not locked:
+                break
+
+        return await func()
+
+    def in_flight(self) -> int:
+        return len(self._calls)
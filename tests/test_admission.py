@@ -0,0 +1,217 @@
+"""
+ConcurrencyLimiter and AdmissionController: FIFO hand-off, queue limits,
+wait timeouts, per-session limits, and slots given back on error and
+cancellation
+"""
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, ConcurrencyLimiter, Overloaded
+
+
+async def _settle():
+    """Let tasks that were just woken run up to their next await"""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_release_hands_the_slot_to_the_oldest_waiter():
+    async def scenario():
+        limiter = ConcurrencyLimiter("text", limit=1, max_waiting=2, wait_timeout=5)
+        await limiter.acquire()
+
+        order = []
+
+        async def waiter(name):
+            await limiter.acquire()
+            order.append(name)
+
+        first = asyncio.create_task(waiter("first"))
+        await _settle()
+        second = asyncio.create_task(waiter("second"))
+        await _settle()
+        assert len(limiter._waiters) == 2
+
+        limiter.release()
+        await _settle()
+        assert order == ["first"]
+        assert limiter.active == 1
+
+        limiter.release()
+        await asyncio.gather(first, second)
+        assert order == ["first", "second"]
+
+        limiter.release()
+        assert limiter.active == 0
+        assert not limiter._waiters
+
+    asyncio.run(scenario())
+
+
+def test_newcomer_queues_behind_waiters_even_when_a_slot_is_free():
+    async def scenario():
+        limiter = ConcurrencyLimiter("text", limit=1, max_waiting=2, wait_timeout=5)
+        await limiter.acquire()
+        queued = asyncio.create_task(limiter.acquire())
+        await _settle()
+
+        # The released slot belongs to the queued waiter, not to a caller arriving now
+        limiter.release()
+        newcomer = asyncio.create_task(limiter.acquire())
+        await _settle()
+        assert queued.done()
+        assert not newcomer.done()
+
+        limiter.release()
+        await newcomer
+        limiter.release()
+        assert limiter.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_rejects_at_once():
+    async def scenario():
+        limiter = ConcurrencyLimiter("image", limit=1, max_waiting=0, wait_timeout=5)
+        await limiter.acquire()
+        with pytest.raises(Overloaded) as error:
+            await limiter.acquire()
+        assert error.value.reason == "queue_full"
+        assert limiter.active == 1
+
+    asyncio.run(scenario())
+
+
+def test_wait_timeout_rejects_and_leaves_the_queue():
+    async def scenario():
+        limiter = ConcurrencyLimiter("text", limit=1, max_waiting=1, wait_timeout=0.01)
+        await limiter.acquire()
+        with pytest.raises(Overloaded) as error:
+            await limiter.acquire()
+        assert error.value.reason == "timeout"
+        assert not limiter._waiters
+
+        limiter.release()
+        assert limiter.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        limiter = ConcurrencyLimiter("text", limit=1, max_waiting=1, wait_timeout=5)
+        await limiter.acquire()
+        waiting = asyncio.create_task(limiter.acquire())
+        await _settle()
+
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert not limiter._waiters
+
+        limiter.release()
+        assert limiter.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_slot_handed_to_a_cancelled_waiter_is_not_lost():
+    async def scenario():
+        limiter = ConcurrencyLimiter("text", limit=1, max_waiting=1, wait_timeout=5)
+        await limiter.acquire()
+        waiting = asyncio.create_task(limiter.acquire())
+        await _settle()
+
+        # Hand the slot over and cancel the waiter before it gets to run
+        limiter.release()
+        waiting.cancel()
+        results = await asyncio.gather(waiting, return_exceptions=True)
+        if not isinstance(results[0], asyncio.CancelledError):
+            # The wait completed before the cancellation landed: the caller holds the slot
+            limiter.release()
+
+        assert limiter.active == 0
+        assert not limiter._waiters
+
+    asyncio.run(scenario())
+
+
+def test_session_limit_rejects_without_queueing():
+    async def scenario():
+        limiter = ConcurrencyLimiter("text", limit=4, max_waiting=4, wait_timeout=5)
+        controller = AdmissionController({"text": limiter}, session_limit=1)
+
+        permit = await controller.acquire("text", "session-a")
+        with pytest.raises(Overloaded) as error:
+            await controller.acquire("text", "session-a")
+        assert error.value.reason == "session"
+
+        other = await controller.acquire("text", "session-b")
+        assert limiter.active == 2
+
+        permit.release()
+        other.release()
+        assert limiter.active == 0
+        assert controller._sessions == {}
+
+    asyncio.run(scenario())
+
+
+def test_permit_release_is_idempotent():
+    async def scenario():
+        limiter = ConcurrencyLimiter("text", limit=2, max_waiting=0, wait_timeout=0)
+        controller = AdmissionController({"text": limiter}, session_limit=2)
+
+        permit = await controller.acquire("text", "session-a")
+        kept = await controller.acquire("text", "session-a")
+        permit.release()
+        permit.release()
+        assert limiter.active == 1
+        assert controller._sessions == {"session-a": 1}
+
+        kept.release()
+        assert limiter.active == 0
+        assert controller._sessions == {}
+
+    asyncio.run(scenario())
+
+
+def test_rejected_or_cancelled_request_gives_back_its_session_count():
+    async def scenario():
+        limiter = ConcurrencyLimiter("text", limit=1, max_waiting=1, wait_timeout=0.01)
+        controller = AdmissionController({"text": limiter}, session_limit=2)
+        holder = await controller.acquire("text", "session-a")
+
+        with pytest.raises(Overloaded):
+            await controller.acquire("text", "session-b")
+        assert "session-b" not in controller._sessions
+
+        limiter.wait_timeout = 5
+        waiting = asyncio.create_task(controller.acquire("text", "session-c"))
+        await _settle()
+        assert controller._sessions["session-c"] == 1
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert "session-c" not in controller._sessions
+
+        holder.release()
+        assert limiter.active == 0
+        assert controller._sessions == {}
+
+    asyncio.run(scenario())
+
+
+def test_unlimited_kinds_get_a_no_op_permit():
+    async def scenario():
+        limiter = ConcurrencyLimiter("text", limit=1)
+        controller = AdmissionController({"text": limiter}, session_limit=1)
+
+        for kind in (None, "faq"):
+            permit = await controller.acquire(kind, "session-a")
+            permit.release()
+        assert limiter.active == 0
+        assert controller._sessions == {}
+
+    asyncio.run(scenario())
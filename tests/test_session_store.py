@@ -0,0 +1,206 @@
+"""
+Session bootstrap, history folding and expired session cleanup, running
+the Lua scripts against fakeredis (needs fakeredis with Lua support,
+pip install "fakeredis[lua]")
+"""
+import time
+import asyncio
+
+import fakeredis
+
+import session_store
+from session_store import (
+    SESSION_EXPIRY,
+    SESSION_INDEX_KEY,
+    bootstrap_session,
+    encode_entry,
+    fold_session_history,
+    history_key,
+    purge_expired_sessions,
+    session_key,
+    summary_key,
+)
+
+
+def use_fake_redis(monkeypatch) -> fakeredis.FakeAsyncRedis:
+    """Point session_store and its registered scripts at a fresh fakeredis"""
+    client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    monkeypatch.setattr(session_store, "async_redis_client", client)
+    monkeypatch.setattr(session_store, "_bootstrap_session", client.register_script(session_store.BOOTSTRAP_SESSION_SCRIPT))
+    monkeypatch.setattr(session_store, "_fold_history", client.register_script(session_store.FOLD_HISTORY_SCRIPT))
+    monkeypatch.setattr(session_store, "_cleanup_sessions", client.register_script(session_store.CLEANUP_SESSIONS_SCRIPT))
+    return client
+
+
+def turn(i: int):
+    return {"user_message": f"question {i}", "bot_message": f"answer {i}"}
+
+
+async def push_history(client, session_id: str, count: int) -> None:
+    await client.rpush(history_key(session_id), *[encode_entry(turn(i)) for i in range(count)])
+
+
+def test_bootstrap_creates_a_session_for_an_unknown_id(monkeypatch):
+    async def scenario():
+        client = use_fake_redis(monkeypatch)
+
+        session_id, history, summary = await bootstrap_session("unknown")
+        assert session_id != "unknown"
+        assert (history, summary) == ([], None)
+        assert 0 < await client.ttl(session_key(session_id)) <= SESSION_EXPIRY
+        assert await client.exists(session_key("unknown")) == 0
+
+        score = await client.zscore(SESSION_INDEX_KEY, session_id)
+        assert abs(score - (time.time() + SESSION_EXPIRY)) < 5
+
+        new_id, _, _ = await bootstrap_session(None)
+        assert new_id not in ("", session_id)
+
+    asyncio.run(scenario())
+
+
+def test_bootstrap_touches_a_session_and_returns_its_recent_history(monkeypatch):
+    async def scenario():
+        client = use_fake_redis(monkeypatch)
+        await client.set(session_key("s1"), "1", ex=10)
+        await push_history(client, "s1", 5)
+        await client.expire(history_key("s1"), 10)
+        await client.set(summary_key("s1"), "earlier turns", ex=10)
+
+        session_id, history, summary = await bootstrap_session("s1", turns=3)
+        assert session_id == "s1"
+        assert history == [turn(2), turn(3), turn(4)]
+        assert summary == "earlier turns"
+        for key in (session_key("s1"), history_key("s1"), summary_key("s1")):
+            assert await client.ttl(key) > 10
+        assert await client.zscore(SESSION_INDEX_KEY, "s1") > time.time() + 10
+
+    asyncio.run(scenario())
+
+
+def test_fold_keeps_half_the_prompt_turns_and_folds_the_rest(monkeypatch):
+    async def scenario():
+        client = use_fake_redis(monkeypatch)
+        monkeypatch.setattr(session_store, "HISTORY_PROMPT_TURNS", 8)
+        await push_history(client, "s1", 9)
+        folded_turns = []
+
+        async def summarize(summary, turns):
+            folded_turns.extend(turns)
+            return "summary of 5"
+
+        assert await fold_session_history("s1", summarize)
+        assert folded_turns == [turn(i) for i in range(5)]
+        remaining = await client.lrange(history_key("s1"), 0, -1)
+        assert [session_store.decode_entry(raw) for raw in remaining] == [turn(i) for i in range(5, 9)]
+        assert await client.get(summary_key("s1")) == "summary of 5"
+        assert await client.exists("summary_lock:s1") == 0
+
+    asyncio.run(scenario())
+
+
+def test_fold_does_nothing_when_the_history_already_fits(monkeypatch):
+    async def scenario():
+        client = use_fake_redis(monkeypatch)
+        monkeypatch.setattr(session_store, "HISTORY_PROMPT_TURNS", 8)
+        await push_history(client, "s1", 4)
+
+        async def summarize(summary, turns):
+            raise AssertionError("nothing should be folded")
+
+        assert not await fold_session_history("s1", summarize)
+        assert await client.llen(history_key("s1")) == 4
+        assert await client.exists(summary_key("s1")) == 0
+
+    asyncio.run(scenario())
+
+
+def test_fold_keeps_turns_appended_while_summarizing(monkeypatch):
+    async def scenario():
+        client = use_fake_redis(monkeypatch)
+        monkeypatch.setattr(session_store, "HISTORY_PROMPT_TURNS", 4)
+        await push_history(client, "s1", 4)
+
+        async def summarize(summary, turns):
+            await client.rpush(history_key("s1"), encode_entry(turn(4)))
+            return "summary"
+
+        assert await fold_session_history("s1", summarize)
+        remaining = await client.lrange(history_key("s1"), 0, -1)
+        assert [session_store.decode_entry(raw) for raw in remaining] == [turn(2), turn(3), turn(4)]
+
+    asyncio.run(scenario())
+
+
+def test_fold_is_abandoned_when_the_oldest_turns_changed(monkeypatch):
+    async def scenario():
+        client = use_fake_redis(monkeypatch)
+        monkeypatch.setattr(session_store, "HISTORY_PROMPT_TURNS", 4)
+        await push_history(client, "s1", 4)
+
+        async def summarize(summary, turns):
+            # Another writer trimmed the list underneath the fold
+            await client.ltrim(history_key("s1"), 1, -1)
+            return "stale summary"
+
+        assert not await fold_session_history("s1", summarize)
+        assert await client.llen(history_key("s1")) == 3
+        assert await client.exists(summary_key("s1")) == 0
+
+    asyncio.run(scenario())
+
+
+def test_fold_is_skipped_while_another_fold_holds_the_lock(monkeypatch):
+    async def scenario():
+        client = use_fake_redis(monkeypatch)
+        monkeypatch.setattr(session_store, "HISTORY_PROMPT_TURNS", 4)
+        await push_history(client, "s1", 6)
+        await client.set("summary_lock:s1", "1")
+
+        async def summarize(summary, turns):
+            raise AssertionError("the lock holder is folding")
+
+        assert not await fold_session_history("s1", summarize)
+        assert await client.llen(history_key("s1")) == 6
+        assert await client.get("summary_lock:s1") == "1"
+
+    asyncio.run(scenario())
+
+
+def test_cleanup_handles_expired_touched_and_persistent_sessions(monkeypatch):
+    async def scenario():
+        client = use_fake_redis(monkeypatch)
+        expired_at = time.time() - 10
+
+        # Expired: the session key is gone, leftover history and summary are deleted
+        await push_history(client, "gone", 2)
+        await client.set(summary_key("gone"), "summary")
+        # Touched since it was indexed: re-scored by its current TTL
+        await client.set(session_key("touched"), "1", ex=100)
+        # No TTL: only dropped from the index
+        await client.set(session_key("persistent"), "1")
+        await client.zadd(SESSION_INDEX_KEY, {"gone": expired_at, "touched": expired_at, "persistent": expired_at})
+        await client.zadd(SESSION_INDEX_KEY, {"live": time.time() + 100})
+
+        assert await purge_expired_sessions() == (2, 2)
+        assert await client.exists(history_key("gone"), summary_key("gone")) == 0
+        assert await client.zscore(SESSION_INDEX_KEY, "touched") > time.time() + 50
+        assert await client.exists(session_key("persistent")) == 1
+        assert set(await client.zrange(SESSION_INDEX_KEY, 0, -1)) == {"touched", "live"}
+
+    asyncio.run(scenario())
+
+
+def test_cleanup_works_through_the_index_in_batches(monkeypatch):
+    async def scenario():
+        client = use_fake_redis(monkeypatch)
+        await client.zadd(SESSION_INDEX_KEY, {f"s{i}": time.time() - 10 for i in range(5)})
+
+        assert await purge_expired_sessions(batch_size=2) == (5, 0)
+        assert await client.zcard(SESSION_INDEX_KEY) == 0
+
+        await client.zadd(SESSION_INDEX_KEY, {f"s{i}": time.time() - 10 for i in range(5)})
+        assert await purge_expired_sessions(batch_size=2, max_batches=1) == (2, 0)
+        assert await client.zcard(SESSION_INDEX_KEY) == 3
+
+    asyncio.run(scenario())
@@ -0,0 +1,166 @@
+"""
+SingleFlight: callers sharing one in-flight call in-process and across
+replicas through a Redis lock, and what followers see when the leader
+fails
+"""
+import asyncio
+
+import fakeredis
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_callers_share_one_call():
+    async def scenario():
+        flights = SingleFlight("test")
+        calls = []
+        release = asyncio.Event()
+
+        async def call():
+            calls.append(1)
+            await release.wait()
+            return "result"
+
+        callers = [asyncio.create_task(flights.do("key", call)) for _ in range(5)]
+        await asyncio.sleep(0)
+        assert flights.in_flight() == 1
+
+        release.set()
+        assert await asyncio.gather(*callers) == ["result"] * 5
+        assert len(calls) == 1
+        assert flights.in_flight() == 0
+
+    asyncio.run(scenario())
+
+
+def test_followers_get_the_leaders_error_and_the_next_call_runs_again():
+    async def scenario():
+        flights = SingleFlight("test")
+        calls = []
+        release = asyncio.Event()
+
+        async def failing():
+            calls.append(1)
+            await release.wait()
+            raise RuntimeError("boom")
+
+        callers = [asyncio.create_task(flights.do("key", failing)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert len(calls) == 1
+
+        # A failure is not remembered: the next caller makes a fresh call
+        async def succeeding():
+            calls.append(1)
+            return "ok"
+
+        assert await flights.do("key", succeeding) == "ok"
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_caller_does_not_cancel_the_call_for_others():
+    async def scenario():
+        flights = SingleFlight("test")
+        release = asyncio.Event()
+
+        async def call():
+            await release.wait()
+            return "result"
+
+        leader = asyncio.create_task(flights.do("key", call))
+        cancelled_follower = asyncio.create_task(flights.do("key", call))
+        follower = asyncio.create_task(flights.do("key", call))
+        await asyncio.sleep(0)
+
+        for caller in (leader, cancelled_follower):
+            caller.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await caller
+
+        release.set()
+        assert await follower == "result"
+
+    asyncio.run(scenario())
+
+
+def test_replica_waits_for_the_result_published_by_the_lock_holder():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        leader = SingleFlight("test", fakeredis.FakeAsyncRedis(server=server, decode_responses=True), lock_ttl=5, poll_interval=0.01)
+        follower = SingleFlight("test", fakeredis.FakeAsyncRedis(server=server, decode_responses=True), lock_ttl=5, poll_interval=0.01)
+        release = asyncio.Event()
+        follower_calls = []
+
+        async def leader_call():
+            await release.wait()
+            return "from leader"
+
+        async def follower_call():
+            follower_calls.append(1)
+            return "from follower"
+
+        leading = asyncio.create_task(leader.do("key", leader_call))
+        await asyncio.sleep(0.01)
+        following = asyncio.create_task(follower.do("key", follower_call))
+        await asyncio.sleep(0.03)
+        assert not following.done()
+
+        release.set()
+        assert await leading == "from leader"
+        assert await following == "from leader"
+        assert follower_calls == []
+
+        client = leader.redis_client
+        assert await client.exists("singleflight:key:lock") == 0
+        assert await client.get("singleflight:key:result") == "from leader"
+
+    asyncio.run(scenario())
+
+
+def test_replica_makes_the_call_itself_when_the_lock_holder_fails():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        leader = SingleFlight("test", fakeredis.FakeAsyncRedis(server=server, decode_responses=True), lock_ttl=5, poll_interval=0.01)
+        follower = SingleFlight("test", fakeredis.FakeAsyncRedis(server=server, decode_responses=True), lock_ttl=5, poll_interval=0.01)
+        release = asyncio.Event()
+
+        async def leader_call():
+            await release.wait()
+            raise RuntimeError("boom")
+
+        async def follower_call():
+            return "from follower"
+
+        leading = asyncio.create_task(leader.do("key", leader_call))
+        await asyncio.sleep(0.01)
+        following = asyncio.create_task(follower.do("key", follower_call))
+        await asyncio.sleep(0.03)
+
+        release.set()
+        with pytest.raises(RuntimeError):
+            await leading
+        assert await leader.redis_client.exists("singleflight:key:lock") == 0
+        # The failed holder released its lock without a result, so the follower stops waiting
+        assert await following == "from follower"
+        assert await leader.redis_client.get("singleflight:key:result") is None
+
+    asyncio.run(scenario())
+
+
+def test_lock_is_only_released_by_its_holder():
+    async def scenario():
+        client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        flights = SingleFlight("test", client)
+        await client.set("singleflight:key:lock", "holder-token")
+
+        assert await flights._release_lock(keys=["singleflight:key:lock"], args=["other-token"]) == 0
+        assert await client.get("singleflight:key:lock") == "holder-token"
+        assert await flights._release_lock(keys=["singleflight:key:lock"], args=["holder-token"]) == 1
+        assert await client.exists("singleflight:key:lock") == 0
+
+    asyncio.run(scenario())
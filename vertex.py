@@ -1,25 +1,33 @@
-from fuzzywuzzy import fuzz, process
-import pandas as pd
-import boto3
-from botocore.exceptions import ClientError
-
-from PIL import Image
 from io import BytesIO
-import requests
 import os
 import json
 import uuid
-import re
+import time
 import logging
 import base64
-from typing import Optional, List, Dict, Any, Optional, Tuple, Union
-
-import vertexai
-from vertexai.preview.generative_models import GenerativeModel, Part, SafetySetting, FinishReason, Tool, GenerationConfig
-from vertexai.preview.generative_models import grounding
-from vertexai.preview.generative_models import Image as VertexImage
-
-from utils import exponential_backoff_retry, SDKRotator, S3ImageManager
+import hashlib
+import asyncio
+import functools
+import importlib
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Optional, List, Dict, Any, Tuple, Callable, Iterator, AsyncIterator, Awaitable
+
+# vertexai, google-auth, PIL, boto3 and requests are imported on first use (or by
+# warm_up_clients in the background) so importing this module, and app with it, stays fast
+
+from faq_index import FAQIndex
+from image_store import FallbackImageStore
+from image_processing import IMAGE_VARIANTS, WEBP_MIMETYPE, encode_webp, fit_within, render_variants_in_pool
+from metrics import IMAGE_PROCESSING_LATENCY, span
+from prompt_context import fit_history
+from response_cache import ResponseCache, normalize_message, request_key
+from router import IntentRouter, RouteDecision, ROUTE_FAQ, ROUTE_HANDOVER, ROUTE_IMAGE, IMAGE_KEYWORDS, GOOD_MATCH_THRESHOLD, POOR_MATCH_THRESHOLD, faq_route
+from session_store import async_redis_client, binary_redis_client, async_binary_redis_client
+from singleflight import SingleFlight
+from utils import async_exponential_backoff_retry, SDKRotator, S3ImageManager
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
@@ -33,32 +41,114 @@ gcp_key_paths = [
 ]
 
 # Load SDK configurations
+# Per project, GCP_MAX_IN_FLIGHT_<n> caps its concurrent calls (0, the default, means no cap)
+# and GCP_WEIGHT_<n> sets its share of the load relative to the others (default 1.0)
 
 SDK_CONFIGS = [
     {
         "project_id": "carbon-beanbag-410610",
         "key_path": gcp_key_paths[0],
         "location": "us-central1",
+        "max_in_flight": int(os.environ.get('GCP_MAX_IN_FLIGHT_1', 0)),
+        "weight": float(os.environ.get('GCP_WEIGHT_1', 1.0)),
     },
     {
         "project_id": "spiritual-slate-410612",
         "key_path": gcp_key_paths[1],
         "location": "us-central1",
+        "max_in_flight": int(os.environ.get('GCP_MAX_IN_FLIGHT_2', 0)),
+        "weight": float(os.environ.get('GCP_WEIGHT_2', 1.0)),
     },
     {
         "project_id": "ultra-function-439306-r4",
         "key_path": gcp_key_paths[2],
         "location": "us-central1",
+        "max_in_flight": int(os.environ.get('GCP_MAX_IN_FLIGHT_3', 0)),
+        "weight": float(os.environ.get('GCP_WEIGHT_3', 1.0)),
     }
 ]
 
 # Setup S3 manager for handling images
 S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME", "lilotest-images")
 S3_REGION = os.environ.get("S3_REGION", "eu-north-1")
-s3_manager = S3ImageManager(S3_BUCKET_NAME, S3_REGION)
+s3_manager = S3ImageManager(
+    S3_BUCKET_NAME,
+    S3_REGION,
+    max_pool_connections=int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 50)),
+    connect_timeout=float(os.environ.get("S3_CONNECT_TIMEOUT", 5)),
+    read_timeout=float(os.environ.get("S3_READ_TIMEOUT", 30)),
+    max_attempts=int(os.environ.get("S3_MAX_ATTEMPTS", 3)),
+    retry_mode=os.environ.get("S3_RETRY_MODE", "adaptive"),
+    endpoint_url=os.environ.get("S3_ENDPOINT_URL") or None,
+    upload_workers=int(os.environ.get("S3_UPLOAD_WORKERS", 16)),
+)
+
+# Setup SDK rotator - spreads calls across projects and trips a circuit on repeated 429/5xx/401/403/404
+sdk_rotator = SDKRotator(
+    SDK_CONFIGS,
+    failure_threshold=int(os.environ.get("SDK_FAILURE_THRESHOLD", 3)),
+    cooldown=float(os.environ.get("SDK_CIRCUIT_COOLDOWN", 30)),
+    # Seconds a call waits for a slot when every project is at its max_in_flight quota
+    acquire_timeout=float(os.environ.get("SDK_ACQUIRE_TIMEOUT", 5)),
+)
+
+# Optional cache for Gemini replies to repeated context-free questions
+response_cache = ResponseCache(
+    async_redis_client,
+    enabled=os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() == "true",
+    ttl=int(os.environ.get("RESPONSE_CACHE_TTL", 3600)),
+    local_size=int(os.environ.get("RESPONSE_CACHE_LOCAL_SIZE", 1024)),
+    max_value_bytes=int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 16384)),
+    context_free_only=os.environ.get("RESPONSE_CACHE_CONTEXT_FREE_ONLY", "true").lower() == "true",
+)
+
+# Concurrent identical Gemini and Imagen calls share one generation. Text calls can also be
+# shared across replicas through a Redis lock; image results are tuples and stay in-process.
+SINGLEFLIGHT_DISTRIBUTED = os.environ.get("SINGLEFLIGHT_DISTRIBUTED", "false").lower() == "true"
+text_flights = SingleFlight(
+    "text",
+    async_redis_client if SINGLEFLIGHT_DISTRIBUTED else None,
+    lock_ttl=float(os.environ.get("SINGLEFLIGHT_LOCK_TTL", 60)),
+    result_ttl=int(os.environ.get("SINGLEFLIGHT_RESULT_TTL", 10)),
+)
+image_flights = SingleFlight("image")
+
+# Bounded worker pool for blocking Vertex AI calls made from the async API
+VERTEX_MAX_WORKERS = int(os.environ.get("VERTEX_MAX_WORKERS", 128))
+vertex_executor = ThreadPoolExecutor(max_workers=VERTEX_MAX_WORKERS, thread_name_prefix="vertex")
+
+GCP_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+# Models used for text and image generation
+TEXT_MODEL_NAME = "gemini-1.5-flash-002"
+IMAGE_MODEL_NAME = "imagen-3.0-generate-002"
+SYSTEM_INSTRUCTION = """Helpful and assisting ai."""
+
+# Imagen parameters
+IMAGE_GENERATION_PARAMS = {
+    "number_of_images": 1,
+    "aspect_ratio": "1:1",
+}
 
-# Setup SDK rotator
-sdk_rotator = SDKRotator(SDK_CONFIGS)
+# Images whose S3 upload failed are kept in Redis for a short while and served by /images/{id}
+# under FALLBACK_IMAGE_BASE_URL (e.g. https://api.lilotest.com); without it they are inlined as
+# base64 data URLs, since clients can't load relative URLs
+fallback_images = FallbackImageStore(
+    binary_redis_client,
+    async_binary_redis_client,
+    ttl=int(os.environ.get("FALLBACK_IMAGE_TTL", 900)),
+    base_url=os.environ.get("FALLBACK_IMAGE_BASE_URL", ""),
+)
+
+# Reuse S3 images generated for the same normalized prompt
+IMAGE_CACHE_ENABLED = os.environ.get("IMAGE_CACHE_ENABLED", "true").lower() == "true"
+IMAGE_CACHE_TTL = int(os.environ.get("IMAGE_CACHE_TTL", 60 * 60 * 24 * 7))
+
+# Rolling summaries of older turns
+SUMMARY_PREAMBLE = "Summary of our earlier conversation:"
+SUMMARY_INSTRUCTION = """Update the summary of this conversation with the new turns below.
+Keep facts, names, preferences, decisions and open questions the assistant needs to continue the conversation.
+Reply with the updated summary only, in at most 200 words."""
 
 # Common generation config
 GENERATION_CONFIG = {
@@ -67,226 +157,581 @@ GENERATION_CONFIG = {
     "top_p": 0.9,
 }
 
-# Safety settings
-SAFETY_SETTINGS = [
-    SafetySetting(
-        category=SafetySetting.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-        threshold=SafetySetting.HarmBlockThreshold.BLOCK_NONE
-    ),
-    SafetySetting(
-        category=SafetySetting.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-        threshold=SafetySetting.HarmBlockThreshold.BLOCK_NONE
-    ), 
-    SafetySetting(
-        category=SafetySetting.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-        threshold=SafetySetting.HarmBlockThreshold.BLOCK_NONE
-    ), 
-    SafetySetting(
-        category=SafetySetting.HarmCategory.HARM_CATEGORY_HARASSMENT,
-        threshold=SafetySetting.HarmBlockThreshold.BLOCK_NONE
-    ), 
-] 
-
-# Search tool for gemini models
-SEARCH_TOOL = [
-    Tool.from_google_search_retrieval(
-        google_search_retrieval=grounding.GoogleSearchRetrieval()
-    ),
-]
+# Safety settings, built on first use (vertex.SAFETY_SETTINGS still works, see __getattr__)
+@functools.lru_cache(maxsize=None)
+def build_safety_settings() -> List[Any]:
+    from vertexai.preview.generative_models import SafetySetting
+
+    return [
+        SafetySetting(
+            category=SafetySetting.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+            threshold=SafetySetting.HarmBlockThreshold.BLOCK_NONE
+        ),
+        SafetySetting(
+            category=SafetySetting.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+            threshold=SafetySetting.HarmBlockThreshold.BLOCK_NONE
+        ),
+        SafetySetting(
+            category=SafetySetting.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+            threshold=SafetySetting.HarmBlockThreshold.BLOCK_NONE
+        ),
+        SafetySetting(
+            category=SafetySetting.HarmCategory.HARM_CATEGORY_HARASSMENT,
+            threshold=SafetySetting.HarmBlockThreshold.BLOCK_NONE
+        ),
+    ]
+
+# Local compiled Q&A snapshot, regenerated by questions_answers.py and the background refresher
+FAQ_SNAPSHOT_PATH = os.environ.get("FAQ_SNAPSHOT_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "faq_snapshot.json"))
+FAQ_REFRESH_INTERVAL = float(os.environ.get("FAQ_REFRESH_INTERVAL", 300))
+FAQ_REFRESH_TIMEOUT = float(os.environ.get("FAQ_REFRESH_TIMEOUT", 10))
+
+# Search tool for gemini models, built on first use
+@functools.lru_cache(maxsize=None)
+def build_search_tool() -> List[Any]:
+    from vertexai.preview.generative_models import Tool, grounding
+
+    return [
+        Tool.from_google_search_retrieval(
+            google_search_retrieval=grounding.GoogleSearchRetrieval()
+        ),
+    ]
+
+def __getattr__(name: str) -> Any:
+    """Build SAFETY_SETTINGS and SEARCH_TOOL when first accessed, they need the vertexai SDK"""
+    if name == "SAFETY_SETTINGS":
+        return build_safety_settings()
+    if name == "SEARCH_TOOL":
+        return build_search_tool()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 class BaboonQAManager:
-    def __init__(self, bucket_url='https://questions-answers-baboon.s3.eu-north-1.amazonaws.com/questions_and_answers.xlsx'):
+    def __init__(
+        self,
+        bucket_url='https://questions-answers-baboon.s3.eu-north-1.amazonaws.com/questions_and_answers.xlsx',
+        snapshot_path: str = FAQ_SNAPSHOT_PATH,
+        refresh_interval: float = FAQ_REFRESH_INTERVAL,
+    ):
         self.bucket_url = bucket_url
-        self.qa_data = None
+        self.snapshot_path = snapshot_path
+        self.refresh_interval = refresh_interval
+        self.index = None
+        self.etag = None
+        self.last_modified = None
         self.support_info = {
             "phone": "+355676038187",
             "email": "support@baboon.al"
         }
-        self.load_qa_data()
-    
-    def load_qa_data(self):
-        """Load Q&A data from S3 bucket via URL"""
+        self._refresher = None
+        self._stop_refresh = threading.Event()
+        self.load_snapshot()
+
+    def load_snapshot(self) -> bool:
+        """Load the compiled Q&A snapshot from local disk"""
         try:
-            logger.info(f"Loading Q&A data from: {self.bucket_url}")
-            
-            # Test connection first
-            try:
-                import socket
-                socket.create_connection(("questions-answers-baboon.s3.eu-north-1.amazonaws.com", 443), timeout=5)
-                logger.info("Successfully connected to S3 host")
-            except Exception as e:
-                logger.error(f"Cannot connect to S3 host: {e}")
-            
-            # Try with different SSL settings
+            with open(self.snapshot_path, 'r', encoding='utf-8') as file:
+                snapshot = json.load(file)
+
+            entries = snapshot["entries"]
+            self.index = FAQIndex([e["question"] for e in entries], [e["answer"] for e in entries])
+            self.etag = snapshot.get("etag")
+            self.last_modified = snapshot.get("last_modified")
+            logger.info(f"Loaded {len(self.index)} Q&A pairs from snapshot {self.snapshot_path}")
+            return True
+
+        except Exception as e:
+            logger.error(f"Error loading Q&A snapshot from {self.snapshot_path}: {e}")
+            return False
+
+    def save_snapshot(self, index: FAQIndex) -> None:
+        """Atomically write the current Q&A data and validators to the local snapshot"""
+        snapshot = {
+            "source": self.bucket_url,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "entries": [
+                {"question": question, "answer": answer}
+                for question, answer in zip(index.questions, index.answers)
+            ],
+        }
+
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(snapshot, file, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def refresh(self) -> bool:
+        """
+        Fetch the remote Q&A sheet if it changed and swap the index in
+
+        Uses conditional requests (ETag / Last-Modified) so an unchanged
+        sheet costs a single 304 round-trip.
+
+        Returns:
+            True if a new index was installed
+        """
+        import requests
+
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        response = requests.get(self.bucket_url, headers=headers, timeout=FAQ_REFRESH_TIMEOUT)
+
+        if response.status_code == 304:
+            logger.debug("Q&A data not modified")
+            return False
+
+        response.raise_for_status()
+
+        index = FAQIndex.from_xlsx(response.content)
+
+        # Single reference assignment - requests in flight keep the index they already hold
+        self.index = index
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        logger.info(f"Refreshed {len(index)} Q&A pairs from {self.bucket_url}")
+
+        try:
+            self.save_snapshot(index)
+        except Exception as e:
+            logger.warning(f"Failed to write Q&A snapshot: {e}")
+
+        return True
+
+    def _refresh_loop(self) -> None:
+        while True:
             try:
-                # First attempt - normal request
-                response = requests.get(self.bucket_url, timeout=30)
-                logger.info(f"Normal request status: {response.status_code}")
+                self.refresh()
             except Exception as e:
-                logger.error(f"Normal request failed: {e}")
-                
-                # Second attempt - without SSL verification (for debugging only)
-                try:
-                    response = requests.get(self.bucket_url, timeout=30, verify=False)
-                    logger.warning("Request succeeded without SSL verification")
-                    logger.info(f"No-SSL request status: {response.status_code}")
-                except Exception as e2:
-                    logger.error(f"No-SSL request also failed: {e2}")
-                    
-                    # Third attempt - with explicit headers
-                    try:
-                        headers = {
-                            'User-Agent': 'Mozilla/5.0',
-                            'Accept': '*/*'
-                        }
-                        response = requests.get(self.bucket_url, headers=headers, timeout=30)
-                        logger.info(f"Headers request status: {response.status_code}")
-                    except Exception as e3:
-                        logger.error(f"Headers request failed: {e3}")
-                        raise e3
-            
-            response.raise_for_status()
-            
-            # Log successful response details
-            logger.info(f"Response headers: {dict(response.headers)}")
-            logger.info(f"Content length: {len(response.content)} bytes")
-            
-            # Load into pandas
-            self.qa_data = pd.read_excel(BytesIO(response.content))
-            logger.info(f"Successfully loaded {len(self.qa_data)} Q&A pairs from URL")
-            logger.info(f"Columns in Q&A data: {self.qa_data.columns.tolist()}")
-            
-        except Exception as e:
-            logger.error(f"Error loading Q&A data from URL: {e}")
-            logger.exception("Full traceback:")
-            self.qa_data = None
+                logger.error(f"Error refreshing Q&A data from {self.bucket_url}: {e}")
+
+            if self._stop_refresh.wait(self.refresh_interval):
+                return
+
+    def start_refresher(self) -> None:
+        """Start the background thread that keeps the Q&A data in sync with S3"""
+        if self.refresh_interval <= 0 or (self._refresher and self._refresher.is_alive()):
+            return
+
+        self._stop_refresh.clear()
+        self._refresher = threading.Thread(target=self._refresh_loop, name="faq-refresher", daemon=True)
+        self._refresher.start()
+
+    def stop_refresher(self) -> None:
+        """Stop the background refresh thread"""
+        self._stop_refresh.set()
     
     def find_best_match(self, user_message):
         """Find best matching question using fuzzy matching"""
-        if self.qa_data is None or self.qa_data.empty:
+        index = self.index
+        if index is None or len(index) == 0:
             logger.warning("No Q&A data available for matching")
             return None, 0
         
-        questions = self.qa_data['Question'].tolist()
-        logger.info(f"Searching for match among {len(questions)} questions")
-        best_match, score = process.extractOne(user_message, questions, scorer=fuzz.token_sort_ratio)
-        logger.info(f"Best match: '{best_match}' with score: {score}")
-        
-        # Get the corresponding answer
-        answer_index = self.qa_data[self.qa_data['Question'] == best_match].index[0]
-        answer = self.qa_data.loc[answer_index, 'Answer']
+        best_match, answer, score = index.match(user_message)
+        logger.debug(f"Best match: '{best_match}' with score: {score}")
         
         return answer, score
     
-    def process_question(self, user_message):
-        """Process user question and return appropriate response"""
-        answer, score = self.find_best_match(user_message)
-        
-        # Define thresholds
-        GOOD_MATCH_THRESHOLD = 85
-        POOR_MATCH_THRESHOLD = 40
-      
-        logger.info(f"Match score: {score}, Good threshold: {GOOD_MATCH_THRESHOLD}, Poor threshold: {POOR_MATCH_THRESHOLD}")
-        
-        if score >= GOOD_MATCH_THRESHOLD:
+    def build_response(self, decision: RouteDecision):
+        """Q&A system response for a FAQ or handover routing decision, None for other routes"""
+        if decision.route == ROUTE_FAQ:
             # Good match - return the answer
-            logger.info(f"Good match found, returning answer: {answer}")
             return {
                 "type": "qa_answer",
-                "response": answer,
+                "response": decision.answer,
                 "confidence": "high"
             }
-        elif score >= POOR_MATCH_THRESHOLD:
+        elif decision.route == ROUTE_HANDOVER:
             # Poor match - return support contact info
-            logger.info("Poor match, returning support contact")
             return {
                 "type": "support_contact",
                 "response": f"I'm not quite sure about that. You can contact our support team at {self.support_info['phone']} or email {self.support_info['email']}. Would you like to speak with a representative?",
                 "confidence": "low",
                 "support_info": self.support_info
             }
+        # No match - return None to use regular bot response
+        return None
+
+    def build_busy_response(self):
+        """Support contact response given instead of a model reply when the models are over capacity"""
+        return {
+            "type": "support_contact",
+            "response": f"We're getting a lot of messages right now, please try again in a moment. If it's urgent, you can contact our support team at {self.support_info['phone']} or email {self.support_info['email']}.",
+            "confidence": "low",
+            "support_info": self.support_info
+        }
+
+    def match_batch(
+        self,
+        messages: List[str],
+        good_threshold: int = GOOD_MATCH_THRESHOLD,
+        poor_threshold: int = POOR_MATCH_THRESHOLD,
+    ) -> List[Dict[str, Any]]:
+        """
+        Score many messages against the FAQ in one pass, for re-scoring traffic offline
+
+        Scores are the ones live routing computes; the thresholds only change
+        the decisions, so they can be tuned without touching the live values.
+
+        Args:
+            messages: Current user messages, without history
+            good_threshold: Score at or above which the FAQ answer is returned
+            poor_threshold: Score at or above which the message is handed over to support
+
+        Returns:
+            Per message: the message, matched question, answer, score and decision
+            ("faq", "handover" or None when the message goes to the models)
+        """
+        index = self.index
+        if index is None or len(index) == 0:
+            matches = [(None, None, 0)] * len(messages)
         else:
-            # No match - return None to use regular bot response
-            logger.info("No match found, returning None")
+            matches = index.match_many(messages)
+
+        return [
+            {
+                "message": message,
+                "matched_question": question,
+                "answer": answer,
+                "score": score,
+                "decision": faq_route(score, good_threshold, poor_threshold),
+            }
+            for message, (question, answer, score) in zip(messages, matches)
+        ]
+
+    def process_question(self, user_message):
+        """Process user question and return appropriate response"""
+        answer, score = self.find_best_match(user_message)
+
+        route = faq_route(score)
+        if route is None:
             return None
+        return self.build_response(RouteDecision(route, user_message, score, answer=answer))
 
 # Initialize the Q&A manager globally
 qa_manager = BaboonQAManager()
 
-def initialize_vertex_with_config(config: Dict[str, Any]) -> None:
-    """Initialize vertex ai with the given configuration"""
+# Routes every message once; reads the manager's current index so refreshes apply immediately
+intent_router = IntentRouter(lambda: qa_manager.index)
+
+def initialize_vertex_with_config(config: Dict[str, Any], credentials=None):
+    """Initialize vertex ai with the given configuration
 
-    # Set google credentials for authentication
-    if os.path.exists(config["key_path"]):
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = config["key_path"]
+    Credentials are passed to vertexai.init explicitly instead of through
+    GOOGLE_APPLICATION_CREDENTIALS, so concurrent threads don't race on the
+    process environment. Returns the credentials used.
+    """
+    import vertexai
 
-        # Initialize Vertex AI
-        vertexai.init(
-            project=config["project_id"],
-            location=config["location"],
+    if credentials is None:
+        from google.oauth2 import service_account
+
+
+        if not os.path.exists(config["key_path"]):
+            logger.error(f"GCP key file not found at: {config['key_path']}")
+            raise FileNotFoundError(f"GCP key file not found: {config['key_path']}")
+
+        credentials = service_account.Credentials.from_service_account_file(
+            config["key_path"],
+            scopes=GCP_SCOPES,
         )
-        logger.info(f"Initialized Vertex AI with project {config['project_id']}")
 
-    else:
-        logger.error(f"GCP key file not found at: {config['key_path']}")
-        raise FileNotFoundError(f"GCP key file not found: {config['key_path']}")
+    # Initialize Vertex AI
+    vertexai.init(
+        project=config["project_id"],
+        location=config["location"],
+        credentials=credentials,
+    )
+    logger.info(f"Initialized Vertex AI with project {config['project_id']}")
 
-def is_image_request(message: str) -> bool:
-    """Check if the message is requesting an image generation"""
-    # Check for image generation keywords (.image or image:)
-    pattern = r"(\.image|image:)"
-    return bool(re.search(pattern, message, re.IGNORECASE))
+    return credentials
 
-def generate_text_response(message: str, history: List[Dict[str, Any]]) -> str:
-    """Generate text response using Gemini model with exponential retry and SDK rotation logic.
+
+class VertexModelPool:
     """
-    def _generate_with_current_sdk():
-        config = sdk_rotator.get_current_config()
-        initialize_vertex_with_config(config)
-
-        instruction = """Helpful and assisting ai."""
-
-        model = GenerativeModel(
-            "gemini-1.5-flash-002",
-            system_instruction=[instruction],
-            #tools=SEARCH_TOOL,
-            generation_config=GENERATION_CONFIG,
-            safety_settings=SAFETY_SETTINGS,
-        )
-            
-        # Format history into Vertex AI format
-        formatted_history = []
-        for entry in history:
-            formatted_history.append({"role": "user", "parts": [{"text": entry["user_message"]}]})
+    Per-project Vertex AI model handles, built once and shared across threads
+
+    vertexai.init sets process-global state, so handles are only constructed
+    under a lock and each one binds its client to its project's credentials
+    at build time. After that, lookups are lock-free dict reads and the
+    underlying gRPC clients are safe to share between threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._credentials: Dict[str, Any] = {}
+        self._text_models: Dict[str, Any] = {}
+        self._image_models: Dict[str, Any] = {}
+
+    def _init_project(self, config: Dict[str, Any]) -> None:
+        """Point vertexai at the project; caller must hold the lock"""
+        key = config["project_id"]
+        self._credentials[key] = initialize_vertex_with_config(config, self._credentials.get(key))
+
+    def get_text_model(self, config: Dict[str, Any]):
+        """Return the Gemini model for the given SDK config"""
+        key = config["project_id"]
+        model = self._text_models.get(key)
+        if model is not None:
+            return model
+
+        with self._lock:
+            model = self._text_models.get(key)
+            if model is None:
+                from vertexai.preview.generative_models import GenerativeModel
+
+                self._init_project(config)
+                model = GenerativeModel(
+                    TEXT_MODEL_NAME,
+                    system_instruction=[SYSTEM_INSTRUCTION],
+                    #tools=SEARCH_TOOL,
+                    generation_config=GENERATION_CONFIG,
+                    safety_settings=build_safety_settings(),
+                )
+                # GenerativeModel has no public way to bind a project: its prediction client is
+                # built lazily from the global vertexai.init() config, which the next project's
+                # init overwrites. Building it here, right after this project's init and under
+                # the lock, pins the model to this project's credentials. The attribute is
+                # private, so an SDK without it only gets a warning.
+                prediction_client = getattr(model, "_prediction_client", None)
+                if prediction_client is None:
+                    logger.warning(f"Could not bind the text model to project {config['project_id']}; it will use the credentials active on its first call")
+                self._text_models[key] = model
+        return model
+
+    def get_image_model(self, config: Dict[str, Any]):
+        """Return the Imagen model for the given SDK config"""
+        key = config["project_id"]
+        model = self._image_models.get(key)
+        if model is not None:
+            return model
+
+        with self._lock:
+            model = self._image_models.get(key)
+            if model is None:
+                from vertexai.preview.vision_models import ImageGenerationModel
+
+                self._init_project(config)
+                model = ImageGenerationModel.from_pretrained(IMAGE_MODEL_NAME)
+                self._image_models[key] = model
+        return model
+
+    def warm_up(self, configs: List[Dict[str, Any]], include_image: bool = True) -> None:
+        """Build credentials and model handles for every config ahead of the first request"""
+        for config in configs:
+            try:
+                self.get_text_model(config)
+                if include_image:
+                    self.get_image_model(config)
+                logger.info(f"Warmed up Vertex AI models for project {config['project_id']}")
+            except Exception as e:
+                logger.error(f"Failed to warm up Vertex AI project {config['project_id']}: {e}")
+
+# Shared model handles for all requests
+model_pool = VertexModelPool()
+
+async def warm_up_models() -> None:
+    """Build model handles for every SDK config on the worker pool"""
+    await run_in_vertex_pool(model_pool.warm_up, SDK_CONFIGS)
 
-            if "bot_message" in entry:        
-                formatted_history.append({"role": "model", "parts": [{"text": entry["bot_message"]}]})
+# Modules imported on first use instead of at module import, loaded early by warm_up_clients
+DEFERRED_MODULES = ("requests", "PIL.Image", "vertexai.preview.generative_models", "vertexai.preview.vision_models")
 
-        # Add current message
-        conversation = formatted_history + [{"role": "user", "parts": [{"text": message}]}]
+def _load_clients() -> None:
+    """Import the SDKs deferred at module import and build the S3 client"""
+    start = time.perf_counter()
+    for module in DEFERRED_MODULES:
+        importlib.import_module(module)
 
-        # Generate response
+    build_safety_settings()
+    s3_manager.connect()
+    logger.info(f"Loaded deferred SDKs and clients in {time.perf_counter() - start:.2f}s")
+
+async def warm_up_clients() -> None:
+    """Load deferred SDKs and clients on the worker pool, so the first request doesn't pay for them"""
+    try:
+        await run_in_vertex_pool(_load_clients)
+    except Exception as e:
+        logger.error(f"Failed to warm up clients: {e}")
+
+async def run_in_vertex_pool(func: Callable, *args) -> Any:
+    """Run a blocking Vertex AI / S3 call on the bounded worker pool without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    # Carry the request's context (and its trace) into the worker thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(vertex_executor, functools.partial(context.run, func, *args))
+
+def is_image_request(message: str) -> bool:
+    """Check if the message is requesting an image generation"""
+    return IMAGE_KEYWORDS.search(message) is not None
+
+def _format_conversation(message: str, history: List[Dict[str, Any]], summary: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Format the summary, the history that fits the token budget and the current message into Vertex AI contents"""
+    formatted_history = []
+    if summary:
+        formatted_history.append({"role": "user", "parts": [{"text": f"{SUMMARY_PREAMBLE}\n{summary}"}]})
+        formatted_history.append({"role": "model", "parts": [{"text": "Understood."}]})
+
+    for entry in fit_history(history, summary):
+        formatted_history.append({"role": "user", "parts": [{"text": entry["user_message"]}]})
+
+        if "bot_message" in entry:
+            formatted_history.append({"role": "model", "parts": [{"text": entry["bot_message"]}]})
+
+    # Add current message
+    return formatted_history + [{"role": "user", "parts": [{"text": message}]}]
+
+def _response_text(response) -> str:
+    """Extract the text of a Gemini response or stream chunk"""
+    if hasattr(response, 'text'):
+        return response.text
+    elif hasattr(response, 'parts'):
+
+        text_parts = []
+        for part in response.parts:
+            if hasattr(part, 'text') and part.text:
+                text_parts.append(part.text)
+        return " ".join(text_parts)
+    else:
+        return str(response)
+
+def _generate_text_with_current_sdk(message: str, history: List[Dict[str, Any]], summary: Optional[str] = None) -> str:
+    """Single Gemini text generation attempt on the project picked by the SDK scheduler"""
+    conversation = _format_conversation(message, history, summary)
+
+    # Generate response; the lease records the outcome against the project
+    with sdk_rotator.lease("text") as config:
+        model = model_pool.get_text_model(config)
         response = model.generate_content(conversation)
 
-        if hasattr(response, 'text'):
-            return response.text
-        elif hasattr(response, 'parts'):
+    return _response_text(response)
 
-            text_parts = []
-            for part in response.parts:
-                if hasattr(part, 'text') and part.text:
-                    text_parts.append(part.text)
-            return " ".join(text_parts)
-        else:
-            return str(response)
+def _start_text_stream(message: str, history: List[Dict[str, Any]], summary: Optional[str] = None) -> Tuple[Any, Iterator[Any], ExitStack]:
+    """Open a streaming Gemini call and wait for its first chunk
+
+    Only this part is retried: once text has reached the client a failed
+    stream can't be transparently replayed on another project. The project
+    lease stays open after a successful start and is returned as an
+    ExitStack, so the project counts the call as in flight until the caller
+    exits it at the end of the stream.
+    """
+    conversation = _format_conversation(message, history, summary)
+
+    with ExitStack() as attempt:
+        config = attempt.enter_context(sdk_rotator.lease("text_stream"))
+        model = model_pool.get_text_model(config)
+        chunks = iter(model.generate_content(conversation, stream=True))
+        first_chunk = next(chunks, None)
+        return first_chunk, chunks, attempt.pop_all()
+
+def _close_stream(chunks: Iterator[Any], pending=None) -> None:
+    """Close a Gemini response stream, cancelling its gRPC call, once no worker thread is reading it"""
+    close = getattr(chunks, "close", None)
+    if close is None:
+        return
+
+    def close_stream(_=None):
+        try:
+            close()
+        except Exception as e:
+            logger.debug(f"Failed to close text stream: {e}")
 
+    if pending is not None and not pending.done():
+        pending.add_done_callback(close_stream)
+    else:
+        close_stream()
+
+def _text_error_response(error: Exception) -> str:
+    """Message returned to the user when every text generation attempt failed"""
+    return f"I'm sorry, I'm having trouble processing your request right now. Please try again later. (Error: {str(error)})"
+
+async def generate_text_response_async(message: str, history: List[Dict[str, Any]], summary: Optional[str] = None) -> str:
+    """Generate a text response with Gemini, with exponential retry and SDK rotation.
+
+    Each attempt runs on the Vertex worker pool and the backoff between
+    attempts is an asyncio.sleep, so waiting requests hold no thread.
+    Successful replies go through the optional response cache, and
+    concurrent identical requests share one generation.
+    """
+    cache_key = response_cache.key_for(message, history, summary)
+    if cache_key:
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    async def generate() -> str:
+        text_response = await async_exponential_backoff_retry(
+            lambda: run_in_vertex_pool(_generate_text_with_current_sdk, message, history, summary),
+            operation="text",
+        )
+        if cache_key:
+            await response_cache.set(cache_key, text_response)
+        return text_response
+
+    flight_key = request_key(message, history, summary)
     try:
-        # Try to generate with exponential backoff and SDK rotation
-        return exponential_backoff_retry(_generate_with_current_sdk)
+        if flight_key is None:
+            return await generate()
+        return await text_flights.do(flight_key, generate)
     except Exception as e:
-        # If all SDKs fail after retries, return an error message
         logger.error(f"All SDKs failed to generate text response: {str(e)}")
-        return f"I'm sorry, I'm having trouble processing your request right now. Please try again later. (Error: {str(e)})"
+        return _text_error_response(e)
+
+async def stream_text_response_async(message: str, history: List[Dict[str, Any]], summary: Optional[str] = None) -> AsyncIterator[str]:
+    """Yield Gemini text chunks as they are generated
+
+    Opening the stream is retried with backoff like generate_text_response_async;
+    each following chunk is pulled from the stream on the Vertex worker pool.
+    The project stays leased until the stream ends, and a stream abandoned
+    by the consumer (client disconnect, cancellation) is closed so Vertex
+    AI stops generating.
+    """
+    first_chunk, chunks, lease = await async_exponential_backoff_retry(
+        lambda: run_in_vertex_pool(_start_text_stream, message, history, summary),
+        operation="text_stream",
+    )
+
+    pending = None
+    try:
+        chunk = first_chunk
+        while chunk is not None:
+            text = _response_text(chunk)
+            if text:
+                yield text
+            # Submitted directly so a read still running after a cancellation can be waited on before closing
+            pending = vertex_executor.submit(contextvars.copy_context().run, next, chunks, None)
+            chunk = await asyncio.wrap_future(pending)
+    except Exception as e:
+        lease.__exit__(type(e), e, e.__traceback__)
+        raise
+    finally:
+        lease.close()
+        _close_stream(chunks, pending)
+
+def _summarize_with_current_sdk(summary: Optional[str], turns: List[Dict[str, Any]]) -> str:
+    """Single attempt at folding turns into the rolling summary"""
+    transcript = "\n".join(
+        f"User: {entry['user_message']}\nAssistant: {entry.get('bot_message', '')}"
+        for entry in turns
+    )
+    prompt = f"{SUMMARY_INSTRUCTION}\n\nCurrent summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"
+
+    with sdk_rotator.lease("summary") as config:
+        model = model_pool.get_text_model(config)
+        response = model.generate_content([{"role": "user", "parts": [{"text": prompt}]}])
+
+    return _response_text(response).strip()
+
+async def summarize_history_async(summary: Optional[str], turns: List[Dict[str, Any]]) -> str:
+    """Fold history turns into the rolling summary of a session; raises if every attempt fails"""
+    return await async_exponential_backoff_retry(
+        lambda: run_in_vertex_pool(_summarize_with_current_sdk, summary, turns),
+        operation="summary",
+    )
 
 
 def compress_to_webp(image_data: bytes, quality: int = 85, max_size: int = 800) -> Tuple[bytes, str]:
@@ -302,106 +747,153 @@ def compress_to_webp(image_data: bytes, quality: int = 85, max_size: int = 800)
         Tuple of (compressed image bytes, mimetype)
     """
 
+    from PIL import Image
+
     # Open image from bytes
     img = Image.open(BytesIO(image_data))
 
     # Resize if the image is too large while maintaining aspect ratio
-    if max(img.width, img.height) > max_size:
-        if img.width > img.height:
-            new_width = max_size
-            new_height = int(img.height * (max_size / img.width))
-        else:
-            new_height = max_size
-            new_width = int(img.width * (max_size / img.height))
-
-        img = img.resize((new_width, new_height), Image.LANCZOS)
+    img = fit_within(img, max_size)
 
     # Save as WebP with specified quality
-    output = BytesIO()
-    img.save(output, format="WEBP", quality=quality)
-    output.seek(0)
+    return encode_webp(img, quality), WEBP_MIMETYPE
 
-    return output.getvalue(), "image/webp"
 
+def image_cache_key(prompt: str) -> Optional[str]:
+    """Content address of a generated image: normalized prompt plus generation params"""
+    if not IMAGE_CACHE_ENABLED:
+        return None
 
-def generate_image(prompt: str) -> Tuple[str, Optional[str]]:
-    """
-    Generate image using Imagen 3 with retry and rotation logic,
-    compress to WebP and handle fallbacks
+    normalized = normalize_message(prompt)
+    if not normalized:
+        return None
 
-    Args:
-        prompt: Text prompt for image generation
+    params = json.dumps(
+        {"model": IMAGE_MODEL_NAME, "variant": IMAGE_VARIANTS["primary"], **IMAGE_GENERATION_PARAMS},
+        sort_keys=True,
+    )
+    digest = hashlib.sha256(f"{params}\x00{normalized}".encode("utf-8")).hexdigest()
+    return f"image_cache:{digest}"
 
-    Returns:
-        Tuple of (S3 URL or None, base64 data URL or None)
-    """
+def _generate_image_with_current_sdk(prompt: str) -> Tuple[Optional[str], Optional[str]]:
+    """Single Imagen generation attempt on the project picked by the SDK scheduler"""
 
-    def _generate_with_current_sdk():
+    with sdk_rotator.lease("image") as config:
+        generation_model = model_pool.get_image_model(config)
 
-        config = sdk_rotator.get_current_config()
-        initialize_vertex_with_config(config)
+        image_response = generation_model.generate_images(
+            prompt=prompt,
+            **IMAGE_GENERATION_PARAMS,
+        )
 
-        # Clean up the prompt - remove image keywords
-        clean_prompt = re.sub(r"(\.image|image:)", "", prompt, flags=re.IGNORECASE).strip()
+    logger.debug(f"image_response: {image_response}")
+    # Extract image data - first try the new API format
+    try:
+        if not image_response:
+            raise ValueError("No images were created")
 
-        from vertexai.preview.vision_models import ImageGenerationModel
+        image_data = image_response[0]._image_bytes
 
-        generation_model = ImageGenerationModel.from_pretrained("imagen-3.0-generate-002")
+        # Decode once and encode the 800px/85%, 600px/70% fallback and thumbnail
+        # variants together in the image process pool, off this thread's GIL
+        with span("image.process", IMAGE_PROCESSING_LATENCY):
+            variants = render_variants_in_pool(image_data)
 
-        image_response = generation_model.generate_images(
-            prompt=clean_prompt,
-            number_of_images=1,
-            aspect_ratio="1:1",
-        )   
+        # Generate unique filename with WebP extension
+        image_id = uuid.uuid4()
+        filename = f"image_{image_id}.webp"
 
-        logger.info(f"image_response: {image_response}")
-        # Extract image data - first try the new API format
         try:
-            if not image_response:
-                raise ValueError("No images were created")
+            # Primary and thumbnail go up as one batch. The thumbnail lives next to the image,
+            # clients derive its key from the image URL, and its failure is not fatal
+            image_url, thumbnail_url = s3_manager.upload_images([
+                (variants["primary"], filename, WEBP_MIMETYPE),
+                (variants["thumbnail"], f"image_{image_id}_thumb.webp", WEBP_MIMETYPE),
+            ])
+            if isinstance(thumbnail_url, Exception):
+                logger.warning(f"Failed to upload thumbnail to S3: {str(thumbnail_url)}")
+            if isinstance(image_url, Exception):
+                raise image_url
+
+            if hasattr(image_response[0], 'enhanced_prompt'):
+                logger.debug(f"Enhanced prompt: {image_response[0].enhanced_prompt}")
+
+            # Success - return URL with no fallback needed
+            return image_url, None
+        except Exception as s3_error:
+            # S3 upload failed, serve the more aggressively compressed variant (70% quality, 600px max)
+            # from the fallback image store
+            logger.warning(f"Failed to upload to S3, using fallback image: {str(s3_error)}")
+
+            if fallback_images.enabled:
+                try:
+                    image_id = fallback_images.put(variants["fallback"], WEBP_MIMETYPE)
+                    return None, fallback_images.url(image_id)
+                except Exception as store_error:
+                    # Last resort: inline the image as a base64 data URL
+                    logger.warning(f"Failed to store fallback image, using base64 fallback: {str(store_error)}")
 
-            image_data = image_response[0]._image_bytes
+            base64_encoded = base64.b64encode(variants["fallback"]).decode('utf-8')
+            data_url = f"data:{WEBP_MIMETYPE};base64,{base64_encoded}"
 
-            # Compress to WebP format and 85% quality
-            compressed_data, mimetype = compress_to_webp(image_data, quality=85)
+            return None, data_url
 
-            # Generate unique filename with WebP extension
-            filename = f"image_{uuid.uuid4()}.webp"
+    except Exception as processing_error:
+        logger.error(f"Error processing image: {str(processing_error)}")
+        raise
 
-            try:
-                # Try to upload to S3
-                image_url = s3_manager.upload_image(compressed_data, filename, content_type=mimetype)
+async def generate_image_async(prompt: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Generate an image with Imagen, with exponential retry and SDK rotation,
+    compress it to WebP and handle fallbacks
 
-                if hasattr(image_response[0], 'enhanced_prompt'):
-                    logger.info(f"Enhanced prompt: {image_response[0].enhanced_prompt}")
+    Each attempt runs on the Vertex worker pool. Concurrent requests for the
+    same normalized prompt share one generation, and generated URLs are
+    cached by prompt when the image cache is enabled.
 
-                # Success - return URL with no fallback needed
-                return image_url, None
-            except Exception as s3_error:
-                # S3 upload failed, use base64 fallback with further compression
-                logger.warning(f"Failed to upload to S3, using base64 fallback: {str(s3_error)}")
+    Args:
+        prompt: Text prompt for image generation, without the image keywords
+            (RouteDecision.image_prompt)
 
-                # Apply more aggressive compression for fallback (70% quality, 600px max)
-                fallback_data, fallback_mimetype = compress_to_webp(image_data, quality=70, max_size=600)
+    Returns:
+        Tuple of (S3 URL or None, fallback URL or None); the fallback URL points at
+        /images/{id} under FALLBACK_IMAGE_BASE_URL, or is a base64 data URL if no base
+        URL is configured or the fallback store failed
+    """
+    flight_key = normalize_message(prompt)
+    if not flight_key:
+        return await _generate_image_async(prompt)
+    return await image_flights.do(flight_key, lambda: _generate_image_async(prompt))
 
-                # Convert to base64 data URL
-                base64_encoded = base64.b64encode(fallback_data).decode('utf-8')
-                data_url = f"data:{fallback_mimetype};base64,{base64_encoded}"
- 
-                return None, data_url
+async def _generate_image_async(prompt: str) -> Tuple[Optional[str], Optional[str]]:
 
-        except Exception as processing_error:
-            logger.error(f"Error processing image: {str(processing_error)}")
-            raise
+    cache_key = image_cache_key(prompt)
+    if cache_key:
+        try:
+            cached_url = await async_redis_client.get(cache_key)
+            if cached_url:
+                logger.info(f"Image cache hit ({len(prompt)} char prompt)")
+                return cached_url, None
+        except Exception as cache_error:
+            logger.warning(f"Image cache lookup failed: {str(cache_error)}")
 
     try:
-        # Try to generate with exponential backoff and SDK rotation
-        return exponential_backoff_retry(_generate_with_current_sdk)
+        image_url, data_url = await async_exponential_backoff_retry(
+            lambda: run_in_vertex_pool(_generate_image_with_current_sdk, prompt),
+            operation="image",
+        )
     except Exception as e:
-        # If all SDKs fail after some retries, return an error message
         logger.error(f"All SDKs failed to generate image: {str(e)}")
         return None, None
 
+    if cache_key and image_url:
+        try:
+            await async_redis_client.set(cache_key, image_url, ex=IMAGE_CACHE_TTL)
+        except Exception as cache_error:
+            logger.warning(f"Image cache store failed: {str(cache_error)}")
+
+    return image_url, data_url
+
 
 def enhance_s3_image_manager():
     """Add a method for WebP compression to the S3ImageManager class"""
@@ -427,213 +919,203 @@ def enhance_s3_image_manager():
     # Add the method to the S3 Image Manager class 
     S3ImageManager.upload_webp_image = upload_webp_image
 
-def extract_current_message(full_prompt: str) -> str:
-    """Extract the current user message from the full prompt with history"""
-    
-    # Look for the CURRENT USER MESSAGE marker
-    marker = "=== CURRENT USER MESSAGE ==="
-    
-    if marker in full_prompt:
-        # Split at the marker and take everything after it
-        parts = full_prompt.split(marker)
-        if len(parts) > 1:
-            current_message = parts[1].strip()
-            logger.info(f"Extracted current message: {current_message}")
-            return current_message
-    
-    # If no marker found, return the full prompt
-    logger.info("No marker found, using full prompt")
-    return full_prompt.strip()
-
-def process_message(message: str, history: List[Dict[str, Any]]) -> Dict[str, Any]:
-    """Process incoming message and generate appropriate response"""
-    
-    # Extract the current message for Q&A matching
-    current_message = extract_current_message(message)
-    
-    # First, check if this is a Q&A type question
-    qa_result = qa_manager.process_question(current_message)
-    
-    if qa_result:
-        # Q&A system has a response
-        if qa_result["type"] == "qa_answer":
-            response = {
-                "type": "text",
-                "text": qa_result["response"],
-                "source": "qa_system"
-            }
-        elif qa_result["type"] == "support_contact":
-            response = {
-                "type": "support_contact",
-                "text": qa_result["response"],
-                "support_info": qa_result["support_info"],
-                "show_representative_button": True
-            }
-        
-        history_entry = {
-            "user_message": current_message,  # Store only the current message
-            "bot_message": qa_result["response"]
-        }
-        
-        return {"response": response, "history_entry": history_entry}
-    
-    # If no Q&A match, proceed with regular processing
-    if is_image_request(current_message):
-        # ... (existing image generation code)
-        logger.info(f"Processing image generation request: {current_message}")
-        image_url, image_base64 = generate_image(current_message)
-        
-        text_response = "Generated image"
-        if image_url:
-            text_response = f"{text_response}\n!IMAGEURL!{image_url}"
-        elif image_base64:
-            text_response = f"{text_response}\n!IMAGEDATA!{image_base64}"
-        
-        response = {
-            "type": "image",
-            "text": text_response,
-            "url": image_url,
-            "base64": image_base64
-        }
-        
-        history_entry = {
-            "user_message": current_message,  # Store only the current message
-            "bot_message": "image"
-        }
-    else:
-        # Generate text response using the full prompt
-        logger.info(f"Processing text request: {message}")  # Use full message for context
-        text_response = generate_text_response(message, history)  # Pass full message
-        
+def _build_qa_result(current_message: str, qa_result: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the response and history entry for a Q&A system answer"""
+    if qa_result["type"] == "qa_answer":
         response = {
             "type": "text",
-            "text": text_response
+            "text": qa_result["response"],
+            "source": "qa_system"
         }
-        
-        history_entry = {
-            "user_message": current_message,  # Store only the current message
-            "bot_message": text_response
-        }
-    
-    return {"response": response, "history_entry": history_entry}
-    
-    # If no Q&A match, proceed with regular processing
-    if is_image_request(message):
-        # ... (existing image generation code)
-        logger.info(f"Processing image generation request: {message}")
-        image_url, image_base64 = generate_image(message)
-        
-        text_response = "Generated image"
-        if image_url:
-            text_response = f"{text_response}\n!IMAGEURL!{image_url}"
-        elif image_base64:
-            text_response = f"{text_response}\n!IMAGEDATA!{image_base64}"
-        
+    elif qa_result["type"] == "support_contact":
         response = {
-            "type": "image",
-            "text": text_response,
-            "url": image_url,
-            "base64": image_base64
-        }
-        
-        history_entry = {
-            "user_message": message,
-            "bot_message": "image"
-        }
-    else:
-        # Generate text response
-        logger.info(f"Processing text request: {message}")
-        text_response = generate_text_response(message, history)
-        
-        response = {
-            "type": "text",
-            "text": text_response
-        }
-        
-        history_entry = {
-            "user_message": message,
-            "bot_message": text_response
+            "type": "support_contact",
+            "text": qa_result["response"],
+            "support_info": qa_result["support_info"],
+            "show_representative_button": True
         }
-    
+
+    history_entry = {
+        "user_message": current_message,  # Store only the current message
+        "bot_message": qa_result["response"]
+    }
+
     return {"response": response, "history_entry": history_entry}
-    
-    logger.info("No QA match, proceeding with regular processing")
-    
-    # If no Q&A match, proceed with regular processing
-    if is_image_request(message):
-        # ... (existing image generation code)
-        logger.info(f"Processing image generation request: {message}")
-        image_url, image_base64 = generate_image(message)
-        
-        text_response = "Generated image"
-        if image_url:
-            text_response = f"{text_response}\n!IMAGEURL!{image_url}"
-        elif image_base64:
-            text_response = f"{text_response}\n!IMAGEDATA!{image_base64}"
-        
-        response = {
-            "type": "image",
-            "text": text_response,
-            "url": image_url,
-            "base64": image_base64
-        }
-        
-        history_entry = {
-            "user_message": message,
-            "bot_message": "image"
-        }
-    else:
-        # Generate text response
-        logger.info(f"Processing text request: {message}")
-        text_response = generate_text_response(message, history)
-        
-        response = {
-            "type": "text",
-            "text": text_response
-        }
-        
-        history_entry = {
-            "user_message": message,
-            "bot_message": text_response
-        }
-    
-    return {"response": response, "history_entry": history_entry}    
-    # If no Q&A match, proceed with regular processing
-    if is_image_request(message):
-        # ... (existing image generation code)
-        logger.info(f"Processing image generation request: {message}")
-        image_url, image_base64 = generate_image(message)
-        
-        text_response = "Generated image"
-        if image_url:
-            text_response = f"{text_response}\n!IMAGEURL!{image_url}"
-        elif image_base64:
-            text_response = f"{text_response}\n!IMAGEDATA!{image_base64}"
-        
-        response = {
-            "type": "image",
-            "text": text_response,
-            "url": image_url,
-            "base64": image_base64
-        }
-        
-        history_entry = {
-            "user_message": message,
-            "bot_message": "image"
-        }
+
+def build_busy_result(decision: RouteDecision) -> Dict[str, Any]:
+    """
+    Degraded response for a text or image request shed by admission control
+
+    The support contact answer, flagged busy so clients can offer a retry.
+    Its history entry is not meant to be stored: the model never saw the message.
+    """
+    result = _build_qa_result(decision.message, qa_manager.build_busy_response())
+    result["response"]["busy"] = True
+    return result
+
+def _build_image_result(current_message: str, image_url: Optional[str], image_base64: Optional[str]) -> Dict[str, Any]:
+    """Build the response and history entry for a generated image"""
+    if image_url is None and image_base64 and not image_base64.startswith("data:"):
+        # Fallback served by /images/{id}: clients load it like an S3 URL
+        image_url, image_base64 = image_base64, None
+
+    text_response = "Generated image"
+    if image_url:
+        text_response = f"{text_response}\n!IMAGEURL!{image_url}"
+    elif image_base64:
+        text_response = f"{text_response}\n!IMAGEDATA!{image_base64}"
+
+    response = {
+        "type": "image",
+        "text": text_response,
+        "url": image_url,
+        "base64": image_base64
+    }
+
+    history_entry = {
+        "user_message": current_message,  # Store only the current message
+        "bot_message": "image"
+    }
+
+    return {"response": response, "history_entry": history_entry}
+
+def _build_text_result(current_message: str, text_response: str) -> Dict[str, Any]:
+    """Build the response and history entry for a Gemini text reply"""
+    response = {
+        "type": "text",
+        "text": text_response
+    }
+
+    history_entry = {
+        "user_message": current_message,  # Store only the current message
+        "bot_message": text_response
+    }
+
+    return {"response": response, "history_entry": history_entry}
+
+def _build_image_job_result(current_message: str, job_id: str) -> Dict[str, Any]:
+    """Build the response and history entry for a queued image job"""
+    response = {
+        "type": "image_pending",
+        "text": "Generating image",
+        "job_id": job_id,
+        "status_url": f"/image-jobs/{job_id}"
+    }
+
+    history_entry = {
+        "user_message": current_message,
+        "bot_message": "image"
+    }
+
+    return {"response": response, "history_entry": history_entry}
+
+async def generate_image_response_async(image_prompt: str) -> Dict[str, Any]:
+    """Generate an image and return the same response object as an inline image request"""
+    image_url, image_base64 = await generate_image_async(image_prompt)
+    return _build_image_result(image_prompt, image_url, image_base64)["response"]
+
+async def process_message_async(
+    message: str,
+    history: List[Dict[str, Any]],
+    summary: Optional[str] = None,
+    submit_image_job: Optional[Callable[[str], Awaitable[str]]] = None,
+    decision: Optional[RouteDecision] = None,
+) -> Dict[str, Any]:
+    """Process an incoming message and generate the appropriate response.
+
+    Q&A matching is in-process and cheap so it runs inline; Gemini and
+    Imagen calls are awaited on the Vertex worker pool. With
+    submit_image_job, image requests are queued and answered with a job id
+    instead of waiting for generation; a full queue falls back to inline
+    generation. A decision already made by the caller is reused instead of
+    routing the message again.
+    """
+
+    if decision is None:
+        decision = intent_router.route(message)
+    current_message = decision.message
+
+    qa_result = qa_manager.build_response(decision)
+
+    if qa_result:
+        return _build_qa_result(current_message, qa_result)
+
+    if decision.route == ROUTE_IMAGE:
+        if submit_image_job is not None:
+            try:
+                job_id = await submit_image_job(decision.image_prompt)
+                logger.info(f"Queued image generation job {job_id}")
+                return _build_image_job_result(current_message, job_id)
+            except asyncio.QueueFull:
+                logger.warning("Image job queue is full, generating inline")
+
+        logger.info(f"Processing image generation request ({len(current_message)} chars)")
+        image_url, image_base64 = await generate_image_async(decision.image_prompt)
+        return _build_image_result(current_message, image_url, image_base64)
+
+    logger.info(f"Processing text request ({len(current_message)} chars)")
+    text_response = await generate_text_response_async(message, history, summary)
+    return _build_text_result(current_message, text_response)
+
+async def stream_message_async(
+    message: str,
+    history: List[Dict[str, Any]],
+    summary: Optional[str] = None,
+    decision: Optional[RouteDecision] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Streaming variant of process_message_async
+
+    Yields {"event": "chunk", "text": ...} while Gemini generates, then a
+    final {"event": "done", "response": ..., "history_entry": ...}. Q&A
+    answers and images are not streamed and arrive as a single "done".
+    """
+
+    if decision is None:
+        decision = intent_router.route(message)
+    current_message = decision.message
+
+    qa_result = qa_manager.build_response(decision)
+
+    if qa_result:
+        yield dict(_build_qa_result(current_message, qa_result), event="done")
+        return
+
+    if decision.route == ROUTE_IMAGE:
+        logger.info(f"Processing image generation request ({len(current_message)} chars)")
+        image_url, image_base64 = await generate_image_async(decision.image_prompt)
+        yield dict(_build_image_result(current_message, image_url, image_base64), event="done")
+        return
+
+    logger.info(f"Processing streaming text request ({len(current_message)} chars)")
+
+    cache_key = response_cache.key_for(message, history, summary)
+    cached = await response_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        yield {"event": "chunk", "text": cached}
+        yield dict(_build_text_result(current_message, cached), event="done")
+        return
+
+    text_parts = []
+    text_stream = stream_text_response_async(message, history, summary)
+    try:
+        async for text in text_stream:
+            text_parts.append(text)
+            yield {"event": "chunk", "text": text}
+    except Exception as e:
+        if text_parts:
+            # Keep what the client has already seen
+            logger.error(f"Text stream failed after {len(text_parts)} chunks: {str(e)}")
+        else:
+            logger.error(f"All SDKs failed to stream text response: {str(e)}")
+            error_text = _text_error_response(e)
+            text_parts.append(error_text)
+            yield {"event": "chunk", "text": error_text}
     else:
-        # Generate text response
-        logger.info(f"Processing text request: {message}")
-        text_response = generate_text_response(message, history)
-        
-        response = {
-            "type": "text",
-            "text": text_response
-        }
-        
-        history_entry = {
-            "user_message": message,
-            "bot_message": text_response
-        }
-    
-    return {"response": response, "history_entry": history_entry}
\ No newline at end of file
+        if cache_key:
+            await response_cache.set(cache_key, "".join(text_parts))
+    finally:
+        # Close the Gemini stream now, not when the generator is garbage collected
+        await text_stream.aclose()
+
+    yield dict(_build_text_result(current_message, "".join(text_parts)), event="done")